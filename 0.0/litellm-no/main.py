@@ -2,6 +2,8 @@ import os
 import uvicorn
 from fastapi import FastAPI, Request, Header, HTTPException, Query
 from fastapi.responses import StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
+from contextlib import asynccontextmanager
 import httpx
 from dotenv import load_dotenv
 import json
@@ -19,7 +21,29 @@ MCP_SERVER_URL = os.getenv("MCP_SERVER_URL")  # MCP server base URL
 if not SUPABASE_API_KEY or not SUPABASE_PROJECT_URL:
     raise RuntimeError("Missing Supabase environment configuration.")
 
-app = FastAPI()
+# One client per place we proxy to, made when the app starts and kept
+# for its lifetime, so requests reuse kept-alive connections (HTTP/2
+# where the server does it) instead of a new handshake each, and every
+# call has timeouts. Read is between bytes, completions can take a while
+# to get going.
+def make_client(base_url, read, max_connections):
+    return httpx.AsyncClient(
+        base_url=base_url,
+        timeout=httpx.Timeout(connect=10, read=read, write=30, pool=30),
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections // 4, keepalive_expiry=60),
+        http2=True,
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.clients = {"openrouter": make_client(OPENROUTER_URL, 300, 200)}
+    if MCP_SERVER_URL:
+        app.state.clients["mcp"] = make_client(MCP_SERVER_URL, 60, 50)
+    yield
+    for client in app.state.clients.values():
+        await client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 HISTORY_DIR = Path("conversation_history")
 HISTORY_DIR.mkdir(exist_ok=True)
@@ -43,23 +67,18 @@ def save_user_history(user_id: str, data: dict):
 
 # --- Core Proxy to OpenRouter ---
 
-async def proxy_request(request: Request, target_url: str):
+async def proxy_request(request: Request, target_url: str, client_name: str = "openrouter"):
     method = request.method
     headers = dict(request.headers)
     headers.pop("host", None)
     body = await request.body()
-    async with httpx.AsyncClient(timeout=None) as client:
-        try:
-            resp = await client.request(
-                method,
-                target_url,
-                headers=headers,
-                content=body,
-                stream=True,
-            )
-            return StreamingResponse(resp.aiter_raw(), status_code=resp.status_code, headers=dict(resp.headers))
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=502, detail=str(e))
+    client = request.app.state.clients[client_name]
+    try:
+        resp = await client.send(client.build_request(method, target_url, headers=headers, content=body), stream=True)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    # The connection goes back to the pool once the body's been sent on.
+    return StreamingResponse(resp.aiter_raw(), status_code=resp.status_code, headers=dict(resp.headers), background=BackgroundTask(resp.aclose))
 
 
 # --- Stub MCP Client Integration ---
@@ -79,24 +98,23 @@ async def mcp_proxy(request: Request, path: str):
     body = await request.body()
     target_url = f"{MCP_SERVER_URL}/{path}"
 
-    async with httpx.AsyncClient(timeout=None) as client:
+    client = request.app.state.clients["mcp"]
+    try:
+        resp = await client.send(client.build_request(method, target_url, headers=headers, content=body), stream=True)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+    # For demo, if JSON response, parse & modify here if needed
+    if 'application/json' in resp.headers.get('content-type', ''):
         try:
-            resp = await client.request(
-                method,
-                target_url,
-                headers=headers,
-                content=body,
-                stream=True,
-            )
-            # For demo, if JSON response, parse & modify here if needed
-            if 'application/json' in resp.headers.get('content-type', ''):
-                json_data = resp.json()
-                # Add any MCP-layer processing here, e.g. validation, augmentation
-                return JSONResponse(content=json_data, status_code=resp.status_code)
-            else:
-                return StreamingResponse(resp.aiter_raw(), status_code=resp.status_code, headers=dict(resp.headers))
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=502, detail=str(e))
+            await resp.aread()
+        finally:
+            await resp.aclose()
+        json_data = resp.json()
+        # Add any MCP-layer processing here, e.g. validation, augmentation
+        return JSONResponse(content=json_data, status_code=resp.status_code)
+    else:
+        return StreamingResponse(resp.aiter_raw(), status_code=resp.status_code, headers=dict(resp.headers), background=BackgroundTask(resp.aclose))
 
 
 # --- API Key Validation Stub ---
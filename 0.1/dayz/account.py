@@ -1,3 +1,15 @@
+import os
+import time
+from fastapi import APIRouter, Depends, Request, HTTPException, status
+from fastapi.responses import RedirectResponse
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from starlette.authentication import AuthenticationBackend, AuthCredentials, SimpleUser
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+import auth_db
+import clients
+import credentials
+
 _tools =  [{
     "type": "function",
     "function": {
@@ -15,11 +27,16 @@ _tools =  [{
     },
 }] 
 
-def history_process(api_key, message):
-    pass
+def history_process(api_key, messages):
+    # The messages go upstream as they are. They get stored once the
+    # reply is in, the request's turns and the reply together under
+    # app.capture_meta(), see capture.py and history.py.
+    return messages
 
-def get_api_key(caller_key, model):
-    pass
+# API keys are looked up, and cached, in credentials.py so the proxy
+# can get at them without this module.
+get_api_key = credentials.get_api_key
+aget_api_key = credentials.aget_api_key
 
 def add_tools(body):
     toolList = body.get('tools') or []
@@ -35,11 +52,12 @@ def get_stream_id(body):
 # Configuration
 import jwt
 import casbin
+import acl
 GITHUB_CLIENT_ID = os.getenv("GITHUB_CLIENT_ID")
 GITHUB_CLIENT_SECRET = os.getenv("GITHUB_CLIENT_SECRET")
-JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-here")
-JWT_ALGORITHM = "HS256"
-JWT_EXPIRATION_HOURS = 24
+JWT_SECRET_KEY = credentials.JWT_SECRET_KEY
+JWT_ALGORITHM = credentials.JWT_ALGORITHM
+JWT_EXPIRATION_HOURS = credentials.JWT_EXPIRATION_HOURS
 
 # Security
 security = HTTPBearer()
@@ -54,13 +72,44 @@ auth = AuthX(AuthXConfig(
 auth.handle_errors(app)
 app.include_router(auth.get_social_router(), prefix="/auth")
 """
+# The routes below, for the server to include_router(). app.py puts
+# them behind CasbinMiddleware with this enforcer, and Bearer in front
+# of that so casbin knows who's asking.
+app = APIRouter()
+get_db = auth_db.get_db
+
 # Casbin Setup
-enforcer = casbin.Enforcer("casbin_model.conf", "casbin_policy.csv")
-app.add_middleware(CasbinMiddleware, enforcer=enforcer)
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
+# Decisions are cached and the policy file reloads itself, see acl.py.
+_here = os.path.dirname(os.path.abspath(__file__))
+enforcer = acl.CachedEnforcer(os.path.join(_here, "casbin_model.conf"), os.path.join(_here, "casbin_policy.csv"))
+
+class Bearer(AuthenticationBackend):
+    # Who casbin checks: the sub of a good JWT, anyone else is
+    # 'anonymous' as far as the policy goes.
+    async def authenticate(self, conn):
+        header = conn.headers.get("Authorization") or ""
+        if not header.lower().startswith("bearer "):
+            return None
+        try:
+            payload = decode_token(header[7:].strip())
+        except jwt.InvalidTokenError:
+            return None
+        if payload.get("sub") is None:
+            return None
+        return AuthCredentials(["authenticated"]), SimpleUser(str(payload["sub"]))
+
+# Verified tokens are cached, and revoked, in credentials.py.
+decode_token = credentials.decode_token
+revoke_token = credentials.revoke_token
+
+def create_access_token(data):
+    claims = dict(data, exp=int(time.time()) + JWT_EXPIRATION_HOURS * 3600)
+    return jwt.encode(claims, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+
+def verify_token(bearer: HTTPAuthorizationCredentials = Depends(security)):
+    token = bearer.credentials
     try:
-        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+        payload = decode_token(token)
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(
@@ -69,13 +118,19 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
                 headers={"WWW-Authenticate": "Bearer"},
             )
         return payload
+    except credentials.Revoked:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token revoked",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     except jwt.ExpiredSignatureError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Token expired",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials",
@@ -104,82 +159,84 @@ async def github_login_old():
     return await auth.social_login("github")
 
 @app.get("/auth/github/callback")
-async def github_callback(code: str, db: Session = Depends(get_db)):
+async def github_callback(code: str, db: AsyncSession = Depends(get_db)):
     """Handle GitHub OAuth callback"""
     if not code:
         raise HTTPException(status_code=400, detail="Authorization code not provided")
     
     # Exchange code for access token
-    async with httpx.AsyncClient() as client:
-        token_response = await client.post(
-            "https://github.com/login/oauth/access_token",
-            data={
-                "client_id": GITHUB_CLIENT_ID,
-                "client_secret": GITHUB_CLIENT_SECRET,
-                "code": code,
-            },
-            headers={"Accept": "application/json"},
-        )
-        
-        if token_response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to get access token")
-        
-        token_data = token_response.json()
-        github_token = token_data.get("access_token")
-        
-        if not github_token:
-            raise HTTPException(status_code=400, detail="No access token received")
-        
-        # Get user info from GitHub
-        user_response = await client.get(
-            "https://api.github.com/user",
-            headers={"Authorization": f"token {github_token}"},
-        )
-        
-        if user_response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to get user info")
-        
-        user_data = user_response.json()
-        
-        # Get user email (GitHub might not include email in user endpoint)
-        email_response = await client.get(
-            "https://api.github.com/user/emails",
-            headers={"Authorization": f"token {github_token}"},
-        )
-        
-        emails = email_response.json() if email_response.status_code == 200 else []
-        primary_email = next((email["email"] for email in emails if email["primary"]), None)
-        
-        # Create or update user in database
-        github_id = str(user_data["id"])
-        username = user_data["login"]
-        name = user_data.get("name", username)
-        email = primary_email or user_data.get("email")
-        
-        # TODO: Implement user creation/update logic with your auth_db
-        # user = auth_db_module.create_or_update_user(
-        #     github_id=github_id,
-        #     username=username,
-        #     name=name,
-        #     email=email
-        # )
-        
-        # Create JWT token
-        access_token = create_access_token(
-            data={
-                "sub": github_id,
-                "username": username,
-                "name": name,
-                "email": email,
-            }
-        )
-        
-        return {"access_token": access_token, "token_type": "bearer"}
-async def github_callback(request: Request, db: Session = Depends(get_db)):
+    # Shared and kept alive, with timeouts, see clients.py.
+    client = clients.client('oauth')
+    token_response = await client.post(
+        "https://github.com/login/oauth/access_token",
+        data={
+            "client_id": GITHUB_CLIENT_ID,
+            "client_secret": GITHUB_CLIENT_SECRET,
+            "code": code,
+        },
+        headers={"Accept": "application/json"},
+    )
+    
+    if token_response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to get access token")
+    
+    token_data = token_response.json()
+    github_token = token_data.get("access_token")
+    
+    if not github_token:
+        raise HTTPException(status_code=400, detail="No access token received")
+    
+    # Get user info from GitHub
+    user_response = await client.get(
+        "https://api.github.com/user",
+        headers={"Authorization": f"token {github_token}"},
+    )
+    
+    if user_response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to get user info")
+    
+    user_data = user_response.json()
+    
+    # Get user email (GitHub might not include email in user endpoint)
+    email_response = await client.get(
+        "https://api.github.com/user/emails",
+        headers={"Authorization": f"token {github_token}"},
+    )
+    
+    emails = email_response.json() if email_response.status_code == 200 else []
+    primary_email = next((email["email"] for email in emails if email["primary"]), None)
+    
+    # Create or update user in database
+    github_id = str(user_data["id"])
+    username = user_data["login"]
+    name = user_data.get("name", username)
+    email = primary_email or user_data.get("email")
+    
+    # TODO: Implement user creation/update logic with your auth_db
+    # user = auth_db_module.create_or_update_user(
+    #     github_id=github_id,
+    #     username=username,
+    #     name=name,
+    #     email=email
+    # )
+    
+    # Create JWT token
+    access_token = create_access_token(
+        data={
+            "sub": github_id,
+            "username": username,
+            "name": name,
+            "email": email,
+        }
+    )
+    
+    return {"access_token": access_token, "token_type": "bearer"}
+async def github_callback(request: Request, db: AsyncSession = Depends(get_db)):
     user_data = await auth.social_callback("github", request)
 
     # Find or create user in DB
-    user = db.query(auth_db.User).filter_by(oauth_provider="github", oauth_id=user_data["id"]).first()
+    result = await db.execute(select(auth_db.User).filter_by(oauth_provider="github", oauth_id=user_data["id"]))
+    user = result.scalars().first()
     if not user:
         user = auth_db.User(
             username=user_data["login"],
@@ -188,8 +245,8 @@ async def github_callback(request: Request, db: Session = Depends(get_db)):
             oauth_id=user_data["id"],
         )
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
 
     token = auth.create_token(
         subject=str(user.id),
@@ -0,0 +1,208 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+import casbin
+
+# Casbin for every request, without running the matcher for every
+# request. Decisions are kept per (subject, object, action) until the
+# policy changes, either through the enforcer (add_policy() and the
+# rest) or because the file did: that's checked at most every
+# DAYZER_POLICY_CHECK seconds (1), and a changed file gets loaded on a
+# thread of its own, without anyone restarting anything or any request
+# waiting for it. Until it's in, the old policy stands.
+#
+# With the plain RBAC model in casbin_model.conf there's no need for
+# casbin's matcher at all, which goes through every p line for every
+# check: the policy gets compiled to a set of (subject, object, action)
+# and a map of who's in which role, and a check is a few set lookups.
+# Any other model gets casbin's own enforce() behind the cache.
+#
+# It's an Enforcer, so it goes wherever one does, CasbinMiddleware
+# included.
+
+_CHECK = float(os.environ.get('DAYZER_POLICY_CHECK') or 1)
+
+# Decisions kept. Subjects times objects grows with the user base, so
+# the least recently used go once there's this many.
+_DECISIONS = 100000
+
+# The model compile() knows how to do without casbin, as casbin has
+# it once it's loaded, spaces aside.
+_MATCHER = 'g(r_sub,p_sub)&&r_obj==p_obj&&r_act==p_act'
+_EFFECT = 'some(where(p_eft==allow))'
+
+# How deep roles go, the same as casbin's role manager.
+_HIERARCHY = 10
+
+_stats = {'hits': 0, 'misses': 0, 'reloads': 0}
+
+
+class CachedEnforcer(casbin.Enforcer):
+    def __init__(self, model=None, adapter=None, *args, **kwargs):
+        self.decisions = OrderedDict()
+        self.compiled = None
+        self.generation = 0
+        self.decision_lock = threading.Lock()
+        self.policy_path = adapter if isinstance(adapter, str) else None
+        self.policy_mtime = self._mtime()
+        self.next_check = time.monotonic() + _CHECK
+        self.reloading = False
+        super().__init__(model, adapter, *args, **kwargs)
+
+    def _mtime(self):
+        try:
+            return os.stat(self.policy_path).st_mtime_ns if self.policy_path else None
+        except OSError:
+            return None
+
+    def forget(self):
+        # The policy's changed: nothing we worked out still holds.
+        with self.decision_lock:
+            self.decisions.clear()
+            self.generation += 1
+        self.compiled = self.compile()
+
+    def compile(self):
+        # (allowed, roles) for the model we know, None for anything else.
+        try:
+            if self.model['m']['m'].value.replace(' ', '') != _MATCHER or self.model['e']['e'].value.replace(' ', '') != _EFFECT:
+                return None
+            if self.model['p']['p'].tokens != ['p_sub', 'p_obj', 'p_act']:
+                return None
+            p_list = self.model['p']['p'].policy
+            g_list = self.model['g']['g'].policy if 'g' in self.model.keys() and 'g' in self.model['g'] else []
+        except (KeyError, AttributeError):
+            return None
+
+        if any(len(rule) != 2 for rule in g_list):
+            # Roles with domains.
+            return None
+
+        roles = {}
+        for member, role in g_list:
+            roles.setdefault(member, []).append(role)
+        return ({tuple(rule) for rule in p_list}, roles)
+
+    def decide(self, sub, obj, act):
+        # g(r.sub, p.sub): the subject itself or any role it has, however
+        # it got it.
+        allowed, roles = self.compiled
+        seen = {sub}
+        level = [sub]
+        for depth in range(_HIERARCHY + 1):
+            for subject in level:
+                if (subject, obj, act) in allowed:
+                    return True
+            level = [role for subject in level for role in roles.get(subject, ()) if role not in seen]
+            seen.update(level)
+            if not level:
+                break
+        return False
+
+    def changed(self):
+        mtime = self._mtime()
+        return mtime is not None and mtime != self.policy_mtime
+
+    def reload(self):
+        # Only if the file's changed since we last read it.
+        try:
+            mtime = self._mtime()
+            if mtime is None or mtime == self.policy_mtime:
+                return False
+
+            self.policy_mtime = mtime
+            self.load_policy()
+        except Exception as ex:
+            # Half written, most likely. What we had still stands.
+            logging.warning(f"Couldn't reload {self.policy_path}: {ex}")
+            self.policy_mtime = None
+            return False
+        finally:
+            self.reloading = False
+
+        _stats['reloads'] += 1
+        logging.info(f"Reloaded {self.policy_path}")
+        return True
+
+    def load_policy(self):
+        super().load_policy()
+        self.forget()
+
+    def enforce(self, *rvals):
+        if time.monotonic() >= self.next_check:
+            self.next_check = time.monotonic() + _CHECK
+            if not self.reloading and self.changed():
+                self.reloading = True
+                threading.Thread(target=self.reload, name='acl-reload', daemon=True).start()
+
+        key = rvals
+        try:
+            hash(key)
+        except TypeError:
+            # ABAC style requests with objects in them can't be keys.
+            return super().enforce(*rvals)
+
+        with self.decision_lock:
+            decision = self.decisions.get(key)
+            if decision is not None:
+                self.decisions.move_to_end(key)
+                _stats['hits'] += 1
+                return decision
+            generation = self.generation
+
+        _stats['misses'] += 1
+        if self.compiled and len(rvals) == 3 and all(isinstance(value, str) for value in rvals):
+            decision = self.decide(*rvals)
+        else:
+            decision = super().enforce(*rvals)
+        with self.decision_lock:
+            # Not if the policy changed while we were working it out.
+            if generation != self.generation:
+                return decision
+            self.decisions[key] = decision
+            while len(self.decisions) > _DECISIONS:
+                self.decisions.popitem(last=False)
+        return decision
+
+    # Everything that changes the policy in memory goes through one of
+    # these, for p and g lines alike.
+    def _add_policy(self, *args, **kwargs):
+        result = super()._add_policy(*args, **kwargs)
+        self.forget()
+        return result
+
+    def _add_policies(self, *args, **kwargs):
+        result = super()._add_policies(*args, **kwargs)
+        self.forget()
+        return result
+
+    def _remove_policy(self, *args, **kwargs):
+        result = super()._remove_policy(*args, **kwargs)
+        self.forget()
+        return result
+
+    def _remove_policies(self, *args, **kwargs):
+        result = super()._remove_policies(*args, **kwargs)
+        self.forget()
+        return result
+
+    def _remove_filtered_policy(self, *args, **kwargs):
+        result = super()._remove_filtered_policy(*args, **kwargs)
+        self.forget()
+        return result
+
+    def _update_policy(self, *args, **kwargs):
+        result = super()._update_policy(*args, **kwargs)
+        self.forget()
+        return result
+
+    def _update_policies(self, *args, **kwargs):
+        result = super()._update_policies(*args, **kwargs)
+        self.forget()
+        return result
+
+
+def stats():
+    return dict(_stats)
@@ -1,75 +1,301 @@
 #!/usr/bin/env python
 import os
+import math
 import uvicorn
 import argparse
 import logging
 import httpx
 from datetime import datetime, timedelta
-from litellm import completion
+from litellm import acompletion, provider_list
+from openai import AsyncOpenAI
 from fastapi import FastAPI, Depends, Request, HTTPException, status
-from fastapi.responses import JSONResponse, StreamingResponse, RedirectResponse
+from fastapi.responses import Response, JSONResponse, StreamingResponse, RedirectResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi_authz import CasbinMiddleware
+from starlette.middleware.authentication import AuthenticationMiddleware
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from authx import AuthX, AuthXConfig, RequestToken
 import auth_db as auth_db
 from contextlib import asynccontextmanager
 from toolcalls import toolList
+import sse
+import capture
+import history
+import inject
+import tokens
+import cache
+import coalesce
+import router
+import ratelimit
+import clients
+import credentials
+import account
+import acl
+
+# DAYZER_PASSTHROUGH forwards streamed completions byte for byte instead
+# of having litellm decode every chunk just for us to encode it again.
+# The upstream has to speak the OpenAI protocol for that to work.
+PASSTHROUGH = os.environ.get("DAYZER_PASSTHROUGH") not in (None, "", "0")
+
+# DAYZER_INJECT puts memories from the caller's own earlier
+# conversations into the request, as many as fit in the model's budget
+# (see inject.py). Off unless it's set.
+INJECT = os.environ.get("DAYZER_INJECT") not in (None, "", "0")
 
 
 # Initialize DB tables on startup
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # before load
-    auth_db.init_db()
+    await auth_db.ainit_db()
+    # Outgoing HTTP, upstreams and OAuth alike, see clients.py.
+    clients.registry()
     yield
     # after
+    await clients.close()
+    await auth_db.async_engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 
-# Dependency to get DB session
-def get_db():
-    db = auth_db.SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Dependency to get DB session. Async, so a slow lookup only holds up
+# the request that made it.
+get_db = auth_db.get_db
 
 
-def completion_caller(request, body):
+async def prepare(request, body, record):
     api_key = request.headers.get("API_KEY") # get it from the header
     model = body['model']
 
-    body['messages'] = Dayzer.history_process(api_key, body['messages'])
-    user_api_key = Dayzer.get_api_key(caller_key=api_key, model=model)
-    tools += toolList #Dayzer.add_tools(body)
+    if INJECT:
+        body['messages'] = await inject.ainject(
+            body['messages'], model, body.get('max_tokens') or body.get('max_completion_tokens'),
+            filters={'meta.user': history.user_key(api_key)}
+        )
+    body['tools'] = (body.get('tools') or []) + toolList
+    return record['upstream_key']
+
+def upstream_api_key(upstream, user_api_key):
+    # What to send this upstream for this caller. Without one, that
+    # upstream's no good to them: it's not our key to lend, see
+    # router.Upstream.api_key(). The router moves on to the next.
+    upstream_key = upstream.api_key(user_api_key)
+    if not upstream_key:
+        raise router.Failed(401, b'{"error": "no upstream key for this caller"}')
+    return upstream_key
+
+# Everything on the way to the upstream has to be awaitable. A blocking
+# call in here holds up every other request on the event loop, not just
+# the one that made it.
+#
+# Both callers go through router.py, which picks the upstream and moves
+# on to the next one if it fails. Streams are only handed back once
+# their first chunk is in, so that's still before the client sees any.
+async def completion_caller(body, user_api_key):
+    stream = body.get('stream') or False
+    # Everything else in the request that changes what comes back goes
+    # up as well. The cache keys on the same fields, so what it keeps
+    # under a temperature 0 key really was asked for at temperature 0.
+    params = {field: body[field] for field in cache.KEYED + ('n', ) if field not in ('model', 'messages', 'tools') and body.get(field) is not None}
+
+    async def attempt(upstream, model):
+        upstream_key = upstream_api_key(upstream, user_api_key)
+        response = await acompletion(
+            base_url=upstream.url,
+            api_key=upstream_key,
+            # Over the upstream's shared connections, see clients.py.
+            # Left to itself litellm makes clients, and pools, of its own.
+            # The router does the retrying.
+            client=AsyncOpenAI(base_url=upstream.url, api_key=upstream_key, http_client=upstream.client(), timeout=clients.ROUTES['upstream']['timeout'], max_retries=0),
+            model=model,
+            messages=body["messages"],
+            tools=body['tools'],
+            stream=stream,
+            **params
+        )
+        if not stream:
+            return (response, response)
+        try:
+            return (response, await router.peek(response))
+        except BaseException:
+            await response.aclose()
+            raise
+
+    async def discard(result):
+        # A hedge that answered but lost. A stream's still open on its
+        # upstream; a whole reply has nothing left to let go of.
+        if stream:
+            await result[0].aclose()
+
+    upstream, result = await router.route(body, attempt, discard)
+    return result[1]
+
+def upstream_model(model):
+    # The model as litellm sends it: 'openai/gpt-4o' goes up as
+    # 'gpt-4o', 'openrouter/openai/gpt-4o' as 'openai/gpt-4o'. Only a
+    # provider litellm knows comes off, 'meta-llama/...' stays as it is.
+    provider, _, rest = (model or '').partition('/')
+    return rest if rest and provider in provider_list else model
+
+async def passthrough_caller(body, user_api_key):
+    # The routing fields are ours, the upstream just gets the one model.
+    upstream_body = {key: value for key, value in body.items() if key != 'models'}
+
+    async def attempt(upstream, model):
+        response = await upstream.client().send(upstream.client().build_request(
+            "POST", "chat/completions",
+            json=dict(upstream_body, model=upstream_model(model)),
+            # identity so the raw bytes are plain SSE, for us and the client
+            headers={"Authorization": f"Bearer {upstream_api_key(upstream, user_api_key)}", "Accept-Encoding": "identity"}
+        ), stream=True)
+
+        try:
+            if response.status_code in router.RETRY:
+                retry_after = response.headers.get("retry-after")
+                raise router.Failed(response.status_code, await response.aread(), int(retry_after) if (retry_after or '').isdigit() else None)
+            return (response, await router.peek(response.aiter_raw()))
+        except BaseException:
+            await response.aclose()
+            raise
+
+    async def discard(result):
+        await result[0].aclose()
+
+    upstream, result = await router.route(body, attempt, discard)
+    return result
+
+def capture_meta(request, body):
+    # What we know about a completion when it comes in, per
+    # docs/conversational.md: date, user and the tool (from the header).
+    meta = {
+        'user': history.user_key(request.headers.get("API_KEY")),
+        'tool': request.headers.get("User-Agent"),
+        'model': body.get('model'),
+        'date': datetime.now().timestamp()
+    }
+    if meta['user'] is None and request.client:
+        # Keeps callers without a key apart, see history.seed(). Hashed
+        # the same way keys are, the address itself isn't kept.
+        meta['client'] = history.user_key(request.client.host)
+    return meta
+
+def reply_tokens(usage, message):
+    # What the reply cost, by the upstream's count if it gave one.
+    return (usage or {}).get('completion_tokens') or (tokens.message(message) if message else 0)
 
-    response = completion(
-        base_url="http://localhost:8080/",
-        api_key=user_api_key,
-        model=model,
-        messages=body["messages"],
-        tools=tools,
-        stream=body.get('stream') or False
-    )
-    return response
+def stream_finished(messages, meta, cache_key=None, ticket=None):
+    # Called once the upstream has sent its last byte, with what
+    # the assistant said put back together off the stream.
+    def on_done(accumulator):
+        if accumulator.done or accumulator.finish_reason:
+            capture.submit(messages, accumulator.message(), meta)
+            cache.store(cache_key, cache.completion(accumulator))
+            if ticket:
+                ticket.charge(reply_tokens(accumulator.usage, accumulator.message()), (accumulator.usage or {}).get('prompt_tokens'))
+    return on_done
 
 @app.post("/v1/chat/completions")
 async def chat_completions_proxy(request: Request):
     body = await request.json()
     api_key = os.environ.get("OPENROUTER_API_KEY")
+    stream = body.get('stream') or False
+    # As the client sent them, before anything gets added on the way up.
+    messages = list(body.get('messages') or [])
+    meta = capture_meta(request, body)
+
+    # Only callers with a key on record, see credentials.py, and before
+    # anything else gets done for them. Missing, unknown and revoked
+    # keys all look the same from here.
+    record = await credentials.alookup_key(request.headers.get("API_KEY")) if request.headers.get("API_KEY") else None
+    if record is None:
+        return JSONResponse(
+            {"error": {"message": "invalid API key", "type": "invalid_api_key"}},
+            status_code=401
+        )
+
+    # Per key limits, by the key that was just checked, see ratelimit.py.
+    # Whatever admits the request has to let go of it again: streams when
+    # they end, everything else on the way out of here.
+    try:
+        ticket = await ratelimit.admit(request.headers.get("API_KEY"), body, record['team'])
+    except ratelimit.Limited as e:
+        return JSONResponse(
+            {"error": {"message": str(e), "type": "rate_limit_exceeded"}},
+            status_code=429,
+            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+        )
+    held = False
 
     try:
-        response = completion_caller(request, body)
+        user_api_key = await prepare(request, body, record)
+
+        # Opt-in, and only for deterministic requests, see cache.py.
+        cache_key = cache.lookup_key(body)
+        if cache_key:
+            hit = await cache.cache().get(cache_key)
+            if hit:
+                capture.submit(messages, (hit.get('choices') or [{}])[0].get('message'), meta)
+                if stream:
+                    return StreamingResponse(cache.replay(hit), media_type="text/event-stream")
+                return JSONResponse(hit)
 
+        # Identical requests in flight at the same time share one
+        # upstream call, see coalesce.py.
+        flight_key = coalesce.key(body, user_api_key)
+
+        # The upstream call is shared, everything after it isn't: each
+        # caller that joined gets the reply stored under their own meta
+        # and charged to their own ticket.
         if not stream:
-            return JSONResponse(response.json())
-        
-        def generate():
-            for chunk in response: 
-                yield f"data:{chunk.model_dump_json()}\n\n"
+            async def complete():
+                response = await completion_caller(body, user_api_key)
+                result = response.json()
+                if cache_key:
+                    await cache.cache().put(cache_key, result)
+                return result
+
+            result = await coalesce.call(flight_key, complete)
+            reply = (result.get('choices') or [{}])[0].get('message')
+            capture.submit(messages, reply, meta)
+            if ticket:
+                ticket.charge(reply_tokens(result.get('usage'), reply), (result.get('usage') or {}).get('prompt_tokens'))
+            return JSONResponse(result)
 
-        return StreamingResponse(generate(), media_type="text/event-stream")
+        async def passthrough():
+            response, chunk_iter = await passthrough_caller(body, user_api_key)
+            return (
+                response.status_code,
+                response.headers.get("content-type", "text/event-stream"),
+                chunk_iter,
+                response.aclose
+            )
+
+        async def relay():
+            response = await completion_caller(body, user_api_key)
+
+            async def generate():
+                async for chunk in response: 
+                    yield f"data:{chunk.model_dump_json()}\n\n"
+
+            return (200, "text/event-stream", generate(), None)
+
+        status_code, media_type, chunk_iter = await coalesce.stream(flight_key, passthrough if PASSTHROUGH else relay)
+        if status_code < 400:
+            chunk_iter = sse.tee(chunk_iter, stream_finished(messages, meta, cache_key, ticket))
+        if ticket:
+            chunk_iter = ticket.hold(chunk_iter)
+            held = True
+        return StreamingResponse(chunk_iter, status_code=status_code, media_type=media_type)
+
+    except router.Failed as e:
+        # Every upstream turned it down. The client gets the last one's
+        # answer, so a 429 is still a 429 it can back off from.
+        return Response(
+            e.body,
+            status_code=e.status_code,
+            media_type="application/json",
+            headers={"Retry-After": str(e.retry_after)} if e.retry_after else None
+        )
 
     except Exception as e:
         return JSONResponse(
@@ -77,6 +303,25 @@ async def chat_completions_proxy(request: Request):
             status_code=500
         )
 
+    finally:
+        if ticket and not held:
+            ticket.release()
+
+@app.get("/stats")
+async def stats():
+    return {"cache": cache.stats(), "coalesce": coalesce.stats(), "router": router.stats(), "clients": clients.stats(), "ratelimit": ratelimit.stats(), "capture": capture.stats(), "acl": acl.stats()}
+
+# The account routes (login, the OAuth callback and the rest), checked
+# by casbin against account.enforcer, see acl.py. Who's asking is the
+# sub of their bearer token, or 'anonymous'. The proxy's own routes
+# above answer to API_KEY instead and don't go through it. Mounted
+# last, it gets whatever they don't match.
+accounts = FastAPI()
+accounts.include_router(account.app)
+accounts.add_middleware(CasbinMiddleware, enforcer=account.enforcer)
+accounts.add_middleware(AuthenticationMiddleware, backend=account.Bearer())
+app.mount("/", accounts)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
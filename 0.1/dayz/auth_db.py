@@ -1,12 +1,44 @@
 # db.py
-from sqlalchemy import create_engine, Column, Integer, String
+import os
+from sqlalchemy import create_engine, Column, Integer, String, Boolean
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
-DATABASE_URL = "sqlite:///./auth.db"
+# AUTH_DATABASE_URL points somewhere else, postgresql://... included.
+# The routes use the async engine so a lookup doesn't hold up the event
+# loop, and every stream on it, while it waits on the database; the
+# sync one is left for scripts and init.
+#
+#   AUTH_DB_POOL_SIZE      connections kept open (5)
+#   AUTH_DB_MAX_OVERFLOW   more than that when busy (10)
+#   AUTH_DB_POOL_TIMEOUT   seconds to wait for one (30)
+DATABASE_URL = os.environ.get("AUTH_DATABASE_URL") or "sqlite:///./auth.db"
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+def async_url(url):
+    # The same database through a driver that doesn't block.
+    for sync, nonblocking in (("sqlite://", "sqlite+aiosqlite://"), ("postgresql://", "postgresql+asyncpg://"), ("postgres://", "postgresql+asyncpg://")):
+        if url.startswith(sync):
+            return nonblocking + url[len(sync):]
+    return url
+
+def pool_options(url):
+    if url.startswith("sqlite"):
+        # A file: the pool's per connection and there's no server to
+        # run out of connections on.
+        return {"connect_args": {"check_same_thread": False}}
+    return {
+        "pool_size": int(os.environ.get("AUTH_DB_POOL_SIZE") or 5),
+        "max_overflow": int(os.environ.get("AUTH_DB_MAX_OVERFLOW") or 10),
+        "pool_timeout": float(os.environ.get("AUTH_DB_POOL_TIMEOUT") or 30),
+        "pool_pre_ping": True,
+    }
+
+engine = create_engine(DATABASE_URL, **pool_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(async_url(DATABASE_URL), **pool_options(DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 class User(Base):
@@ -19,5 +51,24 @@ class User(Base):
     oauth_provider = Column(String, nullable=True)    # e.g., 'github', 'google'
     oauth_id = Column(String, unique=True, index=True, nullable=True)  # provider user id
 
+class ApiKey(Base):
+    __tablename__ = "api_keys"
+
+    id = Column(Integer, primary_key=True, index=True)
+    key_hash = Column(String, unique=True, index=True, nullable=False)  # sha256 of the key, never the key
+    user_id = Column(Integer, index=True, nullable=False)
+    team = Column(String, nullable=True)
+    upstream_key = Column(String, nullable=True)      # what goes to the upstream for this key
+    revoked = Column(Boolean, default=False, nullable=False)
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+
+async def ainit_db():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+# FastAPI dependency
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
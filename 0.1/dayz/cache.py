@@ -0,0 +1,264 @@
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Exact match response cache for completions that are supposed to come
+# out the same every time: temperature 0, one choice. Off unless
+# DAYZER_CACHE says where the shared tier lives:
+#
+#   DAYZER_CACHE=memory          just the in-process LRU
+#   DAYZER_CACHE=sqlite          plus a sqlite file shared by every worker
+#                                on the box (DAYZER_CACHE_DB, next to the db)
+#   DAYZER_CACHE=redis://host    plus redis, like ref/app.py uses
+#
+#   DAYZER_CACHE_TTL             seconds an entry lives (86400)
+#   DAYZER_CACHE_ENTRIES         how many the LRU holds (1000)
+#   DAYZER_CACHE_MB              how big the sqlite tier gets (256)
+#
+# What's stored is the completion in its non-streamed shape, so a hit
+# can go out either way, streamed ones as SSE (see replay()).
+
+# Everything in a request that changes what comes back. Anything not
+# in here (stream, user, metadata ...) doesn't make it a different
+# request.
+KEYED = ('model', 'messages', 'tools', 'tool_choice', 'temperature', 'seed', 'top_p', 'max_tokens', 'max_completion_tokens', 'stop', 'response_format', 'frequency_penalty', 'presence_penalty', 'logit_bias')
+
+_stats = {'hits': 0, 'memory_hits': 0, 'shared_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'skipped': 0}
+
+
+def cacheable(body):
+    # Only what's deterministic. A sampled completion coming back the
+    # same twice would be a bug, not a feature.
+    return body.get('temperature') == 0 and (body.get('n') or 1) == 1
+
+def key(body):
+    fields = {field: body[field] for field in KEYED if body.get(field) is not None}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class MemoryTier:
+    # An LRU of key -> (expires, value), bounded by entry count.
+    def __init__(self, entries, ttl):
+        self.entries = entries
+        self.ttl = ttl
+        self.store = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.store.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self.store[key]
+                _stats['evictions'] += 1
+                return None
+            self.store.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.store[key] = (time.time() + self.ttl, value)
+            self.store.move_to_end(key)
+            while len(self.store) > self.entries:
+                self.store.popitem(last=False)
+                _stats['evictions'] += 1
+
+
+class SqliteTier:
+    """
+    One table in its own file, so it doesn't compete with object-db for
+    the writer. Entries expire after ttl and once the values add up to
+    more than max_bytes the ones closest to expiring go first.
+    """
+    def __init__(self, path, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self.conn.execute('pragma journal_mode = wal')
+        self.conn.execute('create table if not exists cache(key text primary key, value blob, expires real, size integer)')
+        self.conn.execute('create index if not exists cache_expires_idx on cache(expires)')
+        self.conn.commit()
+        # Kept as we go rather than added up on every write. Other
+        # processes writing to the same file make it an underestimate,
+        # which the next _evict() puts right.
+        self.total = self.conn.execute('select coalesce(sum(size), 0) from cache').fetchone()[0]
+        self.last_evict = time.time()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute('select value from cache where key = ? and expires > ?', (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, value):
+        with self.lock:
+            # A key that's already there is replaced, its old size with it.
+            row = self.conn.execute('select size from cache where key = ?', (key, )).fetchone()
+            self.conn.execute('insert or replace into cache(key, value, expires, size) values(?, ?, ?, ?)', (key, value, time.time() + self.ttl, len(value)))
+            self.total += len(value) - (row[0] if row else 0)
+            if self.total > self.max_bytes or time.time() - self.last_evict > 60:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        self.last_evict = time.time()
+        res = self.conn.execute('delete from cache where expires <= ?', (time.time(), ))
+        _stats['evictions'] += res.rowcount
+
+        total = self.conn.execute('select coalesce(sum(size), 0) from cache').fetchone()[0]
+        self.total = total
+        if total > self.max_bytes:
+            # Down to 90% so this isn't back again on the next write.
+            over = total - int(self.max_bytes * 0.9)
+            doomed = []
+            for key, size in self.conn.execute('select key, size from cache order by expires'):
+                if over <= 0:
+                    break
+                doomed.append((key, ))
+                over -= size
+            self.conn.executemany('delete from cache where key = ?', doomed)
+            _stats['evictions'] += len(doomed)
+            # over is how far under the target we ended up, if at all.
+            self.total = int(self.max_bytes * 0.9) + over
+
+
+class RedisTier:
+    # Redis does the ttl itself, and size is its maxmemory policy's job.
+    def __init__(self, url, ttl):
+        from redis.asyncio import Redis
+        self.redis = Redis.from_url(url)
+        self.ttl = ttl
+
+    async def get(self, key):
+        return await self.redis.get(f"dayzer:cache:{key}")
+
+    async def put(self, key, value):
+        await self.redis.set(f"dayzer:cache:{key}", value, ex=self.ttl)
+
+
+class Cache:
+    def __init__(self, shared=None, entries=1000, ttl=86400, max_bytes=256 << 20):
+        self.memory = MemoryTier(entries, ttl)
+        self.shared = None
+
+        if shared and shared.startswith('redis'):
+            self.shared = RedisTier(shared, ttl)
+        elif shared == 'sqlite':
+            path = os.environ.get('DAYZER_CACHE_DB') or re.sub(r'\.db$', '', os.environ.get('DB') or 'config.db') + '.cache.db'
+            self.shared = SqliteTier(path, ttl, max_bytes)
+
+    async def _shared(self, method, *args):
+        if isinstance(self.shared, RedisTier):
+            return await getattr(self.shared, method)(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, getattr(self.shared, method), *args)
+
+    async def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            _stats['hits'] += 1
+            _stats['memory_hits'] += 1
+            return value
+
+        if self.shared:
+            try:
+                raw = await self._shared('get', key)
+            except Exception as ex:
+                logging.warning(f"Cache lookup failed: {ex}")
+                raw = None
+
+            if raw is not None:
+                value = json.loads(raw)
+                self.memory.put(key, value)
+                _stats['hits'] += 1
+                _stats['shared_hits'] += 1
+                return value
+
+        _stats['misses'] += 1
+        return None
+
+    async def put(self, key, value):
+        self.memory.put(key, value)
+        _stats['stores'] += 1
+        if self.shared:
+            try:
+                await self._shared('put', key, json.dumps(value))
+            except Exception as ex:
+                logging.warning(f"Cache store failed: {ex}")
+
+
+def completion(accumulator):
+    # A finished stream in the shape of a non-streamed completion.
+    return {
+        'id': accumulator.id,
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': accumulator.model,
+        'choices': [{'index': 0, 'message': accumulator.message(), 'finish_reason': accumulator.finish_reason}],
+        'usage': accumulator.usage,
+    }
+
+async def replay(result):
+    # A cached completion as the chunks a stream of it would have had:
+    # the message, then the finish, then [DONE].
+    choice = (result.get('choices') or [{}])[0]
+    message = choice.get('message') or {}
+    base = {'id': result.get('id'), 'object': 'chat.completion.chunk', 'created': result.get('created'), 'model': result.get('model')}
+
+    delta = {'role': message.get('role') or 'assistant', 'content': message.get('content')}
+    if message.get('tool_calls'):
+        delta['tool_calls'] = [dict(call, index=ix) for ix, call in enumerate(message['tool_calls'])]
+
+    yield f"data: {json.dumps(dict(base, choices=[{'index': 0, 'delta': delta, 'finish_reason': None}]))}\n\n"
+    finish = dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': choice.get('finish_reason') or 'stop'}])
+    if result.get('usage'):
+        finish['usage'] = result['usage']
+    yield f"data: {json.dumps(finish)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+_cache = None
+
+# Stores still on their way to the shared tier. The loop only keeps
+# weak references to tasks.
+_pending = set()
+
+def cache():
+    # The one Cache per process, or None when caching is off.
+    global _cache
+    shared = os.environ.get('DAYZER_CACHE')
+    if _cache is None and shared:
+        _cache = Cache(
+            None if shared == 'memory' else shared,
+            int(os.environ.get('DAYZER_CACHE_ENTRIES') or 1000),
+            int(os.environ.get('DAYZER_CACHE_TTL') or 86400),
+            int(os.environ.get('DAYZER_CACHE_MB') or 256) << 20
+        )
+    return _cache
+
+def lookup_key(body):
+    # The key for this request if it can be cached, None otherwise.
+    if cache() is None:
+        return None
+    if not cacheable(body):
+        _stats['skipped'] += 1
+        return None
+    return key(body)
+
+def store(cache_key, value):
+    # For the end of a stream, which isn't async: the memory tier has it
+    # right away and the shared tier a moment later.
+    if cache_key and cache() and value:
+        task = asyncio.get_running_loop().create_task(cache().put(cache_key, value))
+        _pending.add(task)
+        task.add_done_callback(_pending.discard)
+
+def stats():
+    return dict(_stats, entries=len(_cache.memory.store) if _cache else 0)
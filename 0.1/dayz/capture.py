@@ -0,0 +1,281 @@
+import os
+import re
+import json
+import time
+import queue
+import logging
+import threading
+import importlib
+import history
+import memory
+
+objectdb = importlib.import_module('object-db')
+
+# Proxy to store. The conversation as a request sent it, and again with
+# the reply on the end once there is one, gets handed to submit(), which
+# never waits on anything: it goes on a bounded queue and a writer
+# thread puts the new messages in object-db in batches. If the queue is
+# full, because the db is slow or gone, it's either dropped or spilled
+# to a jsonl file that the writer works back through once it catches up.
+#
+#   DAYZER_CAPTURE         set to 0 to turn capture off
+#   DAYZER_CAPTURE_QUEUE   how many completions can wait (1000)
+#   DAYZER_CAPTURE_POLICY  spill or drop when that's full (spill)
+#   DAYZER_CAPTURE_SPILL   the spill file, next to the db by default
+#
+# A batch that won't go in gets tried again one completion at a time,
+# so one that can't be stored doesn't take the rest down with it. What
+# still fails when others went in, or has been tried _ATTEMPTS times,
+# is set aside in <spill>.quarantine for someone to look at instead of
+# going round the spill file forever.
+
+_BATCH = 64
+
+# How long (seconds) the writer waits for a batch to fill before it
+# writes what it has.
+_LINGER = 0.05
+
+_ATTEMPTS = 5
+
+_stats = {'queued': 0, 'written': 0, 'dropped': 0, 'spilled': 0, 'replayed': 0, 'failed': 0, 'corrupt': 0, 'quarantined': 0, 'embedded': 0}
+
+
+class Capture:
+    def __init__(self, maxsize=1000, policy='spill', spill=None):
+        self.queue = queue.Queue(maxsize)
+        self.policy = policy
+        self.spill_path = spill
+        self.spill_lock = threading.Lock()
+        self.spill_file = None
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='capture', daemon=True)
+            self.thread.start()
+        return self
+
+    def submit(self, messages, reply=None, meta={}):
+        # Safe to call from the event loop, it doesn't block.
+        messages = list(messages or []) + ([reply] if reply else [])
+        if not messages:
+            return
+
+        item = {'messages': messages, 'meta': dict(meta, date=meta.get('date') or time.time())}
+
+        try:
+            self.queue.put_nowait(item)
+            _stats['queued'] += 1
+
+        except queue.Full:
+            if self.policy == 'spill' and self.spill_path:
+                self._spill([item])
+            else:
+                _stats['dropped'] += 1
+                logging.warning("Capture queue is full, dropping a completion")
+
+    def _spill(self, item_list):
+        if not item_list:
+            return
+        try:
+            with self.spill_lock:
+                # Kept open between spills, line buffered so the writer
+                # thread sees every line that's been written.
+                if self.spill_file is None:
+                    self.spill_file = open(self.spill_path, 'a', buffering=1)
+                for item in item_list:
+                    self.spill_file.write(json.dumps(item) + '\n')
+            _stats['spilled'] += len(item_list)
+
+        except Exception as ex:
+            _stats['dropped'] += len(item_list)
+            logging.warning(f"Can't spill {len(item_list)} completions to {self.spill_path}, dropping them: {ex}")
+
+    def _run(self):
+        while True:
+            item_list = [self.queue.get()]
+            deadline = time.time() + _LINGER
+            while len(item_list) < _BATCH:
+                try:
+                    item_list.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+
+            # Nothing that goes wrong with one batch gets to end the
+            # thread, or everything after it would spill forever.
+            try:
+                self._write(item_list)
+            except Exception as ex:
+                logging.exception(f"Capture writer failed on {len(item_list)} completions ({ex})")
+            finally:
+                for _ in item_list:
+                    self.queue.task_done()
+
+            if self.queue.empty():
+                try:
+                    self._replay()
+                except Exception as ex:
+                    logging.exception(f"Capture replay of {self.spill_path} failed ({ex})")
+
+    def _write(self, item_list):
+        """
+        True if the batch has been dealt with, written or quarantined.
+        False if what's left of it had to go in the spill file (or was
+        dropped) because the db looks to be the problem.
+        """
+        try:
+            write(item_list)
+            _stats['written'] += len(item_list)
+            return True
+
+        except Exception as ex:
+            logging.warning(f"Unable to store {len(item_list)} completions ({ex})")
+            failed_list = item_list
+
+        if len(item_list) > 1:
+            failed_list = []
+            for item in item_list:
+                try:
+                    write([item])
+                    _stats['written'] += 1
+                except Exception as ex:
+                    logging.warning(f"Unable to store a completion on its own ({ex})")
+                    failed_list.append(item)
+
+        if not failed_list:
+            return True
+
+        # If anything else went in, it's these that are wrong, not the db.
+        bad = len(failed_list) < len(item_list)
+        _stats['failed'] += len(failed_list)
+        retry_list = []
+        for item in failed_list:
+            item['attempts'] = item.get('attempts', 0) + 1
+            if bad or item['attempts'] >= _ATTEMPTS:
+                self._quarantine(item)
+            else:
+                retry_list.append(item)
+
+        if not retry_list:
+            return True
+        if self.policy == 'spill' and self.spill_path:
+            self._spill(retry_list)
+        else:
+            _stats['dropped'] += len(retry_list)
+        return False
+
+    def _quarantine(self, item):
+        _stats['quarantined'] += 1
+        if not self.spill_path:
+            _stats['dropped'] += 1
+            return
+        try:
+            with self.spill_lock:
+                with open(f"{self.spill_path}.quarantine", 'a') as f:
+                    f.write(json.dumps(item) + '\n')
+            logging.warning(f"Set a completion aside in {self.spill_path}.quarantine after {item['attempts']} tries")
+        except Exception as ex:
+            _stats['dropped'] += 1
+            logging.warning(f"Can't quarantine a completion, dropping it: {ex}")
+
+    def _replay(self):
+        # Catch up on the spill file now that there's nothing waiting.
+        # It's moved aside first so anything spilled in the meantime
+        # goes into a fresh one.
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+
+        replaying = f"{self.spill_path}.replay"
+        with self.spill_lock:
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+            if not os.path.exists(replaying):
+                os.rename(self.spill_path, replaying)
+
+        item_list = []
+        with open(replaying) as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    item_list.append(json.loads(line))
+                except ValueError:
+                    # Most likely the last line, cut short by a crash
+                    # halfway through writing it.
+                    _stats['corrupt'] += 1
+                    logging.warning(f"Skipping line {number} of {replaying}, it isn't json")
+
+        for start in range(0, len(item_list), _BATCH):
+            batch = item_list[start:start + _BATCH]
+            if self._write(batch):
+                _stats['replayed'] += len(batch)
+            else:
+                # Spilled again, the db's still not right. Leave the rest
+                # for later too.
+                self._spill(item_list[start + _BATCH:])
+                break
+
+        os.remove(replaying)
+
+    def _behind(self):
+        # unfinished_tasks counts what's been taken off the queue too,
+        # until it's been written.
+        if self.queue.unfinished_tasks:
+            return True
+        return bool(self.spill_path) and (os.path.exists(self.spill_path) or os.path.exists(f"{self.spill_path}.replay"))
+
+    def drain(self, timeout=5):
+        # Wait, for up to timeout seconds, for the queue and anything
+        # spilled to make it into the db.
+        deadline = time.time() + timeout
+        while self._behind() and time.time() < deadline:
+            time.sleep(0.01)
+
+
+def write(item_list):
+    # Only the messages we don't have yet get written, see history.py,
+    # all of the batch in one transaction. Raises if any of it didn't
+    # make it in.
+    added = []
+    stored = []
+    try:
+        with objectdb.transaction():
+            for item in item_list:
+                added += history.persist(item['messages'], item['meta'], stored)
+
+    except:
+        # None of those made it, so the cache can't say they did.
+        history.forget(added)
+        raise
+
+    # They're in, so they can be found by meaning too, see memory.py.
+    # The messages are safe whatever happens here, so it doesn't get to
+    # say the batch failed.
+    try:
+        _stats['embedded'] += memory.store_as_embedding(stored)
+    except Exception as ex:
+        logging.warning(f"Unable to embed {len(stored)} messages ({ex})")
+
+
+_capture = None
+
+def capture():
+    # The one Capture per process, started on first use.
+    global _capture
+    if _capture is None:
+        spill = os.environ.get('DAYZER_CAPTURE_SPILL') or re.sub(r'\.db$', '', os.environ.get('DB') or 'config.db') + '.capture.jsonl'
+        _capture = Capture(
+            int(os.environ.get('DAYZER_CAPTURE_QUEUE') or 1000),
+            os.environ.get('DAYZER_CAPTURE_POLICY') or 'spill',
+            spill
+        ).start()
+    return _capture
+
+def submit(messages, reply=None, meta={}):
+    if os.environ.get('DAYZER_CAPTURE') == '0':
+        return
+    capture().submit(messages, reply, meta)
+
+def stats():
+    return dict(_stats, waiting=_capture.queue.qsize() if _capture else 0)
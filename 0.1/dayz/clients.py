@@ -0,0 +1,146 @@
+import os
+import time
+import logging
+import httpx
+
+# Every outgoing HTTP call goes through a client from here, so they
+# share kept-alive connections instead of each one paying for a TCP and
+# TLS handshake, and none of them can hang forever. There's a client
+# per route and host: the route says how long to wait and how many
+# connections that kind of call can have, and the host gets its own
+# pool. HTTP/2 where the server does it, if h2 is installed.
+#
+# registry() and close() belong in the app's lifespan. Anything that
+# asks for a client before then still gets one, for scripts and the
+# benchmarks.
+#
+# The timeouts are connect, read (between bytes, not the whole thing),
+# write and waiting for a connection from the pool, in seconds.
+
+ROUTES = {
+    # A completion can think for a long while before its first token.
+    'upstream': {'timeout': httpx.Timeout(connect=10, read=300, write=30, pool=30), 'limits': httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=60)},
+    'oauth': {'timeout': httpx.Timeout(connect=5, read=10, write=10, pool=10), 'limits': httpx.Limits(max_connections=20, max_keepalive_connections=5, keepalive_expiry=30)},
+    'mcp': {'timeout': httpx.Timeout(connect=5, read=60, write=30, pool=10), 'limits': httpx.Limits(max_connections=50, max_keepalive_connections=10, keepalive_expiry=30)},
+}
+
+try:
+    import h2
+    _HTTP2 = os.environ.get('DAYZER_HTTP2') != '0'
+except ImportError:
+    logging.info("No h2, outgoing requests are HTTP/1.1")
+    _HTTP2 = False
+
+
+class _Counted(httpx.AsyncBaseTransport):
+    # How many requests are out on the pool right now, and the most
+    # there have been, by way of httpx's own transport interface: from
+    # sending until whoever has the response closes it. For HTTP/1.1
+    # that's the connections in use.
+    def __init__(self, transport, counts):
+        self.transport = transport
+        self.counts = counts
+
+    async def handle_async_request(self, request):
+        self.counts['in_flight'] += 1
+        self.counts['peak'] = max(self.counts['peak'], self.counts['in_flight'])
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self.counts['in_flight'] -= 1
+            raise
+        response.stream = _Closing(response.stream, self.counts)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+class _Closing(httpx.AsyncByteStream):
+    def __init__(self, stream, counts):
+        self.stream = stream
+        self.counts = counts
+        self.closed = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            self.counts['in_flight'] -= 1
+        await self.stream.aclose()
+
+
+class Registry:
+    def __init__(self):
+        self.clients = {}
+        self.counts = {}
+
+    def client(self, route, base_url=None):
+        key = (route, base_url)
+        client = self.clients.get(key)
+        if client is None or client.is_closed:
+            spec = ROUTES[route]
+            counts = self.counts.setdefault(key, {'requests': 0, 'responses': 0, 'server_errors': 0, 'wait': 0.0, 'in_flight': 0, 'peak': 0})
+
+            async def on_request(request):
+                counts['requests'] += 1
+                request.extensions['dayzer_started'] = time.perf_counter()
+
+            async def on_response(response):
+                counts['responses'] += 1
+                if response.status_code >= 500:
+                    counts['server_errors'] += 1
+                # Until the headers are in: connecting, or waiting for a
+                # connection, plus the server's think time.
+                started = response.request.extensions.get('dayzer_started')
+                if started:
+                    counts['wait'] += time.perf_counter() - started
+
+            client = httpx.AsyncClient(
+                base_url=base_url or '',
+                timeout=spec['timeout'],
+                transport=_Counted(httpx.AsyncHTTPTransport(limits=spec['limits'], http2=_HTTP2), counts),
+                event_hooks={'request': [on_request], 'response': [on_response]}
+            )
+            self.clients[key] = client
+        return client
+
+    def stats(self):
+        stat_map = {}
+        for (route, base_url), client in self.clients.items():
+            counts = self.counts[(route, base_url)]
+            # Ours, from the event hooks and _Counted: what the pool itself
+            # is up to is httpcore's business and it doesn't say. busy is
+            # how much of max_connections is in use.
+            limit = ROUTES[route]['limits'].max_connections
+            stat = dict(counts, wait=round(counts['wait'] / max(1, counts['responses']), 4), max=limit, busy=round(counts['in_flight'] / limit, 3))
+            stat_map[f"{route} {base_url}" if base_url else route] = stat
+        return stat_map
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
+
+
+_registry = None
+
+def registry():
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+    return _registry
+
+def client(route, base_url=None):
+    return registry().client(route, base_url)
+
+async def close():
+    global _registry
+    if _registry is not None:
+        await _registry.close()
+        _registry = None
+
+def stats():
+    return _registry.stats() if _registry else {}
@@ -0,0 +1,145 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+
+# Single flight. Identical requests that are in flight at the same time
+# share one upstream call. Whoever comes in first starts it, anyone
+# with the same request who shows up before it's finished joins in:
+# non-streamed callers all get the one result, streamed ones each get
+# the whole stream, what's gone by already replayed from the buffer and
+# the rest as it comes in.
+#
+# The upstream call runs on its own, not in any one caller's request,
+# so the first caller hanging up doesn't cut off the rest. It's only
+# cancelled once nobody's listening anymore. DAYZER_COALESCE=0 turns
+# all of this off.
+
+_ENABLED = os.environ.get('DAYZER_COALESCE') != '0'
+
+_flights = {}
+
+_stats = {'flights': 0, 'joined': 0}
+
+
+def key(body, upstream_key=None):
+    # Same request to the same upstream account. Everything in the body
+    # counts except the per-caller odds and ends.
+    fields = {field: value for field, value in body.items() if field not in ('user', 'metadata', 'stream_options')}
+    fields['upstream'] = hashlib.sha256((upstream_key or '').encode('utf-8')).hexdigest()
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')).hexdigest()
+
+
+class Flight:
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+        self.head = asyncio.get_running_loop().create_future()
+        self.listeners = 0
+        self.task = None
+
+    def _notify(self):
+        # Wake everyone waiting and give the next round a fresh event.
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def run(self, opener):
+        try:
+            status_code, media_type, chunk_iter, close = await opener()
+            self.head.set_result((status_code, media_type))
+            try:
+                async for chunk in chunk_iter:
+                    self.chunks.append(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+                    self._notify()
+            finally:
+                if close:
+                    await close()
+
+        except asyncio.CancelledError:
+            self.error = 'cancelled'
+            raise
+
+        except Exception as ex:
+            self.error = ex
+            if not self.head.done():
+                self.head.set_exception(ex)
+
+        finally:
+            self.done = True
+            _flights.pop(self.key, None)
+            self._notify()
+
+    def listen(self):
+        # Counted now rather than when the iterator first gets going, so
+        # one caller leaving can't cancel the flight out from under one
+        # that's still on its way to sending headers.
+        self.listeners += 1
+        return self._listen()
+
+    async def _listen(self):
+        # The whole stream from the start, however late we are.
+        try:
+            at = 0
+            while True:
+                while at < len(self.chunks):
+                    yield self.chunks[at]
+                    at += 1
+                if self.done:
+                    break
+                await self.changed.wait()
+
+            if isinstance(self.error, Exception):
+                logging.warning(f"Coalesced stream {self.key[:8]} broke off: {self.error}")
+
+        finally:
+            self.listeners -= 1
+            if self.listeners == 0 and not self.done and self.task:
+                self.task.cancel()
+
+
+async def stream(flight_key, opener):
+    """
+    opener is an async function that starts the upstream call and
+    returns (status_code, media_type, chunk async iterator, close or
+    None). It's only called if there's no flight for flight_key yet.
+    Returns (status_code, media_type, chunks) for this caller, chunks
+    being bytes.
+    """
+    flight = _flights.get(flight_key) if _ENABLED else None
+    if flight is None:
+        flight = Flight(flight_key)
+        if _ENABLED:
+            _flights[flight_key] = flight
+        flight.task = asyncio.get_running_loop().create_task(flight.run(opener))
+        _stats['flights'] += 1
+    else:
+        _stats['joined'] += 1
+
+    chunk_iter = flight.listen()
+    status_code, media_type = await asyncio.shield(flight.head)
+    return (status_code, media_type, chunk_iter)
+
+async def call(flight_key, fn):
+    # The non-streamed version: everyone gets whatever fn() returns, or
+    # raises, from the one call.
+    if not _ENABLED:
+        return await fn()
+
+    future = _flights.get(flight_key)
+    if future is None:
+        future = asyncio.ensure_future(fn())
+        _flights[flight_key] = future
+        future.add_done_callback(lambda done: _flights.pop(flight_key, None))
+        _stats['flights'] += 1
+    else:
+        _stats['joined'] += 1
+
+    # One caller going away shouldn't cancel it for the others.
+    return await asyncio.shield(future)
+
+def stats():
+    return dict(_stats, in_flight=len(_flights))
@@ -0,0 +1,161 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import jwt
+from sqlalchemy import select
+import auth_db
+
+# What we know about API keys, so a completion doesn't cost a trip to
+# auth_db: key hash -> (expires, {user, team, upstream_key}), or None
+# for keys that aren't any good, which are remembered for less long.
+# Revoking a key through here drops it right away; other workers see it
+# once their entry runs out.
+_KEY_TTL = 60
+_KEY_MISS_TTL = 10
+_KEY_SIZE = 10000
+_keys = OrderedDict()
+_keys_lock = threading.Lock()
+
+def _key_hash(caller_key):
+    return hashlib.sha256((caller_key or '').encode('utf-8')).hexdigest()
+
+def _cached_key(key_hash):
+    # (True, record) if we know about this key, (False, None) if not.
+    with _keys_lock:
+        item = _keys.get(key_hash)
+        if item and item[0] > time.time():
+            _keys.move_to_end(key_hash)
+            return (True, item[1])
+    return (False, None)
+
+def _remember_key(key_hash, row):
+    record = {'user': row.user_id, 'team': row.team, 'upstream_key': row.upstream_key} if row else None
+    with _keys_lock:
+        _keys[key_hash] = (time.time() + (_KEY_TTL if record else _KEY_MISS_TTL), record)
+        _keys.move_to_end(key_hash)
+        while len(_keys) > _KEY_SIZE:
+            _keys.popitem(last=False)
+    return record
+
+def lookup_key(caller_key):
+    key_hash = _key_hash(caller_key)
+    known, record = _cached_key(key_hash)
+    if known:
+        return record
+
+    db = auth_db.SessionLocal()
+    try:
+        return _remember_key(key_hash, db.query(auth_db.ApiKey).filter_by(key_hash=key_hash, revoked=False).first())
+    finally:
+        db.close()
+
+async def alookup_key(caller_key):
+    # The same, for the proxy: a miss waits on the database without
+    # holding up the event loop.
+    key_hash = _key_hash(caller_key)
+    known, record = _cached_key(key_hash)
+    if known:
+        return record
+
+    async with auth_db.AsyncSessionLocal() as db:
+        result = await db.execute(select(auth_db.ApiKey).filter_by(key_hash=key_hash, revoked=False).limit(1))
+        return _remember_key(key_hash, result.scalars().first())
+
+def forget_key(caller_key=None):
+    # One key, or all of them when there's no telling which changed.
+    with _keys_lock:
+        if caller_key is None:
+            _keys.clear()
+        else:
+            _keys.pop(_key_hash(caller_key), None)
+
+def create_api_key(caller_key, user_id, team=None, upstream_key=None):
+    db = auth_db.SessionLocal()
+    try:
+        db.add(auth_db.ApiKey(key_hash=_key_hash(caller_key), user_id=user_id, team=team, upstream_key=upstream_key))
+        db.commit()
+    finally:
+        db.close()
+    forget_key(caller_key)
+
+def revoke_api_key(caller_key):
+    db = auth_db.SessionLocal()
+    try:
+        db.query(auth_db.ApiKey).filter_by(key_hash=_key_hash(caller_key)).update({'revoked': True})
+        db.commit()
+    finally:
+        db.close()
+    forget_key(caller_key)
+
+def get_api_key(caller_key, model):
+    record = lookup_key(caller_key)
+    return record['upstream_key'] if record else None
+
+async def aget_api_key(caller_key, model):
+    record = await alookup_key(caller_key)
+    return record['upstream_key'] if record else None
+
+
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-here")
+JWT_ALGORITHM = "HS256"
+JWT_EXPIRATION_HOURS = 24
+
+class Revoked(jwt.InvalidTokenError):
+    # A token that checks out but was revoked. Not ExpiredSignatureError,
+    # the client shouldn't go and refresh it.
+    pass
+
+# Tokens we've already checked -> (when it runs out, its claims), so
+# it's a dict lookup rather than a signature check every request. An
+# entry goes once the token's exp is past, and revoke_token() keeps one
+# out until then: past that jwt.decode() turns it away by itself, so
+# the revoked ones are dropped as they run out.
+_TOKEN_SIZE = 10000
+_tokens = OrderedDict()
+_revoked_tokens = {}
+_tokens_lock = threading.Lock()
+_pruned = 0
+
+def _prune(now):
+    # Under _tokens_lock. At most once a minute, it's a walk of them all.
+    global _pruned
+    if now - _pruned < 60:
+        return
+    _pruned = now
+    for token in [token for token, expires in _revoked_tokens.items() if expires <= now]:
+        del _revoked_tokens[token]
+
+def decode_token(token):
+    now = time.time()
+    with _tokens_lock:
+        _prune(now)
+        if token in _revoked_tokens:
+            if _revoked_tokens[token] > now:
+                raise Revoked("Token revoked")
+            del _revoked_tokens[token]
+
+        item = _tokens.get(token)
+        if item:
+            if item[0] > now:
+                _tokens.move_to_end(token)
+                return item[1]
+            del _tokens[token]
+
+    # Raises for anything expired or not signed by us, same as before.
+    payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+    expires = payload.get('exp') or now + JWT_EXPIRATION_HOURS * 3600
+
+    with _tokens_lock:
+        _tokens[token] = (expires, payload)
+        while len(_tokens) > _TOKEN_SIZE:
+            _tokens.popitem(last=False)
+    return payload
+
+def revoke_token(token):
+    now = time.time()
+    with _tokens_lock:
+        _prune(now)
+        item = _tokens.pop(token, None)
+        _revoked_tokens[token] = item[0] if item else now + JWT_EXPIRATION_HOURS * 3600
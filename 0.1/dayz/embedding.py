@@ -0,0 +1,269 @@
+import os
+import re
+import json
+import zlib
+import logging
+import threading
+import numpy as np
+
+# The embedding modality from ref/memory.md. Everything here runs
+# offline: the default embedder is feature hashing over words and word
+# pairs, and vectors live in a memory-mapped float32 file, one row per
+# object id, that only ever gets appended to.
+
+
+class HashingEmbedder:
+    """
+    Hashes words and adjacent word pairs into a fixed number of signed
+    buckets with sublinear tf weighting and L2 normalization. No model,
+    no vocabulary and no training, so it's stable across processes and
+    any text can be embedded at any time.
+    """
+    name = 'hashing'
+
+    def __init__(self, dim=512):
+        self.dim = dim
+
+    def _features(self, text):
+        word_list = re.findall(r'\w+', (text or '').lower())
+        return word_list + [f"{a} {b}" for a, b in zip(word_list, word_list[1:])]
+
+    def embed(self, text_list):
+        matrix = np.zeros((len(text_list), self.dim), dtype=np.float32)
+        for ix, text in enumerate(text_list):
+            counts = {}
+            for feature in self._features(text):
+                # crc32 rather than hash() since that's salted per process.
+                h = zlib.crc32(feature.encode('utf-8'))
+                bucket = h % self.dim
+                sign = 1.0 if (h >> 31) & 1 else -1.0
+                counts[bucket] = counts.get(bucket, 0.0) + sign
+
+            for bucket, count in counts.items():
+                matrix[ix, bucket] = np.sign(count) * (1.0 + np.log(abs(count))) if count else 0.0
+
+        norm = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norm[norm == 0] = 1.0
+        return matrix / norm
+
+
+class ModelEmbedder:
+    """
+    A sentence-transformers model, if that's installed and the model is
+    on disk. Same interface as HashingEmbedder.
+    """
+    name = 'model'
+
+    def __init__(self, model_name='all-MiniLM-L6-v2'):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, text_list):
+        return self.model.encode(list(text_list), normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+def get_embedder():
+    # DAYZER_EMBEDDER picks a sentence-transformers model by name,
+    # otherwise (or if it can't be loaded) it's the hashing one.
+    model_name = os.environ.get('DAYZER_EMBEDDER')
+    if model_name and model_name != 'hashing':
+        try:
+            return ModelEmbedder(model_name)
+        except Exception as ex:
+            logging.warning(f"Can't load embedding model {model_name}, using hashing instead: {ex}")
+
+    return HashingEmbedder(int(os.environ.get('DAYZER_EMBEDDER_DIM') or 512))
+
+
+class VectorStore:
+    """
+    Vectors in <path>.vec as a (capacity, dim) float32 memmap and their
+    object ids in <path>.ids, with the row count in <path>.json. Appends
+    go on the end and the files double in size when they fill up.
+
+    Search is an exact top-k by inner product over the whole thing,
+    done in blocks so it's a handful of matrix products no matter how
+    many queries come in at once. If an IVF index has been trained
+    (see train()) the search can stick to the nprobe closest lists
+    instead.
+    """
+    block = 65536
+
+    def __init__(self, path, dim):
+        self.path = path
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.centroids = None
+        self.assign = None
+        self.lists = None
+
+        header = {}
+        if os.path.exists(f"{path}.json"):
+            with open(f"{path}.json") as f:
+                header = json.load(f)
+            if header['dim'] != dim:
+                raise Exception(f"{path} holds {header['dim']} dimensional vectors, not {dim}")
+
+        self.count = header.get('count', 0)
+        self._map(header.get('capacity', 1024))
+
+        if os.path.exists(f"{path}.centroids.npy"):
+            self.centroids = np.load(f"{path}.centroids.npy")
+            self.assign = self._memmap(f"{path}.ivf", np.int32, (self.capacity, ))
+
+    def _memmap(self, name, dtype, shape):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        mode = 'r+' if os.path.exists(name) else 'w+'
+        if mode == 'r+' and os.path.getsize(name) < size:
+            with open(name, 'r+b') as f:
+                f.truncate(size)
+        return np.memmap(name, dtype=dtype, mode=mode, shape=shape)
+
+    def _map(self, capacity):
+        self.capacity = capacity
+        self.vectors = self._memmap(f"{self.path}.vec", np.float32, (capacity, self.dim))
+        self.ids = self._memmap(f"{self.path}.ids", np.int64, (capacity, ))
+        if self.centroids is not None:
+            self.assign = self._memmap(f"{self.path}.ivf", np.int32, (capacity, ))
+
+    def _save(self):
+        self.vectors.flush()
+        self.ids.flush()
+        if self.assign is not None:
+            self.assign.flush()
+        with open(f"{self.path}.json", 'w') as f:
+            json.dump({'dim': self.dim, 'count': self.count, 'capacity': self.capacity}, f)
+
+    def append(self, id_list, matrix):
+        # No rebuild, not even with an IVF index: new rows just get
+        # assigned to their closest centroid.
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, self.dim)
+        with self.lock:
+            needed = self.count + len(matrix)
+            if needed > self.capacity:
+                capacity = self.capacity
+                while capacity < needed:
+                    capacity *= 2
+                self._save()
+                self._map(capacity)
+
+            self.vectors[self.count:needed] = matrix
+            self.ids[self.count:needed] = id_list
+            if self.centroids is not None:
+                nearest = np.argmax(matrix @ self.centroids.T, axis=1)
+                self.assign[self.count:needed] = nearest
+                if self.lists is not None:
+                    for list_ix in np.unique(nearest):
+                        self.lists[list_ix] = np.concatenate([self.lists[list_ix], self.count + np.flatnonzero(nearest == list_ix)])
+
+            self.count = needed
+            self._save()
+
+    def train(self, nlist=256, sample=50000, rounds=10):
+        # Spherical k-means over a sample for the IVF lists, then every
+        # row gets its list. Only worth it once there are a lot of rows.
+        count = self.count
+        rng = np.random.default_rng(50)
+        pick = rng.choice(count, size=min(sample, count), replace=False)
+        data = np.asarray(self.vectors[np.sort(pick)])
+        centroids = data[rng.choice(len(data), size=min(nlist, len(data)), replace=False)].copy()
+
+        for _ in range(rounds):
+            nearest = np.argmax(data @ centroids.T, axis=1)
+            for ix in range(len(centroids)):
+                members = data[nearest == ix]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[ix] = centroid / (np.linalg.norm(centroid) or 1.0)
+
+        with self.lock:
+            np.save(f"{self.path}.centroids.npy", centroids)
+            self.centroids = centroids
+            self.assign = self._memmap(f"{self.path}.ivf", np.int32, (self.capacity, ))
+            for start in range(0, self.count, self.block):
+                end = min(start + self.block, self.count)
+                self.assign[start:end] = np.argmax(np.asarray(self.vectors[start:end]) @ centroids.T, axis=1)
+            self.lists = None
+            self._save()
+
+    def _inverted(self, count):
+        # The rows in each IVF list, worked out from the assignments the
+        # first time they're needed and kept up to date by append().
+        if self.lists is None:
+            with self.lock:
+                assign = np.asarray(self.assign[:self.count])
+                order = np.argsort(assign, kind='stable')
+                bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+                self.lists = [order[bounds[ix]:bounds[ix + 1]] for ix in range(len(self.centroids))]
+        return self.lists
+
+    def search(self, queries, k=10, nprobe=None):
+        # queries is (n, dim). Returns n lists of (id, score), best first.
+        # nprobe only means something once train() has been run.
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        count = self.count
+        if count == 0:
+            return [[] for _ in queries]
+
+        if nprobe and self.centroids is not None:
+            return [self._probe(query, k, nprobe, count) for query in queries]
+
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+
+        for start in range(0, count, self.block):
+            end = min(start + self.block, count)
+            scores = queries @ np.asarray(self.vectors[start:end]).T
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, end), (len(queries), end - start))], axis=1)
+
+            keep = min(k, scores.shape[1])
+            top = np.argpartition(-scores, keep - 1, axis=1)[:, :keep]
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_rows = np.take_along_axis(rows, top, axis=1)
+
+        return [self._ranked(rows, scores) for rows, scores in zip(best_rows, best_scores)]
+
+    def _probe(self, query, k, nprobe, count):
+        nprobe = min(nprobe, len(self.centroids))
+        inverted = self._inverted(count)
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows = np.concatenate([inverted[ix] for ix in probe])
+        rows = rows[rows < count]
+        if len(rows) == 0:
+            return []
+
+        scores = np.asarray(self.vectors[rows]) @ query
+        keep = min(k, len(rows))
+        top = np.argpartition(-scores, keep - 1)[:keep]
+        return self._ranked(rows[top], scores[top])
+
+    def _ranked(self, rows, scores):
+        order = np.argsort(-scores)
+        return [(int(self.ids[rows[ix]]), float(scores[ix])) for ix in order]
+
+
+_store = None
+_embedder = None
+_lock = threading.Lock()
+
+def store():
+    # One embedder and store per process. The vectors go next to the
+    # object db unless DAYZER_VECTORS says otherwise.
+    global _store, _embedder
+    if _store is None:
+        with _lock:
+            if _store is None:
+                _embedder = get_embedder()
+                path = os.environ.get('DAYZER_VECTORS') or re.sub(r'\.db$', '', os.environ.get('DB') or 'config.db') + f".{_embedder.name}"
+                _store = VectorStore(path, _embedder.dim)
+    return (_embedder, _store)
+
+def add(id_list, text_list):
+    embedder, vectors = store()
+    vectors.append(id_list, embedder.embed(text_list))
+
+def nearest(text_list, k=10, nprobe=None):
+    embedder, vectors = store()
+    return vectors.search(embedder.embed(text_list), k, nprobe)
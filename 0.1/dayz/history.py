@@ -0,0 +1,205 @@
+import os
+import json
+import uuid
+import hashlib
+import logging
+import threading
+import importlib
+from collections import OrderedDict
+import tokens
+import threads
+
+objectdb = importlib.import_module('object-db')
+
+# OpenAI style clients send the whole conversation every time, so most
+# of any request is messages we already have. Every message gets a
+# chain hash, the hash of the one before it plus its own content, which
+# makes the hash stand for the whole conversation up to that point. A
+# stored message keeps its chain hash in objects.chain (indexed), so
+# the longest prefix we already have is the last message whose chain
+# hash we can find, and only what comes after it gets written.
+#
+# The chains people are in the middle of are also kept in memory, the
+# latest DAYZER_HISTORY_CACHE of them (100000), so the db is only asked
+# about conversations that haven't been seen in a while.
+
+# Message bodies this long or longer (in characters) are stored once,
+# content addressed, however many conversations they turn up in (see
+# objectdb.intern()). The message row has no data of its own then, just
+# a 'content' edge to the row that does. Shorter ones aren't worth the
+# extra row and stay inline. objectdb.search() finds either kind, a hit
+# on shared content counting as a hit on each message that uses it.
+_INTERN = int(os.environ.get('DAYZER_INTERN') or 1024)
+
+_cache = OrderedDict()
+_cache_size = int(os.environ.get('DAYZER_HISTORY_CACHE') or 100000)
+_lock = threading.Lock()
+
+
+def user_key(api_key):
+    # Stands in for the user in meta and seeds their chains. The key
+    # itself never gets stored, just enough of its hash to tell people
+    # apart.
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16] if api_key else None
+
+def _canonical(message):
+    # Only what the model sees. Key order and whatever else a client
+    # tacks on shouldn't make a message look new.
+    fields = {key: message.get(key) for key in ('role', 'content', 'name', 'tool_calls', 'tool_call_id') if message.get(key) is not None}
+    return json.dumps(fields, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+def seed(meta):
+    # Whose chain it is. Someone without a key is told apart by the
+    # address they came from, or failing that not at all: a chain of
+    # their own every time, so two strangers who open the same way
+    # don't end up in one thread. Their conversations don't get picked
+    # up where they left off, there's no telling it's them.
+    if meta.get('user'):
+        return meta['user']
+    if meta.get('client'):
+        return f"client:{meta['client']}"
+    return f"once:{uuid.uuid4().hex}"
+
+def chain(messages, seed=None):
+    # The chain hash for each message in turn, the seed (the user)
+    # going in first so the same words from two people never meet.
+    digest = hashlib.blake2b((seed or '').encode('utf-8'), digest_size=16).digest()
+    hash_list = []
+    for message in messages:
+        digest = hashlib.blake2b(digest + _canonical(message), digest_size=16).digest()
+        hash_list.append(digest.hex())
+    return hash_list
+
+def remember(chain_hash, id):
+    with _lock:
+        _cache[chain_hash] = id
+        _cache.move_to_end(chain_hash)
+        while len(_cache) > _cache_size:
+            _cache.popitem(last=False)
+
+def forget(hash_list):
+    with _lock:
+        for chain_hash in hash_list:
+            _cache.pop(chain_hash, None)
+
+def lookup(chain_hash):
+    # The object id stored under a chain hash, or None.
+    with _lock:
+        if chain_hash in _cache:
+            _cache.move_to_end(chain_hash)
+            return _cache[chain_hash]
+
+    row_list = objectdb.find('objects', {'chain': chain_hash}, 'id', limit=1)
+    if row_list:
+        remember(chain_hash, row_list[0]['id'])
+        return row_list[0]['id']
+
+def stored_prefix(hash_list):
+    """
+    How many of the messages are already stored and the id of the last
+    of those, (0, None) if none are. Having message n means having
+    everything before it, so this gallops back from the end, where the
+    new messages are, and then binary searches the gap, so it's a
+    handful of lookups however long the conversation is.
+    """
+    count = len(hash_list)
+    low, high = (0, None), count + 1
+
+    # Try count, count - 1, count - 3, count - 7 ... stored messages
+    # until one of them is. low is known to be stored, high isn't.
+    new = 1
+    while new <= count:
+        have = count - new + 1
+        id = lookup(hash_list[have - 1])
+        if id is not None:
+            low = (have, id)
+            break
+        high = have
+        new *= 2
+
+    while low[0] + 1 < high:
+        middle = (low[0] + high) // 2
+        id = lookup(hash_list[middle - 1])
+        if id is not None:
+            low = (middle, id)
+        else:
+            high = middle
+
+    return low
+
+def content(message):
+    # content is a string or, for multimodal messages, a list of parts
+    content = message.get('content')
+    if isinstance(content, list):
+        return '\n'.join(part.get('text', '') for part in content if isinstance(part, dict) and part.get('type') == 'text')
+    return content or ''
+
+def persist(messages, meta={}, stored=None):
+    """
+    Stores whatever part of messages isn't stored yet, each one linked
+    to the one before it. Meant to run inside objectdb.transaction();
+    it returns the chain hashes it added so that if the transaction
+    rolls back they can be handed to forget(). If there's a stored list
+    the new rows go on it too, {'id':, 'data':} with the whole body
+    even when it's interned, for whatever wants them after the commit.
+    """
+    hash_list = chain(messages, seed(meta))
+    have, last_id = stored_prefix(hash_list)
+    if have == len(messages):
+        return []
+
+    new_list = messages[have:]
+    body_list = [content(message) for message in new_list]
+
+    # Which thread they're in, see threads.py.
+    thread_id = threads.of(last_id) if last_id else None
+    if thread_id is None:
+        thread_id = threads.start(body_list, [message.get('role') for message in new_list], meta)
+
+    shared = [ix for ix, body in enumerate(body_list) if _INTERN and len(body) >= _INTERN]
+    content_id_list = objectdb.intern([body_list[ix] for ix in shared], extra_list=[{'tokens': tokens.count(body_list[ix])} for ix in shared]) if shared else []
+
+    row_list = []
+    for message, body, chain_hash in zip(new_list, body_list, hash_list[have:]):
+        row_meta = dict(meta, role=message.get('role'), thread=thread_id)
+        for key in ('name', 'tool_calls', 'tool_call_id'):
+            if message.get(key):
+                row_meta[key] = message[key]
+        # Counted now so nothing that reads it back has to.
+        row_list.append({'data': body, 'meta': row_meta, 'chain': chain_hash, 'tokens': tokens.message(message)})
+
+    for ix in shared:
+        row_list[ix]['data'] = None
+
+    id_list = objectdb.insert_many('objects', row_list)
+    if id_list is None:
+        raise Exception("insert_many failed")
+
+    edge_list = [{'src_id': src, 'dest_id': dest} for src, dest in zip([last_id] + id_list, id_list) if src is not None]
+    edge_list += [{'src_id': id_list[ix], 'dest_id': content_id, 'kind': 'content'} for ix, content_id in zip(shared, content_id_list)]
+    if edge_list and objectdb.insert_many('relationship', edge_list) is None:
+        raise Exception("insert_many failed")
+
+    threads.add(thread_id, id_list)
+
+    if stored is not None:
+        stored += [{'id': id, 'data': body} for id, body in zip(id_list, body_list)]
+
+    for chain_hash, id in zip(hash_list[have:], id_list):
+        remember(chain_hash, id)
+
+    logging.debug(f"history: {have} of {len(messages)} messages already stored")
+    return hash_list[have:]
+
+def resolve(row_list):
+    # Fills in data for message rows whose body is stored elsewhere,
+    # in one query however many there are.
+    missing = {row['id']: row for row in row_list if row.get('data') is None}
+    if missing:
+        query = objectdb.run(
+            "select r.src_id, o.data from relationship r join objects o on o.id = r.dest_id where r.kind = 'content' and r.src_id in ({})".format(','.join(['?'] * len(missing))),
+            list(missing), readonly=True
+        )
+        for src_id, data in query.fetchall():
+            missing[src_id]['data'] = objectdb.unpack(data)
+    return row_list
@@ -0,0 +1,160 @@
+import os
+import asyncio
+import logging
+import importlib
+import history
+import memory
+import tokens
+
+objectdb = importlib.import_module('object-db')
+
+# Context injection: what's been said before that's relevant to this
+# request goes in as a system message, as much of it as fits in the
+# model's budget and the most relevant per token first.
+
+# Context lengths, in tokens, by model name. The longest entry that
+# appears in the model from the request wins, so provider prefixes and
+# suffixes like "openrouter/google/gemini-2.0-flash-exp:free" don't get
+# in the way.
+_CONTEXT = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+    'gpt-4.1': 1047576,
+    'gpt-5': 400000,
+    'o1': 200000,
+    'o3': 200000,
+    'o4-mini': 200000,
+    'claude-3': 200000,
+    'claude-3-5': 200000,
+    'claude-3-7': 200000,
+    'claude-sonnet-4': 200000,
+    'claude-opus-4': 200000,
+    'gemini-1.5-pro': 2097152,
+    'gemini-1.5-flash': 1048576,
+    'gemini-2.0-flash': 1048576,
+    'gemini-2.5': 1048576,
+    'llama-3': 8192,
+    'llama-3.1': 131072,
+    'llama-3.3': 131072,
+    'mistral': 32768,
+    'mixtral': 32768,
+    'deepseek': 65536,
+    'qwen': 32768,
+    'qwen2.5-coder': 131072,
+}
+
+# For anything not in the table.
+_CONTEXT_DEFAULT = int(os.environ.get('DAYZER_CONTEXT_DEFAULT') or 8192)
+
+# The most of the context window that injected memories can take, and
+# what's kept back for the reply when the request doesn't say.
+_SHARE = float(os.environ.get('DAYZER_INJECT_SHARE') or 0.25)
+_RESERVE = 4096
+
+_HEADER = "Relevant context from earlier conversations:"
+
+
+def context_length(model):
+    name = (model or '').lower()
+    match = None
+    for key in _CONTEXT:
+        if key in name and (match is None or len(key) > len(match)):
+            match = key
+    return _CONTEXT[match] if match else _CONTEXT_DEFAULT
+
+def budget(messages, model, max_tokens=None):
+    # What's left for memories once the conversation and the reply have
+    # had theirs, and never more than _SHARE of the window.
+    window = context_length(model)
+    used = sum(tokens.message(message) for message in messages)
+    reserve = max_tokens or min(_RESERVE, window // 4)
+    return max(0, min(int(window * _SHARE), window - used - reserve))
+
+def _rows(id_list):
+    # The candidates with their stored token counts, in one query.
+    if not id_list:
+        return []
+
+    query = objectdb.run(
+        'select id, data, meta, tokens from objects where id in ({})'.format(','.join(['?'] * len(id_list))),
+        list(id_list), readonly=True
+    )
+    return history.resolve(objectdb.process([record for record in query.fetchall()], 'objects', 'post'))
+
+def pack(ranked, room, exclude=()):
+    """
+    Greedy 0/1 knapsack on relevance per token. ranked is [(id, score)]
+    best first, like ensemble_retrieve() hands back; room is the token
+    budget. Returns the rows that made it, most relevant first. Anything
+    whose text is already in the conversation (exclude, a set of content
+    hashes) is skipped.
+    """
+    row_map = {row['id']: row for row in _rows([id for id, score in ranked])}
+    candidate_list = []
+    for id, score in ranked:
+        row = row_map.get(id)
+        if not row or not row.get('data') or objectdb.content_hash(row['data']) in exclude:
+            continue
+
+        # Rows from before the count was kept get one now.
+        cost = (row.get('tokens') or tokens.count(row['data'])) + 4
+        candidate_list.append((score / cost, score, cost, row))
+
+    chosen = []
+    for density, score, cost, row in sorted(candidate_list, key=lambda item: -item[0]):
+        if cost <= room:
+            chosen.append((score, row))
+            room -= cost
+
+    return [row for score, row in sorted(chosen, key=lambda item: -item[0])]
+
+def _format(row_list):
+    part_list = [_HEADER]
+    for row in row_list:
+        role = (row.get('meta') or {}).get('role') or 'note'
+        part_list.append(f"[{role}] {row['data']}")
+    return '\n\n---\n\n'.join(part_list)
+
+def _query(messages):
+    # What to look things up by: the last thing the user said.
+    for message in reversed(messages):
+        if message.get('role') == 'user':
+            return history.content(message)
+    return ''
+
+def inject(messages, model, max_tokens=None, fidelity='medium', filters=None):
+    """
+    messages with a system message of relevant memories added after any
+    system messages already there. If there's no room or nothing
+    relevant, messages come back as they are.
+
+    filters says whose memories they can be, {'meta.user': ...} for the
+    caller's own. Every modality keeps to it. Without one nothing gets
+    injected, since that would be anybody's.
+    """
+    if not filters or any(value is None for value in filters.values()):
+        return messages
+
+    room = budget(messages, model, max_tokens) - tokens.count(_HEADER)
+    query = _query(messages)
+    if room <= 0 or not query:
+        return messages
+
+    ranked = memory.ensemble_retrieve(memory.Query(query, filters), fidelity)
+    exclude = {objectdb.content_hash(history.content(message)) for message in messages}
+    row_list = pack(ranked, room, exclude)
+    if not row_list:
+        return messages
+
+    logging.debug(f"inject: {len(row_list)} of {len(ranked)} memories into {room} tokens for {model}")
+    at = 0
+    while at < len(messages) and messages[at].get('role') == 'system':
+        at += 1
+    return messages[:at] + [{'role': 'system', 'content': _format(row_list)}] + messages[at:]
+
+async def ainject(messages, model, max_tokens=None, fidelity='medium', filters=None):
+    # For the proxy, the retrieval and the db reads happen off the event loop.
+    return await asyncio.get_running_loop().run_in_executor(None, inject, messages, model, max_tokens, fidelity, filters)
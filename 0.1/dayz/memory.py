@@ -1,16 +1,135 @@
-def add_to_memory(query):
-    # see the memory discussion in the google doc
-    # Store across all modes, always
-    for f in [store_as_graph, store_as_embedding, store_as_document]:
-        f(memory_fragment)
+import time
+import asyncio
+import logging
+import importlib
+from concurrent.futures import ThreadPoolExecutor, wait
+import embedding
 
-    # Retrieval time = decision point
-    if query.intent == "just find something relevant":
-        result = retrieve_as_embedding(query)
+objectdb = importlib.import_module('object-db')
 
-    elif query.intent == "reason about implications":
-        result = ensemble_retrieve(query, fidelity="high")
+# What each fidelity costs: which modalities get asked, how many
+# candidates each one returns and how long (seconds) we wait for them.
+# Anything that isn't back by the deadline is left out of the result.
+_FIDELITY = {
+    'low': {'modalities': ['document'], 'k': 5, 'deadline': 0.05},
+    'medium': {'modalities': ['document', 'embedding'], 'k': 10, 'deadline': 0.15},
+    'high': {'modalities': ['document', 'embedding', 'graph', 'rdbms'], 'k': 25, 'deadline': 0.4},
+}
 
-    else:
-        result = retrieve_as_document(query)
+# The k in reciprocal rank fusion, 60 is what everybody uses.
+_RRF_K = 60
 
+# Shared across requests so the threads, and the per-thread object-db
+# connections that come with them, stick around.
+_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='retrieve')
+
+class Query:
+    # Plain text works as a query too. This is for when there's more to
+    # it: filters is a find() style where_dict that every modality keeps
+    # to, {'meta.user': ...} to stay inside one person's history, and
+    # anchor is where graph walks start from.
+    def __init__(self, text, filters=None, anchor=None):
+        self.text = text
+        self.filters = filters
+        self.anchor = anchor
+
+def _text(query):
+    # A query is either plain text or something carrying .text
+    return getattr(query, 'text', query)
+
+def _kept(ranked, query):
+    # For the modalities that can't filter as they go: what's left of
+    # ranked once query.filters has had its say.
+    filters = getattr(query, 'filters', None)
+    if not filters:
+        return ranked
+    allowed = objectdb.matching('objects', [id for id, score in ranked], filters)
+    return [(id, score) for id, score in ranked if id in allowed]
+
+def store_as_embedding(fragment_list):
+    # Stored objects, [{'id':, 'data':, ...}], once they're committed:
+    # the vectors can't be taken back if the rows are. capture.write()
+    # hands over every message history.persist() adds. Ones with no
+    # text have nothing to embed. Returns how many were.
+    fragment_list = [fragment for fragment in fragment_list if fragment.get('data')]
+    if fragment_list:
+        embedding.add([fragment['id'] for fragment in fragment_list], [fragment['data'] for fragment in fragment_list])
+    return len(fragment_list)
+
+def retrieve_as_embedding(query, k=10):
+    # [(object id, similarity), ...] best first. With filters it asks
+    # for more, since some of them won't be allowed.
+    ranked = embedding.nearest([_text(query)], k * 4 if getattr(query, 'filters', None) else k)[0]
+    return _kept(ranked, query)[:k]
+
+def retrieve_as_document(query, k=10):
+    # Keyword recall off the full text index, narrowed by query.filters
+    # (a find() style where_dict) if there is one.
+    hits = objectdb.search(_text(query), getattr(query, 'filters', None) or {}, limit=k)
+    return [(hit['id'], -hit['score']) for hit in hits]
+
+def retrieve_as_graph(query, k=10):
+    # What's connected to query.anchor (a user, project, conversation
+    # ...) closest first. Without an anchor there's nothing to walk from.
+    anchor = getattr(query, 'anchor', None)
+    if anchor is None:
+        return []
+    ranked = [(row['id'], 1.0 / row['depth']) for row in objectdb.walk(anchor, 2, 'both')]
+    return _kept(ranked, query)[:k]
+
+def retrieve_as_rdbms(query, k=10):
+    # Straight structured lookup on query.filters, newest first.
+    filters = getattr(query, 'filters', None)
+    if not filters:
+        return []
+    return [(row['id'], 1.0) for row in objectdb.find('objects', filters, 'id', limit=k)]
+
+_RETRIEVE = {
+    'document': retrieve_as_document,
+    'embedding': retrieve_as_embedding,
+    'graph': retrieve_as_graph,
+    'rdbms': retrieve_as_rdbms,
+}
+
+def _fuse(ranked_lists, k):
+    # Reciprocal rank fusion, so no modality's scores have to be
+    # comparable with any other's, only the order within each counts.
+    fused = {}
+    for ranked in ranked_lists:
+        for rank, (id, score) in enumerate(ranked):
+            fused[id] = fused.get(id, 0.0) + 1.0 / (_RRF_K + rank + 1)
+
+    return sorted(fused.items(), key=lambda item: -item[1])[:k]
+
+def ensemble_retrieve(query, fidelity="high", deadline=None, k=None):
+    """
+    Asks every modality the fidelity calls for at once and fuses what
+    comes back by the deadline. [(object id, fused score), ...] best first.
+    """
+    policy = _FIDELITY[fidelity]
+    k = k or policy['k']
+    deadline = policy['deadline'] if deadline is None else deadline
+    start = time.time()
+
+    futures = {_pool.submit(_RETRIEVE[name], query, k): name for name in policy['modalities']}
+    done, late = wait(futures, timeout=deadline)
+
+    ranked_lists = []
+    for future in done:
+        try:
+            ranked_lists.append(future.result())
+        except Exception as ex:
+            logging.warning(f"retrieve_as_{futures[future]} failed: {ex}")
+
+    for future in late:
+        # Ones that haven't started yet don't need to; the rest finish
+        # in the background and get thrown away.
+        future.cancel()
+        logging.info(f"retrieve_as_{futures[future]} missed the {deadline}s deadline")
+
+    logging.debug(f"ensemble_retrieve {fidelity} took {time.time() - start:.3f}s with {len(done)}/{len(futures)} modalities")
+    return _fuse(ranked_lists, k)
+
+async def aensemble_retrieve(query, fidelity="high", deadline=None, k=None):
+    # For the proxy, so the waiting happens off the event loop.
+    return await asyncio.get_running_loop().run_in_executor(None, ensemble_retrieve, query, fidelity, deadline, k)
@@ -5,15 +5,70 @@ import sqlite3
 import time
 import os
 import sys
+import re
 import json
+import zlib
+import hashlib
+import atexit
+from collections.abc import Mapping
+from contextlib import contextmanager
 from datetime import timedelta
-from threading import Lock
+from threading import RLock
 from pprint import pprint
 
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
 _dbcount = 0
-_lock = Lock()
+_batch = 256
+_lock = RLock()
 _instance = {}
 
+# Readers each get their own connection (see connect()) and don't touch
+# any lock; with wal they run in parallel with each other and with the
+# writer. All writes go through the single _writer connection and are
+# serialized by _lock. Set DBSERIAL to get the old behaviour back where
+# every statement, reads included, takes the lock.
+_writer = None
+_serial = 'DBSERIAL' in os.environ
+
+# How deep we are in transaction() blocks. Only touched with _lock held
+# and while it's non-zero run() leaves the commit to the outermost block.
+_depth = 0
+
+# When group_commit() is on this holds the limits and how many writes
+# are sitting uncommitted on the writer.
+_group = None
+
+# Text at least this many characters long goes into objects.data compressed,
+# as a blob whose first two bytes say how, see pack(). Set DBCOMPRESS
+# to 0 to leave everything as text.
+_COMPRESS = int(os.environ.get('DBCOMPRESS') or 4096)
+
+# zstd if it's installed, zlib otherwise. Either can be read back.
+_CODEC = {
+  b'\x1fz': (lambda x: zlib.compress(x, 6), zlib.decompress),
+}
+if zstandard:
+  _CODEC[b'\x1fs'] = (zstandard.ZstdCompressor(level=3).compress, lambda x: zstandard.ZstdDecompressor().decompress(x))
+_PACK_WITH = b'\x1fs' if zstandard else b'\x1fz'
+
+def pack(x, row=None):
+  if not _COMPRESS or not isinstance(x, str) or len(x) < _COMPRESS:
+    return x
+
+  raw = x.encode('utf-8')
+  packed = _PACK_WITH + _CODEC[_PACK_WITH][0](raw)
+  # Not everything gets smaller.
+  return packed if len(packed) < len(raw) else x
+
+def unpack(x, row=None):
+  if isinstance(x, bytes) and x[:2] in _CODEC:
+    return _CODEC[x[:2]][1](x[2:]).decode('utf-8')
+  return x
+
 # This is a way to get the column names after grabbing everything
 # I guess it's also good practice
 _PROCESSOR = {
@@ -21,6 +76,10 @@ _PROCESSOR = {
     'meta': {
       'pre': lambda x, row: json.dumps(x),
       'post': lambda x, row: json.loads(x)
+    },
+    'data': {
+      'pre': pack,
+      'post': unpack
     }
   }
 }
@@ -34,40 +93,153 @@ _SCHEMA = {
     ('id', 'integer primary key autoincrement'),
     ('data', 'text'),
     ('meta', 'text'),
+    ('chain', 'text'),
+    ('hash', 'text'),
+    ('tokens', 'integer'),
   ],
   'relationship': [
     ('id', 'integer primary key autoincrement'),
     ('src_id', 'integer'),
     ('dest_id', 'integer'),
+    ('kind', 'text'),
   ]
 }
 
+# Indexes we keep on each table, as the expression that goes inside
+# the parens of create index. upgrade() adds what's missing and drops
+# ones of ours that aren't listed here anymore.
+_INDEX = {
+  'objects': [
+    "json_extract(meta, '$.user')",
+    "json_extract(meta, '$.repo')",
+    # threads.py: someone's topics, newest first, the threads in a
+    # topic, and the messages in a thread, in id order.
+    "json_extract(meta, '$.type'), json_extract(meta, '$.user'), json_extract(meta, '$.updated')",
+    "json_extract(meta, '$.type'), json_extract(meta, '$.user'), json_extract(meta, '$.topic')",
+    "json_extract(meta, '$.thread')",
+    'chain',
+    'hash',
+  ],
+  'relationship': [
+    'src_id, dest_id, kind',
+    'dest_id, src_id, kind',
+  ]
+}
+
+# Tables that get a full text index over a column. The index lives in
+# an fts5 table named <table>_fts that reads its content out of the
+# table through the <table>_text view, which undoes pack(), and triggers
+# keep it in step with every insert, update and delete, the bulk paths
+# included.
+_FTS = {
+  'objects': 'data'
+}
+
+# Search words that show up in more than this share of rows are
+# dropped from the query. They barely move the ranking and they're
+# what makes a search walk half the index.
+_FTS_COMMON = 0.05
+
+# A filtered search starts from the rows the filter picks out, rather
+# than from the matches, when there are under a quarter as many of them
+# as there are likely matches. Gathering those rows costs a few times
+# what checking a match against the filter does.
+_FTS_NARROW = 4
+
+# Column names per table in schema order, worked out from _SCHEMA once
+# at import and again whenever upgrade() runs.
+_COLUMNS = {}
+
+# Generated SQL keyed by (table, operation, the keys involved) so the
+# query builders only do their string work the first time they see a
+# given shape of call.
+_SQL = {}
+
+# How to take one step along an edge, depending on which way we go.
+_EDGE = {
+  'out': ('src_id', 'dest_id'),
+  'in': ('dest_id', 'src_id'),
+}
+
 
 def _checkForTable(what):
   global _SCHEMA
   if what not in _SCHEMA:
     raise Exception("Table {} not found".format(what))
 
+def _columns_update():
+  global _COLUMNS
+  _COLUMNS = {table: [x[0] for x in schema] for table, schema in _SCHEMA.items()}
+  _SQL.clear()
+
 def _parse(table, data):
   _checkForTable(table)
 
   data = process(data, table, 'pre')
-  known_keys = [x[0] for x in _SCHEMA[table]] 
-  shared_keys = list(data.keys() & known_keys)
 
-  # Make sure that the ordinal is maintained.
+  # Going by the schema keeps the order the same from call to call,
+  # which is what lets _SQL hand back the same statement.
+  shared_keys = tuple(key for key in _COLUMNS[table] if key in data)
   value_list = [data[key] for key in shared_keys]
 
   return (shared_keys, value_list)
 
+def _meta_expr(key):
+  # 'meta.user' -> json_extract(meta, '$.user'). The path has to be
+  # inlined rather than bound for sqlite to match it up with an index
+  # on the same expression, so it's held to a plain character set.
+  column, path = key.split('.', 1)
+  if not re.match(r'^[A-Za-z0-9_.\[\]]+$', path):
+    raise Exception("Bad path {}".format(key))
+
+  return "json_extract({}, '$.{}')".format(column, path)
+
+def _where(table, where_dict):
+  # Plain columns are matched as is and 'meta.x.y' style keys are
+  # matched against that path inside the json of the meta column.
+  sig = (table, 'where', tuple(where_dict), tuple(value is None for value in where_dict.values()))
+
+  if sig not in _SQL:
+    known_keys = _COLUMNS[table]
+    column_keys = [key for key in known_keys if key in where_dict]
+    clause_list = ["{}=?".format(key) for key in column_keys]
+    meta_keys = []
+
+    for key, value in where_dict.items():
+      if '.' in key and key.split('.')[0] in known_keys:
+        if value is None:
+          clause_list.append('{} is null'.format(_meta_expr(key)))
+        else:
+          clause_list.append('{}=?'.format(_meta_expr(key)))
+          meta_keys.append(key)
+
+    # Only bother with process() when a column here has a pre step.
+    needs_pre = any(key in _PROCESSOR.get(table, {}) for key in column_keys)
+    _SQL[sig] = (' and '.join(clause_list), column_keys, meta_keys, needs_pre)
+
+  where_string, column_keys, meta_keys, needs_pre = _SQL[sig]
+  data = process(where_dict, table, 'pre') if needs_pre else where_dict
+
+  return (where_string, [data[key] for key in column_keys] + [where_dict[key] for key in meta_keys])
+
+def index_meta(path, table='objects'):
+  # Declare a hot meta path, e.g. index_meta('tool'). It goes into
+  # _INDEX so upgrade() builds it now and keeps it from then on.
+  expr = _meta_expr('meta.{}'.format(path))
+  if expr not in _INDEX.setdefault(table, []):
+    _INDEX[table].append(expr)
+
 def _insert(table, data):
   shared_keys, value_list = _parse(table, data)
+  sig = (table, 'insert', shared_keys)
 
-  key_string = ','.join(shared_keys)
-  value_qlist = ['?'] * len(value_list)
-  value_string = ','.join(value_qlist)
+  if sig not in _SQL:
+    key_string = ','.join(shared_keys)
+    value_qlist = ['?'] * len(value_list)
+    value_string = ','.join(value_qlist)
+    _SQL[sig] = 'insert into {}({}) values({})'.format(table, key_string, value_string)
 
-  return ['insert into {}({}) values({})'.format(table, key_string, value_string), shared_keys, value_list]
+  return [_SQL[sig], shared_keys, value_list]
   
 def delete(table, id):
   return run('delete from {} where id = ?'.format(table), (id, ))
@@ -84,13 +256,16 @@ def insert(table, data):
 
   
 def update(table, where_dict, set_dict):
-  shared_keys, where_values = _parse(table, where_dict)
-  where_string = ' and '.join(["{}=?".format(key) for key in shared_keys])
+  where_string, where_values = _where(table, where_dict)
 
   shared_keys, set_values = _parse(table, set_dict)
-  set_string = ','.join(["{}=?".format(key) for key in shared_keys])
+  sig = (table, 'update', shared_keys, where_string)
+
+  if sig not in _SQL:
+    set_string = ','.join(["{}=?".format(key) for key in shared_keys])
+    _SQL[sig] = 'update {} set {} where {}'.format(table, set_string, where_string)
 
-  qstr = 'update {} set {} where {}'.format(table, set_string, where_string)
+  qstr = _SQL[sig]
 
   try:
     res, last = run(qstr, set_values + where_values, with_last = True)
@@ -99,40 +274,85 @@ def update(table, where_dict, set_dict):
   except:
     logging.warning("Unable to update a record {}|{}|{}".format(qstr, ', '.join([str(x) for x in set_values]), ', '.join([str(x) for x in where_values])))
 
-def _find(table, where_dict, fields):
-  shared_keys, where_values = _parse(table, where_dict)
-  where_string = ' and '.join(["{}=?".format(key) for key in shared_keys])
+def _page(where_string, where_values, key, limit, offset, after, order='asc'):
+  # Tacks on the pagination. after is keyset pagination on key, the
+  # last one you saw, which beats a big offset because sqlite doesn't
+  # have to walk over everything it skips.
+  if after is not None:
+    clause = '{} {} ?'.format(key, '<' if order == 'desc' else '>')
+    where_string = '{} and {}'.format(where_string, clause) if where_string else clause
+    where_values = where_values + [after]
 
   # The where string could be empty
   if len(where_string) > 0:
     where_string = "where {}".format(where_string)
 
-  qstr = 'select {} from {} {} order by id desc'.format(fields, table, where_string)
+  tail = 'order by {} {}'.format(key, order)
+  if limit is not None or offset is not None:
+    tail += ' limit ? offset ?'
+    where_values = where_values + [-1 if limit is None else int(limit), int(offset or 0)]
+
+  return (where_string, where_values, tail)
+
+def _find(table, where_dict, fields, limit=None, offset=None, before=None):
+  where_string, where_values = _where(table, where_dict)
+  sig = (table, 'find', fields, where_string, before is not None, limit is not None or offset is not None)
+  where_string, where_values, tail = _page(where_string, where_values, 'id', limit, offset, before, 'desc')
+
+  if sig not in _SQL:
+    _SQL[sig] = 'select {} from {} {} {}'.format(fields, table, where_string, tail)
+
+  qstr = _SQL[sig]
 
   try:
-    return run(qstr, where_values)
+    return run(qstr, where_values, readonly=True)
 
   except:
     logging.warning("Unable to find a record {}|{}".format(qstr, ', '.join([str(x) for x in where_values])))
 
+def matching(table, id_list, where_dict):
+  # Which of the ids in id_list are rows that where_dict matches, the
+  # way find() would, as a set.
+  if not id_list:
+    return set()
+
+  where_string, where_values = _where(table, where_dict)
+  qstr = 'select id from {} where id in ({})'.format(table, ','.join(['?'] * len(id_list)))
+  if where_string:
+    qstr += ' and ' + where_string
+
+  return {row[0] for row in run(qstr, list(id_list) + where_values, readonly=True).fetchall()}
+
 def findOne(table, where_dict = {}, fields='*'):
-  res = _find(table, where_dict, fields)
+  res = _find(table, where_dict, fields, limit=1)
 
   if res is not None:
     rowList = process(res.fetchone(), table, 'post')
     if rowList:
       return list(rowList)
 
-def find(table, where_dict = {}, fields='*'):
-  res = _find(table, where_dict, fields)
+def find(table, where_dict = {}, fields='*', limit=None, offset=None, before=None):
+  # Newest first. For the next page pass the last id you got as before.
+  res = _find(table, where_dict, fields, limit, offset, before)
   if res is not None:
     return process([record for record in res.fetchall()], table, 'post')
 
+def find_iter(table, where_dict = {}, fields='*', limit=None, offset=None, before=None, batch=None):
+  # Same as find() but rows are handed over as they come off the cursor,
+  # batch at a time, and meta isn't decoded until you look at it.
+  res = _find(table, where_dict, fields, limit, offset, before)
+  if res is not None:
+    yield from _stream(res, table, batch)
+
 def upsert(table, data):
   qstr, key_list, values = _insert(table, data)
-  update_list = ["{}=?".format(key) for key in key_list]
+  sig = (table, 'upsert', key_list)
 
-  qstr += "on conflict(id) do update set {}".format(','.join(update_list))
+  if sig not in _SQL:
+    update_list = ["{}=?".format(key) for key in key_list]
+    _SQL[sig] = qstr + "on conflict(id) do update set {}".format(','.join(update_list))
+
+  qstr = _SQL[sig]
 
   try:
     res, last = run(qstr, values + values, with_last = True)
@@ -141,6 +361,180 @@ def upsert(table, data):
   except:
     logging.warning("Unable to upsert a record {}".format(','.join([str(x) for x in values])))
 
+def _many(table, rows, upsert=False):
+  _checkForTable(table)
+
+  # All the meta encoding in one go. process() swaps rows out
+  # for new dicts so this doesn't touch the caller's list.
+  rows = process(list(rows), table, 'pre')
+  known_keys = _COLUMNS[table]
+
+  # Runs of rows that set the same columns share one statement. In
+  # practice that's the whole batch. Going run by run rather than
+  # grouping keeps the ids in the order the rows came in.
+  groups = []
+  for ix, row in enumerate(rows):
+    key_list = tuple(key for key in known_keys if key in row)
+    if not groups or groups[-1][0] != key_list:
+      groups.append((key_list, []))
+    groups[-1][1].append((ix, [row[key] for key in key_list]))
+
+  id_list = [None] * len(rows)
+
+  with transaction() as db:
+    for key_list, batch in groups:
+      qstr = 'insert into {}({}) values({})'.format(table, ','.join(key_list), ','.join(['?'] * len(key_list)))
+
+      if upsert and 'id' in key_list:
+        update_list = ["{0}=excluded.{0}".format(key) for key in key_list if key != 'id']
+        if update_list:
+          qstr += ' on conflict(id) do update set {}'.format(','.join(update_list))
+        else:
+          qstr += ' on conflict(id) do nothing'
+
+      db['c'].executemany(qstr, [values for ix, values in batch])
+
+      if 'id' in key_list:
+        id_ix = key_list.index('id')
+        for ix, values in batch:
+          id_list[ix] = values[id_ix]
+
+      else:
+        # We hold the writer for the whole batch so autoincrement
+        # hands these out back to back, ending at the last one.
+        last = db['c'].execute('select last_insert_rowid()').fetchone()[0]
+        for offset, (ix, values) in enumerate(batch):
+          id_list[ix] = last - len(batch) + 1 + offset
+
+  return id_list
+
+def insert_many(table, rows):
+  # Like insert() for a whole list of dicts, in one transaction.
+  # Returns the ids in the same order as rows.
+  try:
+    return _many(table, rows)
+
+  except Exception as exc:
+    logging.warning("Unable to insert {} records into {} ({})".format(len(rows), table, exc))
+
+def upsert_many(table, rows):
+  # Like upsert() for a whole list of dicts. Rows with an id update
+  # that record if it's there, the rest are plain inserts.
+  try:
+    return _many(table, rows, upsert=True)
+
+  except Exception as exc:
+    logging.warning("Unable to upsert {} records into {} ({})".format(len(rows), table, exc))
+
+def content_hash(data):
+  return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+def intern(data_list, table='objects', extra_list=None):
+  # Content addressed storage. Each distinct string in data_list is
+  # stored once, keyed by its hash in the hash column, and you get back
+  # the id holding each one, in order. Strings we already have just get
+  # their existing id. Reference them from other rows through
+  # relationship rather than copying them. extra_list, if it's there,
+  # has more columns for each string's row should it be a new one.
+  hash_list = [content_hash(data) for data in data_list]
+  id_map = {}
+
+  # The lookups go through the writer, inside the same transaction as
+  # the inserts, so nobody can sneak the same content in between.
+  with transaction() as db:
+    unique_list = list(dict.fromkeys(hash_list))
+    for start in __builtins__['range'](0, len(unique_list), 500):
+      chunk = unique_list[start:start + 500]
+      qstr = 'select hash, min(id) from {} where hash in ({}) group by hash'.format(table, ','.join(['?'] * len(chunk)))
+      id_map.update({row[0]: row[1] for row in db['c'].execute(qstr, chunk).fetchall()})
+
+    new_map = {}
+    for ix, (data, hash) in enumerate(zip(data_list, hash_list)):
+      if hash not in id_map and hash not in new_map:
+        new_map[hash] = dict(extra_list[ix] if extra_list else {}, data=data, hash=hash)
+
+    if new_map:
+      id_list = _many(table, list(new_map.values()))
+      id_map.update(zip(new_map.keys(), id_list))
+
+  return [id_map[hash] for hash in hash_list]
+
+def _index_name(table, expr):
+  return '{}_{}_idx'.format(table, re.sub('[^a-z0-9]+', '_', expr.lower()).strip('_'))
+
+def index_update(db):
+  for table, index_list in _INDEX.items():
+    wanted = {_index_name(table, expr): expr for expr in index_list}
+    existing = [row[0] for row in db['c'].execute("select name from sqlite_master where type = 'index' and tbl_name = ?", (table, )).fetchall()]
+
+    for name in existing:
+      # Only the ones that look like ours, the autoindexes and anything
+      # made by hand are left alone.
+      if name not in wanted and name.startswith(table + '_') and name.endswith('_idx'):
+        logging.info("Dropping index {}".format(name))
+        db['c'].execute('drop index if exists {}'.format(name))
+
+    for name, expr in wanted.items():
+      if name not in existing:
+        logging.info("Creating index {} on {}({})".format(name, table, expr))
+        try:
+          db['c'].execute('create index if not exists {} on {}({})'.format(name, table, expr))
+
+        except Exception as ex:
+          logging.warning("Failed to create index {} on {}({}): {}".format(name, table, expr, ex))
+
+  db['conn'].commit()
+
+def fts_update(db):
+  for table, column in _FTS.items():
+    fts = '{}_fts'.format(table)
+    view = '{}_text'.format(table)
+    existing = {row[0]: row[1] for row in db['c'].execute("select name, sql from sqlite_master where name like ? or name = ?", (fts + '%', view)).fetchall()}
+
+    # The index reads its content through a view that unpacks whatever
+    # pack() compressed. One that was made to read the table directly
+    # gets dropped, along with everything hanging off it, and rebuilt.
+    if fts in existing and "content='{}'".format(view) not in existing[fts]:
+      logging.info("Moving full text index {} onto {}".format(fts, view))
+      for name in [fts + '_ai', fts + '_ad', fts + '_au']:
+        db['c'].execute('drop trigger if exists {}'.format(name))
+      db['c'].execute('drop table if exists {}_vocab'.format(fts))
+      db['c'].execute('drop table if exists {}'.format(fts))
+      existing = {}
+
+    trigger_sql = {
+      fts + '_ai': "after insert on {0} begin insert into {1}(rowid, {2}) values (new.id, unpack(new.{2})); end",
+      fts + '_ad': "after delete on {0} begin insert into {1}({1}, rowid, {2}) values ('delete', old.id, unpack(old.{2})); end",
+      fts + '_au': "after update of {2} on {0} begin insert into {1}({1}, rowid, {2}) values ('delete', old.id, unpack(old.{2})); insert into {1}(rowid, {2}) values (new.id, unpack(new.{2})); end",
+    }
+
+    try:
+      if view not in existing:
+        db['c'].execute("create view if not exists {0} as select id, unpack({2}) as {2} from {1}".format(view, table, column))
+
+      rebuild = fts not in existing
+      if rebuild:
+        logging.info("Creating full text index {} on {}({})".format(fts, table, column))
+        db['c'].execute("create virtual table {} using fts5({}, content='{}', content_rowid='id', tokenize='porter unicode61')".format(fts, column, view))
+
+      for name, sql in trigger_sql.items():
+        if name not in existing:
+          # Whatever was written while the trigger wasn't there
+          # never made it into the index.
+          rebuild = True
+          db['c'].execute('create trigger if not exists {} {}'.format(name, sql.format(table, fts, column)))
+
+      if rebuild:
+        db['c'].execute("insert into {0}({0}) values ('rebuild')".format(fts))
+
+      if fts + '_vocab' not in existing:
+        db['c'].execute("create virtual table {0}_vocab using fts5vocab({0}, row)".format(fts))
+
+    except Exception as ex:
+      logging.warning("Failed to set up full text index {}: {}".format(fts, ex))
+
+  db['conn'].commit()
+
 def pragma_update(db):
   if '_PRAGMA' in globals():
     for name, value in _PRAGMA:
@@ -163,6 +557,8 @@ def upgrade():
   my_set = __builtins__['set']
   db = connect()
 
+  _columns_update()
+
   pragma_update(db)
 
   for table, schema in list(_SCHEMA.items()):
@@ -222,6 +618,11 @@ def upgrade():
       except Exception as ex:
         logging.warningn("Failed: {} ({})".format(drop_column_sql, ex))
 
+  # Rebuilding a table above takes its indexes and triggers with it
+  # so these always go last.
+  index_update(db)
+  fts_update(db)
+
 def map(row_list, table, db=None):
   # Using the schema of a table, map the row_list to a list of dicts.
   mapped = []
@@ -243,24 +644,38 @@ def map(row_list, table, db=None):
   return mapped
 
 
-def all(table, field_list='*', sort_by='id'):
-  # Returns all entries from the sqlite3 database for a given table. 
-
+def _all(table, field_list, sort_by, limit, offset, after):
   column_count = 1
   if type(field_list) is not str:
     column_count = len(field_list)
     field_list = ','.join(field_list)
 
-  query = run('select %s from %s order by %s asc' % (field_list, table, sort_by))
-  if column_count is 1 and field_list != '*':
+  where_string, where_values, tail = _page('', [], sort_by, limit, offset, after)
+  query = run('select %s from %s %s %s' % (field_list, table, where_string, tail), where_values, readonly=True)
+
+  return (query, column_count == 1 and field_list != '*')
+
+def all(table, field_list='*', sort_by='id', limit=None, offset=None, after=None):
+  # Returns all entries from the sqlite3 database for a given table. 
+  query, scalar = _all(table, field_list, sort_by, limit, offset, after)
+  if scalar:
     return [record[0] for record in query.fetchall()]
 
   else:
     return process([record for record in query.fetchall()], table, 'post')
 
+def all_iter(table, field_list='*', sort_by='id', limit=None, offset=None, after=None, batch=None):
+  query, scalar = _all(table, field_list, sort_by, limit, offset, after)
+  if scalar:
+    for record_list in _batches(query, batch):
+      yield from (record[0] for record in record_list)
+
+  else:
+    yield from _stream(query, table, batch)
+
 
 def schema(table, db=None):
-  existing_schema = run('pragma table_info({})'.format(table), db=db).fetchall()
+  existing_schema = run('pragma table_info({})'.format(table), db=db, readonly=True).fetchall()
   if existing_schema:
     return [str(row[1]) for row in existing_schema]
 
@@ -271,49 +686,65 @@ def disconnect(what):
   what['conn'].close()
   pass  
   
-def connect(db_file=None):
-  # A "singleton pattern" or some other fancy $10-world style of maintaining 
-  # the database connection throughout the execution of the script.
-  # Returns the database instance.
-  global _dbcount, _instance
-
-  id = threading.get_ident()
-
-  if id in _instance:
-    return _instance[id] 
-
-  timeout = float(os.environ.get('SQLTIMEOUTMS') or "5000.0") / 1000.0
+def _dbfile(db_file=None):
+  if db_file:
+    return db_file
 
   if 'DB' in os.environ:
-    default_db = os.environ['DB']
-    logging.debug("Using {} as the DB as specified in the DB shell env variable")
-  else:
-    default_db = 'config.db'
-    logging.debug("Using {} as the DB".format(default_db))
+    logging.debug("Using {} as the DB as specified in the DB shell env variable".format(os.environ['DB']))
+    return os.environ['DB']
 
-  if not db_file:
-    db_file = default_db
+  logging.debug("Using config.db as the DB")
+  return 'config.db'
 
-  #
-  # We don't have to worry about the different memory sharing models here.
-  # Really, just think about it ... it's totally irrelevant.
-  #
-
-  _instance[id] = {}
+def _open(db_file, same_thread=True):
+  timeout = float(os.environ.get('SQLTIMEOUTMS') or "5000.0") / 1000.0
 
   if not os.path.exists(db_file):
     sys.stderr.write("Info: Creating db file %s\n" % db_file)
 
-  conn = sqlite3.connect(db_file, timeout=timeout)
+  # Python's sqlite3 keeps this many prepared statements around per
+  # connection. The default of 128 is fine unless you've got a lot of
+  # different query shapes going.
+  cached_statements = int(os.environ.get('SQLSTATEMENTCACHE') or "128")
+
+  conn = sqlite3.connect(db_file, timeout=timeout, check_same_thread=same_thread, cached_statements=cached_statements)
   conn.row_factory = sqlite3.Row
 
+  # The full text index and its triggers need this to see the text
+  # inside compressed rows.
+  conn.create_function('unpack', 1, unpack, deterministic=True)
+
   if 'DEBUG' in os.environ:
     conn.set_trace_callback(logging.debug)
 
-  _instance[id].update({
+  return {
     'conn': conn,
     'c': conn.cursor()
-  })
+  }
+
+def connect(db_file=None):
+  # A "singleton pattern" or some other fancy $10-world style of maintaining 
+  # the database connection throughout the execution of the script.
+  # Returns the database instance.
+  global _dbcount, _instance
+
+  id = threading.get_ident()
+
+  # Thread idents get recycled once a thread exits, so make sure this
+  # is really ours and not one left over from a dead worker.
+  if id in _instance and _instance[id]['thread'] is threading.current_thread():
+    return _instance[id] 
+
+  default_db = _dbfile()
+  db_file = _dbfile(db_file)
+
+  #
+  # We don't have to worry about the different memory sharing models here.
+  # Really, just think about it ... it's totally irrelevant.
+  #
+  _instance[id] = _open(db_file)
+  _instance[id]['thread'] = threading.current_thread()
 
   if db_file == default_db and _dbcount == 0: 
 
@@ -324,11 +755,117 @@ def connect(db_file=None):
       _instance[id]['c'].execute("CREATE TABLE IF NOT EXISTS %s(%s)" % (table, dfn))
 
     _instance[id]['conn'].commit()
+    index_update(_instance[id])
+    fts_update(_instance[id])
 
   _dbcount += 1 
 
   return _instance[id]
 
+def _commit(db):
+  if _group:
+    _group['pending'] = 0
+  db['conn'].commit()
+
+def _written(db):
+  # Called after every write, with _lock held, to decide whether
+  # this is the time to pay for the commit.
+  if _depth > 0:
+    return
+
+  if _group:
+    _group['pending'] += 1
+    if _group['pending'] < _group['rows']:
+      return
+
+  _commit(db)
+
+@contextmanager
+def transaction():
+  # Everything written inside the block goes out in one commit, or
+  # not at all if it raises. Other writers wait until we're done.
+  # Reads inside the block are on their own connection so they only
+  # see these writes once the block commits.
+  #
+  # Each block is a savepoint, so if it raises only its own writes go.
+  # Blocks nested in it that finished stay part of it, and what the
+  # blocks around it and group_commit() are holding on to is left alone.
+  # That's other threads' writes, which they were already told made it.
+  global _depth
+  db = writer()
+
+  with _lock:
+    _depth += 1
+    savepoint = 'block_{}'.format(_depth)
+    db['c'].execute('savepoint {}'.format(savepoint))
+    try:
+      yield db
+
+    except:
+      _depth -= 1
+      try:
+        db['c'].execute('rollback to {}'.format(savepoint))
+        db['c'].execute('release {}'.format(savepoint))
+
+      except sqlite3.OperationalError:
+        # sqlite already rolled back the whole thing (disk full
+        # and the like), savepoint and all.
+        pass
+      raise
+
+    else:
+      _depth -= 1
+      db['c'].execute('release {}'.format(savepoint))
+      if _depth == 0:
+        _commit(db)
+
+def flush():
+  # Commit whatever group_commit() is holding on to.
+  if _writer is not None:
+    with _lock:
+      if _depth == 0 and _writer['conn'].in_transaction:
+        _commit(_writer)
+
+def group_commit(ms=50, rows=500):
+  # Opt-in. Instead of a commit per write, writes coming in from any
+  # thread pile up on the writer and get committed together every ms
+  # milliseconds or every rows writes, whichever comes first. You trade
+  # the last few ms of writes on a crash for a lot fewer fsyncs.
+  # group_commit(False) commits what's pending and turns it back off.
+  global _group
+
+  flush()
+
+  if ms is False:
+    _group = None
+    return
+
+  group = {'ms': ms, 'rows': rows, 'pending': 0}
+
+  def ticker():
+    while _group is group:
+      time.sleep(group['ms'] / 1000.0)
+      flush()
+
+  _group = group
+  threading.Thread(target=ticker, daemon=True).start()
+
+atexit.register(flush)
+_columns_update()
+
+def writer(db_file=None):
+  # The one connection every write goes through. It's shared across
+  # threads so it's only ever touched with _lock held.
+  global _writer
+
+  if _writer is None:
+    with _lock:
+      if _writer is None:
+        # Make sure the tables and pragmas are there first.
+        connect(db_file)
+        _writer = _open(_dbfile(db_file), same_thread=False)
+
+  return _writer
 
 
 def process(res, table, what):
@@ -347,7 +884,7 @@ def process(res, table, what):
         for k, v in _PROCESSOR[table].items():
           # If a pre/post is defined for this key
           # on this table then we do it
-          if what in v:
+          if what in v and row.get(k) is not None:
             row[k] = v[what](row[k], row)
 
         res[ix] = row
@@ -360,13 +897,209 @@ def process(res, table, what):
 def get(table, id = False):
   _checkForTable(table)
 
-  res = run("select * from {} where id = ?".format(table), (id, ))
+  sig = (table, 'get')
+  if sig not in _SQL:
+    _SQL[sig] = "select * from {} where id = ?".format(table)
+
+  res = run(_SQL[sig], (id, ), readonly=True)
 
   if res:
     return process(res.fetchone(), table, 'post')
 
 
-def range(table, start, end, field='*'):
+def _match(query, table):
+  # Free text from a person or a model isn't fts5 query syntax, a
+  # stray quote or hyphen is an error. So every word gets quoted and
+  # any of them can match, bm25 puts the rows with more of them first.
+  # Returns that and about how many rows it'll match, at most.
+  word_list = list(dict.fromkeys([word.lower() for word in re.findall(r'\w+', query or '')]))
+  if not word_list:
+    return None, 0
+
+  # Then the words that are everywhere get dropped, unless that's all
+  # there is in which case we keep the rarest one. max(id) stands in
+  # for the row count since count(*) is a full scan.
+  total = run('select max(id) from {}'.format(table), readonly=True).fetchone()[0] or 0
+  doc_map = {row[0]: row[1] for row in run('select term, doc from {}_fts_vocab where term in ({})'.format(table, ','.join(['?'] * len(word_list))), word_list, readonly=True).fetchall()}
+  # The vocab has the stemmed terms, so a word that isn't in it may
+  # well still match ('running' is 'run' in there). fts5 stems the
+  # query too, so those go in as they are.
+  keep_list = [word for word in word_list if doc_map.get(word, 0) <= total * _FTS_COMMON]
+  if not keep_list:
+    keep_list = [min(word_list, key=lambda word: doc_map.get(word, 0))]
+
+  return ' OR '.join(['"{}"'.format(word) for word in keep_list]), sum([doc_map.get(word, 0) for word in keep_list])
+
+def search(query, filters={}, limit=20, table='objects'):
+  # Keyword search over the full text index, best match first. filters
+  # is a where_dict like find() takes, 'meta.user' and friends included.
+  # Each result has the id, meta, its bm25 score (lower is better) and
+  # a snippet of data with the hits in [brackets].
+  #
+  # bm25 has to score every match to find the best ones, so without a
+  # filter it's as slow as the query's words are common: about a
+  # microsecond a match, 30ms typical and 130ms at the worst at a
+  # million rows (test/bench-objectdb-search.py). _FTS_COMMON is the
+  # knob for that.
+  fts = '{}_fts'.format(table)
+  match, estimate = _match(query, table)
+  if not match:
+    return []
+
+  where_string, where_values = _where(table, filters)
+
+  # Which end to start from, for a filter (see _FTS_NARROW). Counting
+  # stops at the point where the answer's no, so it's never more work
+  # than the search it's saving.
+  narrow = False
+  bound = estimate // _FTS_NARROW
+  if where_string and bound:
+    count_sig = (table, 'search-count', where_string)
+    if count_sig not in _SQL:
+      _SQL[count_sig] = 'select count(*) from (select 1 from {} where {} limit ?)'.format(table, where_string)
+    narrow = run(_SQL[count_sig], where_values + [bound], readonly=True).fetchone()[0] < bound
+
+  sig = (table, 'search', where_string, narrow)
+
+  if sig not in _SQL:
+    # Text that's been interned (see intern()) lives on a content row
+    # with no meta of its own, and a 'content' edge to it from each row
+    # that uses it. A hit on one of those counts as a hit on the rows
+    # that point at it, and those are what get filtered and returned.
+    # The content rows themselves (they're the ones with a hash) never
+    # are: they're shared by whoever sent the same text.
+    snippet = "snippet({0}, 0, '[', ']', '...', 16)".format(fts)
+
+    if where_string:
+      # The filter's placeholders come after the two below, and both
+      # halves use the same ones.
+      counter = iter(__builtins__['range'](3, 3 + where_string.count('?')))
+      where_string = re.sub(r'\?', lambda m: '?{}'.format(next(counter)), where_string)
+
+    if where_string and narrow:
+      # The few rows the filter wants go in a list up front, and then
+      # every match is a lookup in that rather than a trip to the table
+      # and through its meta. The +s keep sqlite from turning the list
+      # into a lookup per entry in it, into fts5 or the edge index,
+      # which is slower than going through every match.
+      _SQL[sig] = '''
+        with mine as materialized (select id from {1} where {2})
+        select o.id, o.meta, bm25({0}) as score, {3} as snippet
+        from {0} join {1} o on o.id = {0}.rowid
+        where {0} match ?1 and +{0}.rowid in mine and o.hash is null
+        union all
+        select o.id, o.meta, bm25({0}) as score, {3} as snippet
+        from {0} join relationship r on r.dest_id = {0}.rowid and r.kind = 'content'
+        join {1} o on o.id = r.src_id
+        where {0} match ?1 and +r.src_id in mine
+        order by score asc
+        limit ?2
+      '''.format(fts, table, where_string, snippet)
+
+    elif where_string:
+      # Let sqlite line the matches up against the table and filter as
+      # it goes.
+      _SQL[sig] = '''
+        select o.id, o.meta, bm25({0}) as score, {3} as snippet
+        from {0} join (select * from {1} where {2}) o on o.id = {0}.rowid
+        where {0} match ?1 and o.hash is null
+        union all
+        select o.id, o.meta, bm25({0}) as score, {3} as snippet
+        from {0} join relationship r on r.dest_id = {0}.rowid and r.kind = 'content'
+        join (select * from {1} where {2}) o on o.id = r.src_id
+        where {0} match ?1
+        order by score asc
+        limit ?2
+      '''.format(fts, table, where_string, snippet)
+
+    else:
+      # The ranking happens in fts5 on its own so the join and the
+      # snippets are only done for the handful of rows we hand back
+      # rather than everything that matched. Both are materialized:
+      # left to itself sqlite runs the match again for each half of
+      # the union, and that's the expensive part.
+      _SQL[sig] = '''
+        with top as materialized (
+          select rowid as id, bm25({0}) as score from {0}
+          where {0} match ?1
+          order by score
+          limit ?2
+        ),
+        hit as materialized (
+          select top.id, top.score, {2} as snippet
+          from top cross join {0} on {0}.rowid = top.id and {0} match ?1
+        )
+        select o.id, o.meta, hit.score as score, hit.snippet as snippet
+        from hit
+        join {1} o on o.id = hit.id and o.hash is null
+        union all
+        select o.id, o.meta, hit.score as score, hit.snippet as snippet
+        from hit
+        join relationship r on r.dest_id = hit.id and r.kind = 'content'
+        join {1} o on o.id = r.src_id
+        order by score asc
+        limit ?2
+      '''.format(fts, table, snippet)
+
+  query = run(_SQL[sig], [match, int(limit)] + where_values, readonly=True)
+  return process([record for record in query.fetchall()], table, 'post')
+
+def fts_optimize(table='objects'):
+  # Merges the index down. Worth doing after a big import.
+  run("insert into {0}_fts({0}_fts) values ('optimize')".format(table))
+
+def _step(direction):
+  # The recursive part of a walk for each way we're going. 'both' is
+  # the two of them side by side, sqlite runs those in the same pass.
+  if direction == 'both':
+    return ' union '.join([_step('out'), _step('in')])
+
+  # Edges with a kind, like a message pointing at its content, are
+  # references rather than part of the graph, so walks don't follow
+  # them. A system prompt shared by a thousand conversations would
+  # otherwise make them all two steps from each other.
+  here, there = _EDGE[direction]
+  return 'select r.{}, walk.depth + 1 from relationship r join walk on r.{} = walk.id where walk.depth < ? and r.kind is null'.format(there, here)
+
+def neighbors(id, direction='out'):
+  # The objects one edge away from id. direction is 'out' (id is the
+  # src_id), 'in' (id is the dest_id) or 'both'.
+  if direction == 'both':
+    return neighbors(id, 'out') + neighbors(id, 'in')
+
+  here, there = _EDGE[direction]
+  qstr = 'select o.* from relationship r join objects o on o.id = r.{} where r.{} = ? order by r.id asc'.format(there, here)
+  query = run(qstr, (id, ), readonly=True)
+  return process([record for record in query.fetchall()], 'objects', 'post')
+
+def walk(id, depth=2, direction='out', exact=False):
+  # Everything up to depth edges away from id in one query. Each object
+  # comes back once with a 'depth' key for how close it is. With exact
+  # you only get the ones exactly depth away, so a user -> project ->
+  # conversation graph gives you all the conversations with
+  # walk(user_id, 2, exact=True).
+  step = _step(direction)
+  qstr = '''
+    with recursive walk(id, depth) as (
+      select ?, 0
+      union
+      {}
+    )
+    select o.*, min(walk.depth) as depth from walk
+    join objects o on o.id = walk.id
+    group by o.id
+    having {}
+    order by depth asc, o.id asc
+  '''.format(step, 'min(walk.depth) = ?' if exact else 'min(walk.depth) > 0')
+
+  args = [id] + [depth] * step.count('?')
+  if exact:
+    args.append(depth)
+
+  query = run(qstr, args, readonly=True)
+  return process([record for record in query.fetchall()], 'objects', 'post')
+
+def _range(table, start, end, field):
   if type(start) is int:
     # if it's in milliseconds or if the year > 2514
     # (which would be truly remarkable)
@@ -374,12 +1107,65 @@ def range(table, start, end, field='*'):
       start /= 1000
       end /= 1000
 
-  query = run("select {} from {} where created_at >= datetime(?, 'unixepoch') and created_at <= datetime(?, 'unixepoch')".format(field, table), (start, end))
+  return run("select {} from {} where created_at >= datetime(?, 'unixepoch') and created_at <= datetime(?, 'unixepoch')".format(field, table), (start, end), readonly=True)
+
+def range(table, start, end, field='*'):
+  query = _range(table, start, end, field)
   return process([record for record in query.fetchall()], table, 'post')
   #return [[x for x in record] for record in query.fetchall()]
 
-def run(query, args=None, with_last=False, db=None):
-  global _lock
+def range_iter(table, start, end, field='*', batch=None):
+  yield from _stream(_range(table, start, end, field), table, batch)
+
+def _batches(query, batch=None):
+  while True:
+    record_list = query.fetchmany(batch or _batch)
+    if not record_list:
+      break
+    yield record_list
+
+def _stream(query, table, batch=None):
+  for record_list in _batches(query, batch):
+    for record in record_list:
+      yield Row(record, table)
+
+class Row(Mapping):
+  # A read-only dict-like wrapper around a sqlite3.Row. The _PROCESSOR
+  # post step for a column (json.loads on meta) only runs the first
+  # time that column is looked at. dict(row) gets you a plain dict.
+  __slots__ = ('_row', '_table', '_cache')
+
+  def __init__(self, row, table):
+    self._row = row
+    self._table = table
+    self._cache = {}
+
+  def __getitem__(self, key):
+    if key in self._cache:
+      return self._cache[key]
+
+    try:
+      value = self._row[key]
+    except IndexError:
+      raise KeyError(key)
+
+    post = _PROCESSOR.get(self._table, {}).get(key, {}).get('post')
+    if post and value is not None:
+      value = post(value, self)
+
+    self._cache[key] = value
+    return value
+
+  def __iter__(self):
+    return iter(self._row.keys())
+
+  def __len__(self):
+    return len(self._row)
+
+  def __repr__(self):
+    return repr(dict(self))
+
+def run(query, args=None, with_last=False, db=None, readonly=False):
   start = time.time()
   """
   if args is None:
@@ -388,23 +1174,36 @@ def run(query, args=None, with_last=False, db=None):
     $print "%d: %s (%s)" % (_dbcount, query, ', '.join([str(m) for m in args]))
   """
 
-  _lock.acquire()
+  # Reads on our own per-thread connection don't need the lock at all.
+  # An explicit db is someone else's business so we play it safe.
+  shared = _serial or not readonly or db is not None
+
   if db is None:
-    db = connect()
+    db = connect() if readonly else writer()
+
+  if shared:
+    _lock.acquire()
 
   res = None
+  last = None
 
   try:
-    if args is None:
-      res = db['c'].execute(query)
+    if readonly:
+      # A fresh cursor so two open result sets on the same thread
+      # don't clobber each other.
+      res = db['conn'].execute(query, args or ())
+
     else:
-      res = db['c'].execute(query, args)
+      if args is None:
+        res = db['c'].execute(query)
+      else:
+        res = db['c'].execute(query, args)
 
-    db['conn'].commit()
-    last = db['c'].lastrowid
+      last = db['c'].lastrowid
+      _written(db)
 
-    if db['c'].rowcount == 0:
-      raise Exception("0 rows")
+      if db['c'].rowcount == 0:
+        raise Exception("0 rows")
 
   except Exception as exc:
     logging.info("{} {}".format(query, exc))
@@ -412,11 +1211,11 @@ def run(query, args=None, with_last=False, db=None):
     raise exc
 
   finally:
-    _lock.release()
+    if shared:
+      _lock.release()
 
   if with_last:
     return (res, last)
 
   return res
 
-
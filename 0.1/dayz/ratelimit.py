@@ -0,0 +1,417 @@
+import os
+import re
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+import history
+
+# What one API key, and the team it's in, can use. Every completion has
+# to get past three things before it goes anywhere:
+#
+#   DAYZER_RPM            requests a minute per key
+#   DAYZER_TPM            tokens a minute per key
+#   DAYZER_STREAMS        completions in flight at once per key
+#   DAYZER_TEAM_STREAMS   the same, for everyone in a team together
+#
+# Any of them unset or 0 is no limit, and with none set nothing here
+# runs at all. The first two are token buckets that fill at the rate
+# and hold a minute's worth. A request is charged an estimate of its
+# prompt tokens on the way in, and the reply's, along with whatever the
+# estimate was off by, once it's done. That can leave the bucket owing
+# for a while. The in-flight ones are leases, which run out after
+# DAYZER_LEASE seconds (600) in case whoever held one never came back.
+#
+# Only keys on record get this far, see credentials.py, and their team
+# is the one on their record.
+#
+# Where the counts live is DAYZER_RATELIMIT: in this process (the
+# default), sqlite for every worker on the box (DAYZER_RATELIMIT_DB,
+# next to the db) or redis://host for everywhere.
+
+_RPM = int(os.environ.get('DAYZER_RPM') or 0)
+_TPM = int(os.environ.get('DAYZER_TPM') or 0)
+_STREAMS = int(os.environ.get('DAYZER_STREAMS') or 0)
+_TEAM_STREAMS = int(os.environ.get('DAYZER_TEAM_STREAMS') or 0)
+_LEASE = int(os.environ.get('DAYZER_LEASE') or 600)
+
+# What a full concurrency gate tells the client to wait, in seconds.
+# Nothing says when a stream will end, so it's a guess.
+_BUSY_RETRY = 1
+
+# Every bucket here is full again a minute after it was last touched,
+# unless it's owing, and one that's full is the same as none at all.
+# So the memory and sqlite backends drop what's been left alone this
+# long, checking at most every _PRUNE seconds. Redis expires them the
+# same way.
+_IDLE = 120
+_PRUNE = 60
+
+_stats = {'admitted': 0, 'limited_requests': 0, 'limited_tokens': 0, 'limited_streams': 0}
+
+
+class Limited(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"rate limited ({reason}), retry in {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def _fill(level, last, rate, capacity, now):
+    # Where a bucket that was at level at last time is now.
+    return min(capacity, level + (now - last) * rate)
+
+
+class MemoryBackend:
+    # Plain dicts under one lock, for a single worker.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.leases = {}
+        self.pruned = time.time()
+
+    def _prune(self, now):
+        # Under the lock.
+        if now - self.pruned < _PRUNE:
+            return
+        self.pruned = now
+        for name in [name for name, (level, last) in self.buckets.items() if last < now - _IDLE]:
+            del self.buckets[name]
+        for name in list(self.leases):
+            held = self.leases[name]
+            for doomed in [id for id, expires in held.items() if expires < now]:
+                del held[doomed]
+            if not held:
+                del self.leases[name]
+
+    def take(self, bucket_list, force=False):
+        """
+        bucket_list is [(name, rate a second, capacity, cost)]. Takes cost
+        out of each if they can all afford it and returns (0, None),
+        otherwise takes nothing and returns how long until they could and
+        the bucket that's furthest off. A cost bigger than the whole
+        bucket only needs it full. force takes it anyway, for charging
+        what's already been spent.
+        """
+        now = time.time()
+        with self.lock:
+            self._prune(now)
+            level_list = []
+            wait, short = 0, None
+            for name, rate, capacity, cost in bucket_list:
+                level, last = self.buckets.get(name, (capacity, now))
+                level = _fill(level, last, rate, capacity, now)
+                level_list.append(level)
+                need = min(cost, capacity)
+                if level < need and (need - level) / rate > wait:
+                    wait, short = (need - level) / rate, name
+
+            if wait and not force:
+                return (wait, short)
+
+            for (name, rate, capacity, cost), level in zip(bucket_list, level_list):
+                self.buckets[name] = (level - cost, now)
+            return (0, None)
+
+    def acquire(self, gate_list, lease):
+        # gate_list is [(name, limit)]: a lease on all of them, or none.
+        now = time.time()
+        with self.lock:
+            self._prune(now)
+            for name, limit in gate_list:
+                held = self.leases.setdefault(name, {})
+                for doomed in [id for id, expires in held.items() if expires < now]:
+                    del held[doomed]
+                if len(held) >= limit:
+                    return False
+
+            for name, limit in gate_list:
+                self.leases[name][lease] = now + _LEASE
+            return True
+
+    def release(self, gate_list, lease):
+        with self.lock:
+            for name, limit in gate_list:
+                held = self.leases.get(name)
+                if held is not None:
+                    held.pop(lease, None)
+                    if not held:
+                        del self.leases[name]
+
+
+class SqliteBackend:
+    """
+    The same in a file of its own, so every worker on the box shares
+    the counts. Each call is one immediate transaction, which is what
+    keeps two workers from both getting the last token.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=5, isolation_level=None)
+        self.conn.execute('pragma journal_mode = wal')
+        self.conn.execute('create table if not exists bucket(name text primary key, level real, last real)')
+        self.conn.execute('create table if not exists lease(name text, id text, expires real, primary key(name, id))')
+        self.pruned = 0
+
+    def _prune(self, now):
+        # Under the lock, inside the transaction.
+        if now - self.pruned < _PRUNE:
+            return
+        self.pruned = now
+        self.conn.execute('delete from bucket where last < ?', (now - _IDLE, ))
+        self.conn.execute('delete from lease where expires < ?', (now, ))
+
+    def take(self, bucket_list, force=False):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('begin immediate')
+            try:
+                self._prune(now)
+                level_list = []
+                wait, short = 0, None
+                for name, rate, capacity, cost in bucket_list:
+                    row = self.conn.execute('select level, last from bucket where name = ?', (name, )).fetchone()
+                    level = _fill(row[0], row[1], rate, capacity, now) if row else capacity
+                    level_list.append(level)
+                    need = min(cost, capacity)
+                    if level < need and (need - level) / rate > wait:
+                        wait, short = (need - level) / rate, name
+
+                if wait and not force:
+                    return (wait, short)
+
+                self.conn.executemany(
+                    'insert or replace into bucket(name, level, last) values(?, ?, ?)',
+                    [(name, level - cost, now) for (name, rate, capacity, cost), level in zip(bucket_list, level_list)]
+                )
+                return (0, None)
+            finally:
+                self.conn.execute('commit')
+
+    def acquire(self, gate_list, lease):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('begin immediate')
+            try:
+                for name, limit in gate_list:
+                    self.conn.execute('delete from lease where name = ? and expires < ?', (name, now))
+                    if self.conn.execute('select count(*) from lease where name = ?', (name, )).fetchone()[0] >= limit:
+                        return False
+
+                self.conn.executemany('insert into lease(name, id, expires) values(?, ?, ?)', [(name, lease, now + _LEASE) for name, limit in gate_list])
+                return True
+            finally:
+                self.conn.execute('commit')
+
+    def release(self, gate_list, lease):
+        with self.lock:
+            self.conn.executemany('delete from lease where name = ? and id = ?', [(name, lease) for name, limit in gate_list])
+
+
+# The bucket arithmetic again, for redis to do atomically. KEYS are the
+# buckets, ARGV is now, force, then rate, capacity and cost per bucket.
+_TAKE = """
+local now = tonumber(ARGV[1])
+local wait, short = 0, ''
+local level = {}
+for i, name in ipairs(KEYS) do
+    local rate, capacity, cost = tonumber(ARGV[3 * i]), tonumber(ARGV[3 * i + 1]), tonumber(ARGV[3 * i + 2])
+    local row = redis.call('HMGET', name, 'level', 'last')
+    level[i] = capacity
+    if row[1] then
+        level[i] = math.min(capacity, tonumber(row[1]) + (now - tonumber(row[2])) * rate)
+    end
+    local need = math.min(cost, capacity)
+    if level[i] < need and (need - level[i]) / rate > wait then
+        wait, short = (need - level[i]) / rate, name
+    end
+end
+if wait > 0 and ARGV[2] == '0' then
+    return {tostring(wait), short}
+end
+for i, name in ipairs(KEYS) do
+    local rate, capacity, cost = tonumber(ARGV[3 * i]), tonumber(ARGV[3 * i + 1]), tonumber(ARGV[3 * i + 2])
+    redis.call('HSET', name, 'level', tostring(level[i] - cost), 'last', ARGV[1])
+    redis.call('EXPIRE', name, math.ceil(capacity / rate) + 60)
+end
+return {'0', ''}
+"""
+
+# KEYS are the gates, ARGV is now, the lease, when it expires, then
+# the limit per gate.
+_ACQUIRE = """
+for i, name in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', name, '-inf', ARGV[1])
+    if redis.call('ZCARD', name) >= tonumber(ARGV[3 + i]) then
+        return 0
+    end
+end
+for i, name in ipairs(KEYS) do
+    redis.call('ZADD', name, ARGV[3], ARGV[2])
+    redis.call('EXPIRE', name, math.ceil(tonumber(ARGV[3]) - tonumber(ARGV[1])) + 60)
+end
+return 1
+"""
+
+class RedisBackend:
+    def __init__(self, url):
+        from redis.asyncio import Redis
+        self.redis = Redis.from_url(url)
+        self._take = self.redis.register_script(_TAKE)
+        self._acquire = self.redis.register_script(_ACQUIRE)
+
+    async def take(self, bucket_list, force=False):
+        argv = [time.time(), 1 if force else 0]
+        for name, rate, capacity, cost in bucket_list:
+            argv += [rate, capacity, cost]
+        wait, short = await self._take(keys=[f"dayzer:bucket:{name}" for name, rate, capacity, cost in bucket_list], args=argv)
+        short = short.decode('utf-8') if isinstance(short, bytes) else short
+        return (float(wait), short[len("dayzer:bucket:"):] or None)
+
+    async def acquire(self, gate_list, lease):
+        now = time.time()
+        return bool(await self._acquire(
+            keys=[f"dayzer:lease:{name}" for name, limit in gate_list],
+            args=[now, lease, now + _LEASE] + [limit for name, limit in gate_list]
+        ))
+
+    async def release(self, gate_list, lease):
+        for name, limit in gate_list:
+            await self.redis.zrem(f"dayzer:lease:{name}", lease)
+
+
+class Ticket:
+    # What admit() hands back: the lease, if there is one, and where to
+    # charge the rest of the tokens.
+    def __init__(self, limiter, user, gate_list, lease, estimate=0):
+        self.limiter = limiter
+        self.user = user
+        self.gate_list = gate_list
+        self.lease = lease
+        self.estimate = estimate
+
+    def charge(self, count, prompt=None):
+        # The reply's tokens, once we know them, and the difference
+        # between the prompt's estimate and what the upstream counted,
+        # if it said. That can be a refund. From the end of a stream,
+        # which isn't async, so it goes on the loop.
+        if prompt is not None:
+            count += prompt - self.estimate
+            self.estimate = prompt
+        if count and _TPM:
+            _later(self.limiter._call('take', [self.limiter.tpm(self.user, count)], True))
+
+    def release(self):
+        if self.lease:
+            lease, self.lease = self.lease, None
+            _later(self.limiter._call('release', self.gate_list, lease))
+
+    async def hold(self, chunk_iter):
+        # Passes a stream through, keeping the lease until it's over.
+        try:
+            async for chunk in chunk_iter:
+                yield chunk
+        finally:
+            self.release()
+
+
+class Limiter:
+    def __init__(self, backend=None):
+        if backend and backend.startswith('redis'):
+            self.backend = RedisBackend(backend)
+        elif backend == 'sqlite':
+            path = os.environ.get('DAYZER_RATELIMIT_DB') or re.sub(r'\.db$', '', os.environ.get('DB') or 'config.db') + '.limits.db'
+            self.backend = SqliteBackend(path)
+        else:
+            self.backend = MemoryBackend()
+
+    async def _call(self, method, *args):
+        if isinstance(self.backend, RedisBackend):
+            return await getattr(self.backend, method)(*args)
+        if isinstance(self.backend, SqliteBackend):
+            return await asyncio.get_running_loop().run_in_executor(None, getattr(self.backend, method), *args)
+        # Nothing in the memory one waits on anything.
+        return getattr(self.backend, method)(*args)
+
+    def tpm(self, user, cost):
+        return (f"tpm:{user}", _TPM / 60, _TPM, cost)
+
+    async def admit(self, api_key, body, team=None):
+        """
+        A Ticket if this request can go ahead, otherwise Limited with how
+        long to wait. Whoever gets a ticket has to release() it. api_key
+        has to be one on record, and team the one on its record: a key
+        nobody checked would get a fresh allowance of its own.
+        """
+        user = history.user_key(api_key)
+
+        # The gates first, they don't cost anything to turn someone away
+        # from. The buckets are only charged for requests that get in.
+        gate_list = []
+        if _STREAMS:
+            gate_list.append((f"streams:{user}", _STREAMS))
+        if _TEAM_STREAMS and team:
+            gate_list.append((f"team:{team}", _TEAM_STREAMS))
+
+        lease = None
+        if gate_list:
+            lease = uuid.uuid4().hex
+            if not await self._call('acquire', gate_list, lease):
+                _stats['limited_streams'] += 1
+                raise Limited('concurrent requests', _BUSY_RETRY)
+
+        prompt = estimate(body) if _TPM else 0
+        bucket_list = []
+        if _RPM:
+            bucket_list.append((f"rpm:{user}", _RPM / 60, _RPM, 1))
+        if _TPM:
+            bucket_list.append(self.tpm(user, prompt))
+
+        if bucket_list:
+            wait, short = await self._call('take', bucket_list)
+            if wait:
+                if lease:
+                    await self._call('release', gate_list, lease)
+                reason = 'tokens' if short.startswith('tpm:') else 'requests'
+                _stats[f"limited_{reason}"] += 1
+                raise Limited(f"{reason} per minute", wait)
+
+        _stats['admitted'] += 1
+        return Ticket(self, user, gate_list, lease, prompt)
+
+
+def estimate(body):
+    # The prompt's tokens, near enough to admit it by: about four
+    # characters each, which costs the same however long the prompt is.
+    # Ticket.charge() puts it right once the upstream says what it was.
+    message_list = body.get('messages') or []
+    return sum(len(history.content(message)) for message in message_list) // 4 + 4 * len(message_list)
+
+# Releases and charges still on their way to the backend.
+_pending = set()
+
+def _later(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+_limiter = None
+
+def enabled():
+    return bool(_RPM or _TPM or _STREAMS or _TEAM_STREAMS)
+
+def limiter():
+    global _limiter
+    if _limiter is None and enabled():
+        _limiter = Limiter(os.environ.get('DAYZER_RATELIMIT'))
+    return _limiter
+
+async def admit(api_key, body, team=None):
+    # A Ticket, or None when there are no limits.
+    if not enabled():
+        return None
+    return await limiter().admit(api_key, body, team)
+
+def stats():
+    return dict(_stats)
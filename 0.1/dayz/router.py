@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import httpx
+import clients
+
+# Where completions go. Each model has a pool of upstreams that can
+# serve it, and for every request the pool is tried best first: lowest
+# expected wait for the kind of request (time to first token when it's
+# streamed, the whole round trip when it's not), scaled up by how busy
+# the upstream is and how often it's been failing lately. All of those
+# are EWMAs, kept per upstream.
+#
+# A 429, a 5xx or not being able to connect moves on to the next one,
+# which is always before the client's seen a byte since streams only
+# count as started once their first chunk is in. A request that's taking
+# much longer than usual gets hedged: the next upstream is tried too and
+# whichever answers first wins.
+#
+# The model's pool comes first, then the pools of the models in the
+# request's models list, in that order (docs/specs.md).
+#
+# DAYZER_UPSTREAMS is the pools, as JSON or a path to a JSON file:
+#
+#   {
+#     "upstreams": {
+#       "local": {"url": "http://localhost:8080/"},
+#       "openrouter": {"url": "https://openrouter.ai/api/v1/", "key": "OPENROUTER_API_KEY"},
+#       "openai": {"url": "https://api.openai.com/v1/", "key": "OPENAI_API_KEY"}
+#     },
+#     "models": {
+#       "gpt-4o": ["openai", {"upstream": "openrouter", "model": "openai/gpt-4o"}],
+#       "*": ["local"]
+#     }
+#   }
+#
+# key is the environment variable with the upstream's API key, without
+# one it gets the upstream key on the caller's record in auth_db. Models that aren't listed
+# go to "*", or to every upstream if there's no "*". Without
+# DAYZER_UPSTREAMS it's the one upstream on localhost:8080.
+#
+#   DAYZER_HEDGE   hedge after this many times the usual wait (3), 0 is never
+
+UPSTREAM = "http://localhost:8080/"
+
+# Statuses that say try somewhere else, rather than that the request
+# is wrong.
+RETRY = (408, 429, 500, 502, 503, 504)
+
+_ALPHA = 0.2
+
+_HEDGE = float(os.environ.get('DAYZER_HEDGE') or 3)
+# Never sooner than this (seconds), however quick the upstream usually is.
+_HEDGE_MIN = 0.5
+# At most this many attempts running at once, the first one included.
+_HEDGE_PARALLEL = 2
+
+# How long an upstream is left alone after it said 429 without saying
+# for how long, or couldn't be reached.
+_COOLDOWN = 5
+
+_stats = {'requests': 0, 'failovers': 0, 'hedges': 0}
+
+
+def _ewma(old, new):
+    return new if old is None else old + _ALPHA * (new - old)
+
+
+class Failed(Exception):
+    # An upstream answered with one of RETRY. body is what it said, so
+    # if it was the last one left the client gets it as it was.
+    def __init__(self, status_code, body=b'', retry_after=None):
+        super().__init__(f"upstream returned {status_code}")
+        self.status_code = status_code
+        self.body = body
+        self.retry_after = retry_after
+
+
+def retryable(ex):
+    if isinstance(ex, Failed):
+        return True
+    if isinstance(ex, (httpx.TransportError, ConnectionError, asyncio.TimeoutError)):
+        return True
+    # litellm's exceptions carry the upstream's status.
+    return getattr(ex, 'status_code', None) in RETRY
+
+
+class Upstream:
+    def __init__(self, name, url, key=None):
+        self.name = name
+        self.url = url
+        self.key = key
+        self.latency = None
+        self.ttft = None
+        self.errors = 0.0
+        self.in_flight = 0
+        self.down_until = 0
+        self.requests = 0
+        self.failures = 0
+
+    def api_key(self, caller_key):
+        # '' rather than None when there's neither, or litellm and openai
+        # go and send OPENAI_API_KEY, ours, on the caller's behalf.
+        return (os.environ.get(self.key) if self.key else caller_key) or ''
+
+    def client(self):
+        return clients.client('upstream', self.url)
+
+    def expected(self, stream):
+        return self.ttft if stream else self.latency
+
+    def score(self, stream):
+        # Nothing known yet counts as quick, so new upstreams get tried.
+        return ((self.expected(stream) or 0) + 0.05) * (1 + self.in_flight) / max(0.05, 1 - self.errors)
+
+    def down(self):
+        return self.down_until > time.time()
+
+    def succeeded(self, took, stream):
+        self.requests += 1
+        self.errors = _ewma(self.errors, 0)
+        self.waited(took, stream)
+
+    def waited(self, took, stream):
+        # Also for a hedge that lost: how long it took without answering
+        # is less than it would have, but it's a lot closer than the
+        # quick answers that got it picked in the first place.
+        if stream:
+            self.ttft = _ewma(self.ttft, took)
+        else:
+            self.latency = _ewma(self.latency, took)
+
+    def failed(self, ex):
+        self.requests += 1
+        self.failures += 1
+        self.errors = _ewma(self.errors, 1)
+        status_code = getattr(ex, 'status_code', None)
+        if status_code == 429 or status_code is None:
+            self.down_until = time.time() + (getattr(ex, 'retry_after', None) or _COOLDOWN)
+
+    def stats(self):
+        return {
+            'url': self.url, 'latency': self.latency, 'ttft': self.ttft, 'errors': round(self.errors, 3),
+            'in_flight': self.in_flight, 'requests': self.requests, 'failures': self.failures, 'down': self.down()
+        }
+
+
+class Router:
+    def __init__(self, config):
+        self.upstreams = {
+            name: Upstream(name, spec['url'], spec.get('key'))
+            for name, spec in (config.get('upstreams') or {}).items()
+        }
+        self.models = {}
+        for model, pool in (config.get('models') or {}).items():
+            self.models[model] = [
+                (entry, None) if isinstance(entry, str) else (entry['upstream'], entry.get('model'))
+                for entry in pool
+            ]
+
+    def pool(self, model):
+        # [(upstream, the model name it knows it by)]
+        entry_list = self.models.get(model) or self.models.get('*') or [(name, None) for name in self.upstreams]
+        return [(self.upstreams[name], alias or model) for name, alias in entry_list if name in self.upstreams]
+
+    def targets(self, body):
+        """
+        Everywhere this request could go, in the order to try them: each
+        model's pool best first, the request's model before the ones in
+        its models list. Upstreams that are cooling off go to the back.
+        """
+        stream = bool(body.get('stream'))
+        target_list = []
+        seen = set()
+        for model in [body.get('model')] + list(body.get('models') or []):
+            for upstream, alias in sorted(self.pool(model), key=lambda target: target[0].score(stream)):
+                if (upstream.name, alias) not in seen:
+                    seen.add((upstream.name, alias))
+                    target_list.append((upstream, alias))
+
+        return [target for target in target_list if not target[0].down()] + [target for target in target_list if target[0].down()]
+
+    def hedge_after(self, upstream, stream):
+        expected = upstream.expected(stream)
+        if not _HEDGE or expected is None:
+            return None
+        return max(_HEDGE_MIN, _HEDGE * expected)
+
+    async def route(self, body, attempt, discard=None):
+        """
+        Calls attempt(upstream, model) down the list of targets until one
+        works and returns (upstream, what it returned). attempt raises to
+        say that one didn't work; if it's retryable() the next one gets a
+        go, anything else goes straight back to the caller. discard(result)
+        cleans up after a hedge that answered but lost.
+        """
+        stream = bool(body.get('stream'))
+        target_list = self.targets(body)
+        if not target_list:
+            raise Failed(503, b'{"error": "no upstream for this model"}')
+
+        _stats['requests'] += 1
+        running = {}
+        last = None
+        try:
+            while target_list or running:
+                if target_list and not running:
+                    if last is not None:
+                        _stats['failovers'] += 1
+                    self._start(running, target_list.pop(0), attempt)
+
+                timeout = None
+                if target_list and len(running) < _HEDGE_PARALLEL:
+                    upstream, started = list(running.values())[-1]
+                    hedge_after = self.hedge_after(upstream, stream)
+                    if hedge_after is not None:
+                        timeout = max(0, started + hedge_after - time.time())
+
+                done, pending = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logging.info(f"Hedging {upstream.name} after {hedge_after:.2f}s")
+                    _stats['hedges'] += 1
+                    self._start(running, target_list.pop(0), attempt)
+                    continue
+
+                winner = None
+                for task in done:
+                    upstream, started = running.pop(task)
+                    upstream.in_flight -= 1
+                    try:
+                        result = task.result()
+                    except Exception as ex:
+                        if not retryable(ex):
+                            raise
+                        logging.warning(f"Upstream {upstream.name} failed: {ex}")
+                        upstream.failed(ex)
+                        last = ex
+                        continue
+
+                    upstream.succeeded(time.time() - started, stream)
+                    if winner is None:
+                        winner = (upstream, result)
+                    elif discard:
+                        await discard(result)
+
+                if winner:
+                    return winner
+
+            raise last
+
+        finally:
+            for task, (upstream, started) in running.items():
+                upstream.in_flight -= 1
+                upstream.waited(time.time() - started, stream)
+                task.cancel()
+                if discard:
+                    task.add_done_callback(lambda task: task.cancelled() or task.exception() or asyncio.ensure_future(discard(task.result())))
+
+    def _start(self, running, target, attempt):
+        upstream, model = target
+        upstream.in_flight += 1
+        running[asyncio.ensure_future(attempt(upstream, model))] = (upstream, time.time())
+
+    def stats(self):
+        return {name: upstream.stats() for name, upstream in self.upstreams.items()}
+
+
+async def peek(chunk_iter):
+    """
+    Waits for the first chunk of a stream and hands back an iterator
+    that starts with it. Until then nothing's gone to the client, so a
+    stream that breaks before its first chunk can still go elsewhere.
+    """
+    chunk_iter = chunk_iter.__aiter__()
+    try:
+        first = await chunk_iter.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def rest():
+        if first is None:
+            return
+        yield first
+        async for chunk in chunk_iter:
+            yield chunk
+
+    return rest()
+
+
+_router = None
+
+def load():
+    config = os.environ.get('DAYZER_UPSTREAMS')
+    if not config:
+        return {'upstreams': {'default': {'url': UPSTREAM}}, 'models': {'*': ['default']}}
+    if not config.lstrip().startswith('{'):
+        with open(config) as f:
+            config = f.read()
+    return json.loads(config)
+
+def router():
+    global _router
+    if _router is None:
+        _router = Router(load())
+    return _router
+
+async def route(body, attempt, discard=None):
+    return await router().route(body, attempt, discard)
+
+def stats():
+    return dict(_stats, upstreams=router().stats())
@@ -0,0 +1,184 @@
+import json
+import logging
+
+# For streamed completions we forward the upstream bytes as they are and
+# only pick out what Dayzer needs for itself: the assistant text and any
+# tool calls. Nothing in here sits between a chunk arriving and it going
+# back out to the client.
+
+
+class SSEParser:
+    """
+    Incremental server-sent events parser. Feed it bytes in whatever
+    pieces they arrive in and it hands back the data of every event
+    that's been completed so far, as str. Comments, event: and id:
+    fields are skipped, Dayzer has no use for them.
+    """
+    def __init__(self):
+        self.buffer = b''
+        self.data = []
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        if b'\n' not in chunk and b'\r' not in chunk:
+            return []
+
+        buffer = self.buffer
+        if b'\r' in buffer:
+            # A trailing \r might be the first half of a \r\n, so it
+            # waits for the next chunk.
+            cut = len(buffer) - 1 if buffer.endswith(b'\r') else len(buffer)
+            line_list = buffer[:cut].replace(b'\r\n', b'\n').replace(b'\r', b'\n').split(b'\n')
+            line_list[-1] += buffer[cut:]
+        else:
+            line_list = buffer.split(b'\n')
+        # Whatever's after the last newline is a partial line.
+        self.buffer = line_list.pop()
+
+        event_list = []
+        for line in line_list:
+            if not line:
+                if self.data:
+                    event_list.append(b'\n'.join(self.data).decode('utf-8', 'replace'))
+                    self.data = []
+            elif line.startswith(b'data:'):
+                self.data.append(line[6:] if line.startswith(b'data: ') else line[5:])
+
+        return event_list
+
+    def close(self):
+        # A stream that ends without the final blank line still counts.
+        event_list = self.feed(b'\n\n') if self.buffer or self.data else []
+        return event_list
+
+
+class Accumulator:
+    """
+    Builds the assistant message back up out of chat.completion.chunk
+    events: the content deltas joined together and the tool calls with
+    their argument fragments put back in order. Only the first choice
+    is kept, that's the only one Dayzer ever asks for.
+
+    feed() only holds on to the event. The json gets decoded, all of it
+    in one go, the first time anything is asked for, which with tee()
+    is after the last byte has gone out.
+    """
+    def __init__(self):
+        self.pending = []
+        self.content = []
+        self.tool_calls = {}
+        self.role = 'assistant'
+        self.done = False
+        self._finish_reason = None
+        self._model = None
+        self._id = None
+        self._usage = None
+
+    def feed(self, data):
+        if data == '[DONE]':
+            self.done = True
+        else:
+            self.pending.append(data)
+
+    def _apply(self):
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, []
+        try:
+            chunk_list = json.loads('[' + ','.join(pending) + ']')
+        except ValueError:
+            chunk_list = []
+            for data in pending:
+                try:
+                    chunk_list.append(json.loads(data))
+                except ValueError:
+                    logging.warning(f"Skipping an event that isn't json: {data[:80]}")
+
+        for chunk in chunk_list:
+            if isinstance(chunk, dict):
+                self._chunk(chunk)
+
+    def _chunk(self, chunk):
+        self._id = self._id or chunk.get('id')
+        self._model = self._model or chunk.get('model')
+        if chunk.get('usage'):
+            self._usage = chunk['usage']
+
+        for choice in chunk.get('choices') or []:
+            if choice.get('index', 0) != 0:
+                continue
+
+            if choice.get('finish_reason'):
+                self._finish_reason = choice['finish_reason']
+
+            delta = choice.get('delta') or {}
+            if delta.get('role'):
+                self.role = delta['role']
+            if delta.get('content'):
+                self.content.append(delta['content'])
+
+            for call in delta.get('tool_calls') or []:
+                index = call.get('index', len(self.tool_calls))
+                current = self.tool_calls.setdefault(index, {'id': None, 'type': 'function', 'function': {'name': '', 'arguments': ''}})
+                if call.get('id'):
+                    current['id'] = call['id']
+                if call.get('type'):
+                    current['type'] = call['type']
+
+                function = call.get('function') or {}
+                if function.get('name'):
+                    current['function']['name'] += function['name']
+                if function.get('arguments'):
+                    current['function']['arguments'] += function['arguments']
+
+    @property
+    def id(self):
+        self._apply()
+        return self._id
+
+    @property
+    def model(self):
+        self._apply()
+        return self._model
+
+    @property
+    def finish_reason(self):
+        self._apply()
+        return self._finish_reason
+
+    @property
+    def usage(self):
+        self._apply()
+        return self._usage
+
+    def message(self):
+        self._apply()
+        message = {'role': self.role, 'content': ''.join(self.content) or None}
+        if self.tool_calls:
+            message['tool_calls'] = [self.tool_calls[index] for index in sorted(self.tool_calls)]
+        return message
+
+
+async def tee(byte_iter, on_done=None):
+    """
+    Yields the upstream bytes untouched. Parsing happens after each
+    chunk has been handed on, and once the stream is over on_done gets
+    the Accumulator, if the stream got that far.
+    """
+    parser = SSEParser()
+    accumulator = Accumulator()
+
+    async for chunk in byte_iter:
+        yield chunk
+        for data in parser.feed(chunk):
+            accumulator.feed(data)
+
+    for data in parser.close():
+        accumulator.feed(data)
+
+    if on_done:
+        try:
+            on_done(accumulator)
+        except Exception as ex:
+            logging.warning(f"Handling the finished stream failed: {ex}")
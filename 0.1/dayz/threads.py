@@ -0,0 +1,226 @@
+import re
+import json
+import time
+import importlib
+import history
+
+objectdb = importlib.import_module('object-db')
+
+# Conversations as threads and topics, worked out as they're written
+# rather than every time someone asks. history.persist() puts every
+# message in a thread, meta.thread being the id of the thread's row, and
+# keeps that row's count and last message up to date. A new conversation
+# starts a thread; one that carries on from a stored message joins that
+# message's thread. A thread's topic is the repo it's about if we know
+# it, else the first line of the first thing the user said, so threads
+# that open the same way end up together.
+#
+# Both are rows in objects with no data of their own:
+#
+#   thread  meta {type: 'thread', user, topic, summary, first, last,
+#           count, started, updated}
+#   topic   meta {type: 'topic', user, topic, threads, updated}
+#
+# and there's a topic row per user and topic, so listing someone's
+# topics is one indexed query (see _INDEX in object-db.py) however many
+# messages they've got.
+#
+# Everything that writes runs inside history.persist()'s transaction,
+# so the lookups go through the writer, same as objectdb.intern(): rows
+# the batch wrote a moment ago aren't on the readers yet.
+
+# A topic is at most this many characters, a summary this many.
+_TOPIC = 60
+_SUMMARY = 200
+
+# Pages, for the MCP tools.
+PAGE = 50
+MAX_BYTES = 16384
+
+
+def _line(text, size):
+    # The first line with anything in it, leaving out anything in tags
+    # (context that's been put in front of what they said, mostly).
+    text = re.sub(r'<([A-Za-z][\w-]*)[^>]*>.*?</\1>', ' ', text or '', flags=re.S)
+    for line in re.sub(r'<[^>]+>', ' ', text).splitlines():
+        line = ' '.join(line.split())
+        if line:
+            return line if len(line) <= size else line[:size - 1].rstrip() + '…'
+    return ''
+
+def topic(body_list, role_list, meta):
+    if meta.get('repo'):
+        return meta['repo']
+    for body, role in zip(body_list, role_list):
+        if role == 'user' and _line(body, _TOPIC):
+            return _line(body, _TOPIC)
+    return 'untitled'
+
+def _meta(db, id):
+    row = db['c'].execute('select meta from objects where id = ?', (id, )).fetchone()
+    return json.loads(row[0]) if row else None
+
+def _set_meta(db, id, meta):
+    db['c'].execute('update objects set meta = ? where id = ?', (json.dumps(meta), id))
+
+def of(message_id):
+    # The thread a stored message is in. None for messages written
+    # before there were threads, which makes what follows a thread of
+    # its own.
+    with objectdb.transaction() as db:
+        row = db['c'].execute("select json_extract(meta, '$.thread') from objects where id = ?", (message_id, )).fetchone()
+    return row[0] if row else None
+
+def start(body_list, role_list, meta):
+    # A new thread, and its topic bumped or made. Returns the thread's id.
+    user = meta.get('user')
+    name = topic(body_list, role_list, meta)
+    now = int(time.time())
+    first = next((body for body, role in zip(body_list, role_list) if role == 'user'), body_list[0] if body_list else '')
+
+    with objectdb.transaction() as db:
+        id_list = objectdb.insert_many('objects', [{'meta': {
+            'type': 'thread', 'user': user, 'topic': name, 'summary': _line(first, _SUMMARY),
+            'first': None, 'last': None, 'count': 0, 'started': now, 'updated': now
+        }}])
+        if id_list is None:
+            raise Exception("insert_many failed")
+
+        row = db['c'].execute(
+            "select id, meta from objects where json_extract(meta, '$.type') = 'topic' and json_extract(meta, '$.user') is ? and json_extract(meta, '$.topic') = ? limit 1",
+            (user, name)
+        ).fetchone()
+        if row:
+            topic_meta = json.loads(row[1])
+            topic_meta.update(threads=topic_meta.get('threads', 0) + 1, updated=now)
+            _set_meta(db, row[0], topic_meta)
+        elif objectdb.insert_many('objects', [{'meta': {'type': 'topic', 'user': user, 'topic': name, 'threads': 1, 'updated': now}}]) is None:
+            raise Exception("insert_many failed")
+
+    return id_list[0]
+
+def add(thread_id, id_list):
+    # Messages id_list were just written to the thread.
+    if not id_list:
+        return
+    with objectdb.transaction() as db:
+        thread_meta = _meta(db, thread_id)
+        if thread_meta is None:
+            return
+        thread_meta.update(
+            first=thread_meta.get('first') or id_list[0], last=id_list[-1],
+            count=thread_meta.get('count', 0) + len(id_list), updated=int(time.time())
+        )
+        _set_meta(db, thread_id, thread_meta)
+
+
+# Reading, for the MCP tools. Newest first where it's a list, the last
+# id of a page being the cursor for the next one, so a page doesn't
+# move when someone writes more. Topics go by when they were last
+# written to instead, see topics(). A page is 1 to PAGE long whatever
+# was asked for, and a cursor we didn't hand out is a ValueError.
+
+def _limit(limit):
+    return max(1, min(limit, PAGE))
+
+def _parts(cursor, count):
+    # The numbers in a cursor, "1:2" style, up to count of them.
+    try:
+        part_list = [int(part) for part in str(cursor).split(':')]
+    except ValueError:
+        part_list = []
+    if not 1 <= len(part_list) <= count or min(part_list) < 0:
+        raise ValueError(f"bad cursor {cursor!r}")
+    return part_list
+
+def _next(row_list, limit):
+    return row_list[-1]['id'] if row_list and len(row_list) == limit else None
+
+def topics(user, cursor=None, limit=PAGE):
+    # Most recently written to first, so that's meta.updated rather
+    # than id, with id to break ties. The cursor is both of the last
+    # one, "updated:id". A topic that gets written to while someone's
+    # paging goes back to the top, where they've already been.
+    limit = _limit(limit)
+    updated, last = (None, None)
+    if cursor:
+        part_list = _parts(cursor, 2)
+        if len(part_list) != 2:
+            raise ValueError(f"bad cursor {cursor!r}")
+        updated, last = part_list
+    row_list = objectdb.run(
+        "select id, meta from objects where json_extract(meta, '$.type') = 'topic' and json_extract(meta, '$.user') is ?"
+        " and (?2 is null or json_extract(meta, '$.updated') < ?2 or (json_extract(meta, '$.updated') = ?2 and id < ?3))"
+        " order by json_extract(meta, '$.updated') desc, id desc limit ?4",
+        (user, updated, last, limit), readonly=True
+    ).fetchall()
+    meta_list = [(row[0], json.loads(row[1])) for row in row_list]
+    next_cursor = f"{meta_list[-1][1].get('updated') or 0}:{meta_list[-1][0]}" if meta_list and len(meta_list) == limit else None
+    return ([{'topic': meta['topic'], 'threads': meta.get('threads', 0), 'updated': meta.get('updated')} for id, meta in meta_list], next_cursor)
+
+def by_topic(user, name, cursor=None, limit=PAGE):
+    limit = _limit(limit)
+    cursor = _parts(cursor, 1)[0] if cursor else None
+    row_list = objectdb.find('objects', {'meta.type': 'thread', 'meta.user': user, 'meta.topic': name}, 'id, meta', limit=limit, before=cursor) or []
+    return ([dict(row['meta'], id=row['id']) for row in row_list], _next(row_list, limit))
+
+def thread(user, thread_id):
+    # The thread's row if it's this user's, None if not.
+    row = objectdb.get('objects', thread_id)
+    if row and row['meta'].get('type') == 'thread' and row['meta'].get('user') == user:
+        return dict(row['meta'], id=row['id'])
+
+def messages(thread_id, cursor=None, max_bytes=MAX_BYTES, batch=PAGE):
+    """
+    The thread's messages in order, from the cursor on, as many as fit
+    in max_bytes of text (utf-8), and the cursor for the rest, None if
+    that was all of it. There's always at least some of one: a message
+    bigger than max_bytes comes a piece at a time, 'truncated' being
+    how many bytes of it are still to come and 'offset' where in it a
+    later piece starts. The cursor is "id", after message id, or
+    "id:offset", offset bytes into message id.
+    """
+    message_list = []
+    used = 0
+    part_list = _parts(cursor, 2) if cursor else [0]
+    last, offset = part_list[0], (part_list[1:] or [0])[0]
+    # Starting partway through a message means starting from it.
+    after = last - 1 if offset else last
+    while True:
+        row_list = objectdb.run(
+            "select id, data, meta from objects where json_extract(meta, '$.thread') = ? and id > ? order by id limit ?",
+            (thread_id, after, batch), readonly=True
+        ).fetchall()
+        row_list = history.resolve(objectdb.process(row_list, 'objects', 'post') or [])
+
+        for row in row_list:
+            data = (row.get('data') or '').encode('utf-8')
+            skip = offset if row['id'] == last else 0
+            data = data[skip:]
+            size = len(data)
+            if message_list and used + size > max_bytes:
+                return message_list, str(after)
+
+            message = {'id': row['id'], 'role': row['meta'].get('role')}
+            if size > max_bytes:
+                # As much as fits without splitting a character, and at
+                # least one of them so the cursor always moves.
+                text = data[:max_bytes].decode('utf-8', 'ignore') or data.decode('utf-8')[:1]
+                sent = len(text.encode('utf-8'))
+                message.update(content=text, truncated=size - sent)
+            else:
+                message.update(content=data.decode('utf-8'))
+            if skip:
+                message['offset'] = skip
+            for key in ('name', 'tool_calls', 'tool_call_id'):
+                if row['meta'].get(key):
+                    message[key] = row['meta'][key]
+
+            message_list.append(message)
+            if message.get('truncated'):
+                return message_list, f"{row['id']}:{skip + sent}"
+            used += size
+            after = row['id']
+
+        if len(row_list) < batch:
+            return message_list, None
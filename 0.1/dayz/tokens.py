@@ -0,0 +1,66 @@
+import math
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# Token counts. Stored messages get theirs counted once, when they're
+# written (objects.tokens), so nothing here should be running over the
+# same text twice: counts for text we've just seen are kept by hash, and
+# hashing is a lot cheaper than tokenizing.
+#
+# tiktoken's cl100k_base if it's installed, which is close enough for
+# budgeting against any of the models in inject.py. Otherwise it's the
+# usual four characters a token.
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('cl100k_base')
+except Exception as ex:
+    logging.info(f"No tiktoken ({ex}), estimating token counts")
+    _encoding = None
+
+_seen = OrderedDict()
+_seen_size = 50000
+_lock = threading.Lock()
+
+
+def _count(text):
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / 4)
+
+def count(text):
+    if not text:
+        return 0
+
+    # Short strings cost less to count than to look up.
+    if len(text) < 256:
+        return _count(text)
+
+    key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    with _lock:
+        if key in _seen:
+            _seen.move_to_end(key)
+            return _seen[key]
+
+    tokens = _count(text)
+    with _lock:
+        _seen[key] = tokens
+        while len(_seen) > _seen_size:
+            _seen.popitem(last=False)
+    return tokens
+
+def message(message):
+    # What a chat message costs: its text, any tool calls, and a few
+    # tokens of framing for the role and separators.
+    content = message.get('content')
+    if isinstance(content, list):
+        content = '\n'.join(part.get('text', '') for part in content if isinstance(part, dict) and part.get('type') == 'text')
+
+    tokens = 4 + count(content or '')
+    if message.get('tool_calls'):
+        for call in message['tool_calls']:
+            function = call.get('function') or {}
+            tokens += count(function.get('name') or '') + count(function.get('arguments') or '')
+    return tokens
@@ -1,7 +1,21 @@
-def get_conversations_from(context, query): 
+import importlib
+
+objectdb = importlib.import_module('object-db')
+
+def get_conversations_from(context, query, limit=10): 
     """
     get contextual conversations from the user
     """
+    # The context is either a bag of extra keywords or, per
+    # docs/toolcalls.md, something like {repo:, files: [...]}.
+    filters = {}
+    if isinstance(context, dict):
+        if context.get('repo'):
+            filters['meta.repo'] = context['repo']
+    elif context:
+        query = '{} {}'.format(query, context)
+
+    return objectdb.search(query, filters, limit=limit)
  
 
 def establish_context():
@@ -1,52 +1,85 @@
 from fastmcp import FastMCP
-from typing import List
-import random
+from typing import Any, Dict, Optional
+import importlib
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dayz'))
+objectdb = importlib.import_module('object-db')
+import threads
 
 mcp = FastMCP("ContextSearchMCP")
 
-# Simulated conversation threads
-FAKE_DB = {
-    "user123": {
-        "LLM Proxy Design": [
-            {"id": "thread1", "summary": "Discussed initial architecture of proxy"},
-            {"id": "thread2", "summary": "Explored performance optimizations"}
-        ],
-        "Git-backed Threads": [
-            {"id": "thread3", "summary": "Talked about versioning chat logs with git"}
-        ]
-    }
-}
-
-THREAD_CONTENT = {
-    "thread1": "Conversation log about building a basic proxy with auth/token relay...",
-    "thread2": "Conversation log discussing FastAPI performance tuning...",
-    "thread3": "Log about designing a git-backed history system..."
-}
+# Topics and threads are worked out as conversations get stored (see
+# dayz/threads.py), so these are a page of one indexed query each. Lists
+# are newest first; pass back the cursor you got for the next page, no
+# cursor means that was the last of it. user_id is the one history.py
+# stores, history.user_key() of their API key. A page is 1 to
+# threads.PAGE long, and a cursor that isn't one we handed out gets an
+# error back rather than a page.
 
 @mcp.tool()
-def list_topics(user_id: str) -> List[str]:
+def list_topics(user_id: str, cursor: Optional[str] = None, limit: int = threads.PAGE) -> Dict[str, Any]:
     """
-    Lists available conversation topics for the user.
+    Lists the user's conversation topics, newest first, with how many
+    threads each has. Pass cursor back for the next page.
     """
-    return list(FAKE_DB.get(user_id, {}).keys())
+    try:
+        topic_list, next_cursor = threads.topics(user_id, cursor, max(1, min(limit, threads.PAGE)))
+    except ValueError as e:
+        return {"error": str(e)}
+    return {"topics": topic_list, "cursor": next_cursor}
 
 @mcp.tool()
-def get_thread_summary(user_id: str, topic: str) -> str:
+def get_thread_summary(user_id: str, topic: str, cursor: Optional[int] = None, limit: int = 20) -> str:
     """
-    Returns a brief summary of threads matching the topic.
+    Returns a brief summary of threads matching the topic, newest first.
     """
-    threads = FAKE_DB.get(user_id, {}).get(topic, [])
-    if not threads:
+    try:
+        thread_list, next_cursor = threads.by_topic(user_id, topic, cursor, max(1, min(limit, threads.PAGE)))
+    except ValueError as e:
+        return str(e)
+    if not thread_list:
         return f"No threads found for topic '{topic}'."
-    summary_list = [f"{i+1}. {t['summary']} (id: {t['id']})" for i, t in enumerate(threads)]
+    summary_list = [f"{i+1}. {t['summary']} ({t['count']} messages, id: {t['id']})" for i, t in enumerate(thread_list)]
+    if next_cursor:
+        summary_list.append(f"More with cursor={next_cursor}")
     return "\n".join(summary_list)
 
 @mcp.tool()
-def get_thread_content(user_id: str, thread_id: str) -> str:
+def get_thread_content(user_id: str, thread_id: int, cursor: Optional[str] = None, max_bytes: int = threads.MAX_BYTES) -> str:
+    """
+    Retrieves a thread's messages in order, a page of at most max_bytes
+    (and never more than 16384) at a time. Pass cursor back for the rest;
+    a message bigger than a page comes over several.
+    """
+    if not threads.thread(user_id, thread_id):
+        return "Thread not found."
+    try:
+        message_list, next_cursor = threads.messages(thread_id, cursor, max(1, min(max_bytes, threads.MAX_BYTES)))
+    except ValueError as e:
+        return str(e)
+    line_list = []
+    for message in message_list:
+        text = message['content']
+        if message.get('offset'):
+            text = f"[...from byte {message['offset']}]\n" + text
+        if message.get('truncated'):
+            text += f"\n[{message['truncated']} more bytes on the next page]"
+        line_list.append(f"[{message['role']}] {text}")
+    if next_cursor:
+        line_list.append(f"More with cursor={next_cursor}")
+    return "\n\n".join(line_list)
+
+@mcp.tool()
+def search_conversations(user_id: str, query: str, limit: int = 10) -> str:
     """
-    Retrieves full content of a specific thread by ID.
+    Keyword search over the user's stored conversations, best match first.
     """
-    return THREAD_CONTENT.get(thread_id, "Thread not found.")
+    hits = objectdb.search(query, {'meta.user': user_id}, limit=max(1, min(limit, threads.PAGE)))
+    if not hits:
+        return f"Nothing found for '{query}'."
+    return "\n".join([f"{i+1}. {h['snippet']} (id: {h['id']})" for i, h in enumerate(hits)])
 
 if __name__ == "__main__":
     mcp.run()
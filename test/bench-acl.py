@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# What the casbin check costs each request at a policy the size a real
+# user base gets to: users in teams, each with their own conversations,
+# teams with shared ones and a few public ones everyone can read.
+#
+#   decision    enforce() alone, casbin's Enforcer against acl.py's
+#               CachedEnforcer, on a skewed mix of requests (most of
+#               them are the same few people reading the same few
+#               conversations, like in real life)
+#   middleware  a whole request through app.py's app, bearer token and
+#               all, to the account routes, where CasbinMiddleware
+#               checks it: with casbin's Enforcer, with acl.py's, and
+#               with one that lets everything through, for what the
+#               rest costs. None of the paths are routes, so what gets
+#               past the check is a 404, the same either way.
+#   reload      how long picking up a changed policy file takes
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '0.1', 'dayz'))
+os.environ.setdefault('DAYZER_POLICY_CHECK', '3600')
+os.environ.setdefault('LITELLM_LOCAL_MODEL_COST_MAP', 'True')
+tmp = tempfile.mkdtemp()
+os.environ['DB'] = os.path.join(tmp, 'bench.db')
+os.environ['AUTH_DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'auth.db')}"
+import casbin
+import acl
+import app
+import account
+from fastapi_authz import CasbinMiddleware
+
+parser = argparse.ArgumentParser(description="casbin enforcement overhead")
+parser.add_argument("--lines", type=int, default=10000, help="policy lines")
+parser.add_argument("--checks", type=int, default=20000, help="enforce() calls for the cached enforcer")
+parser.add_argument("--requests", type=int, default=2000, help="requests through the app")
+parser.add_argument("--uncached", type=int, default=100, help="how many of those casbin's own Enforcer gets, it's slow")
+args = parser.parse_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+model_path = os.path.join(here, '..', '0.1', 'dayz', 'casbin_model.conf')
+
+def policy(lines):
+    rng = random.Random(50)
+    users = max(10, lines // 5)
+    teams = max(2, users // 10)
+    line_list = [f"g, user-{user}, team-{user % teams}" for user in range(users)]
+    conversation = 0
+    while len(line_list) < lines:
+        conversation += 1
+        kind = rng.random()
+        if kind < 0.7:
+            line_list.append(f"p, user-{rng.randrange(users)}, /c/{conversation}, GET")
+        elif kind < 0.95:
+            line_list.append(f"p, team-{rng.randrange(teams)}, /c/{conversation}, GET")
+        else:
+            for user in range(0, users, max(1, users // 20)):
+                line_list.append(f"p, user-{user}, /c/{conversation}, GET")
+    return line_list[:lines], users, teams, conversation
+
+def requests(count, line_list, users, teams, conversations):
+    # Mostly people reading conversations they're allowed to, a few hot
+    # ones far more than the rest, and now and then someone poking at
+    # one that isn't theirs.
+    rng = random.Random(51)
+    p_list = [line.split(', ')[1:] for line in line_list if line.startswith('p,')]
+    request_list = []
+    for _ in range(count):
+        if rng.random() < 0.9:
+            subject, path, method = p_list[min(len(p_list), int(rng.paretovariate(1.1))) - 1]
+            if subject.startswith('team-'):
+                team = int(subject[5:])
+                subject = f"user-{team + teams * rng.randrange(max(1, (users - team) // teams))}"
+            request_list.append((subject, path, method))
+        else:
+            request_list.append((f"user-{rng.randrange(users)}", f"/c/{rng.randrange(conversations) + 1}", "GET"))
+    return request_list
+
+def decision(enforcer, request_list):
+    start = time.perf_counter()
+    allowed = sum(1 for request in request_list if enforcer.enforce(*request))
+    return (time.perf_counter() - start) / len(request_list) * 1e6, allowed
+
+class Everyone:
+    def enforce(self, *rvals):
+        return True
+
+def served(enforcer):
+    # app.app, with the account routes checked by enforcer rather than
+    # the one built from casbin_policy.csv.
+    for middleware in app.accounts.user_middleware:
+        if middleware.cls is CasbinMiddleware:
+            middleware.kwargs['enforcer'] = enforcer
+    app.accounts.middleware_stack = None
+    return app.app
+
+async def through(asgi, request_list, token_map):
+    import httpx
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi), base_url="http://bench") as client:
+        start = time.perf_counter()
+        for user, path, method in request_list:
+            await client.request(method, path, headers={'Authorization': f"Bearer {token_map[user]}"})
+        return (time.perf_counter() - start) / len(request_list) * 1e6
+
+def main():
+    policy_path = os.path.join(tmp, 'policy.csv')
+    line_list, users, teams, conversations = policy(args.lines)
+    with open(policy_path, 'w') as f:
+        f.write('\n'.join(line_list) + '\n')
+
+    plain = casbin.Enforcer(model_path, policy_path)
+    cached = acl.CachedEnforcer(model_path, policy_path)
+    request_list = requests(args.checks, line_list, users, teams, conversations)
+    print(f"{len(line_list)} policy lines, {users} users, {conversations} conversations, {len(set(request_list))} distinct requests in {len(request_list)}")
+
+    # The same requests get the same answers either way.
+    sample = request_list[:args.uncached]
+    assert [plain.enforce(*request) for request in sample] == [cached.enforce(*request) for request in sample]
+    cached.forget()
+
+    plain_us, allowed = decision(plain, sample)
+    cached_us, allowed = decision(cached, request_list)
+    print(f"decision   enforcer {plain_us:9.1f}us  cached {cached_us:5.2f}us with {acl.stats()['misses']} misses  ({allowed / len(request_list):.0%} allowed)")
+
+    # Best of a few, the difference is small next to the noise.
+    token_map = {user: account.create_access_token({"sub": user}) for user in {request[0] for request in request_list}}
+    bare = min(asyncio.run(through(served(Everyone()), request_list[:args.requests], token_map)) for _ in range(5))
+    cached_app = min(asyncio.run(through(served(cached), request_list[:args.requests], token_map)) for _ in range(5))
+    bare_sample = asyncio.run(through(served(Everyone()), sample, token_map))
+    plain_app = asyncio.run(through(served(plain), sample, token_map))
+    print(f"middleware request {bare:7.1f}us  with enforcer {plain_app:9.1f}us ({bare_sample:.1f}us without)  with cached {cached_app:7.1f}us")
+
+    with open(policy_path, 'a') as f:
+        f.write("p, user-0, /c/new, GET\n")
+    os.utime(policy_path, ns=(time.time_ns(), time.time_ns() + 10**9))
+    start = time.perf_counter()
+    assert cached.changed()
+    cached.reload()
+    took = time.perf_counter() - start
+    assert cached.enforce("user-0", "/c/new", "GET")
+    print(f"reload     {took * 1e3:.1f}ms, {acl.stats()}")
+
+main()
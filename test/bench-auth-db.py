@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Do logins and API key lookups hold up the streams sharing their event
+# loop? A pile of fake streams tick every --chunk-ms while logins (the
+# find or create user github_callback does) and API key lookups run
+# alongside, first on auth_db's sync session, the way routes used it
+# before, then on the async one. The key lookups go through
+# credentials.py, get_api_key() and then aget_api_key(), the one
+# app.prepare() awaits for every completion, starting from an empty
+# cache each time, so they're misses until a key comes round again.
+#
+# The streams' worst gap between chunks should stay near --chunk-ms
+# with the async session however many lookups there are; on the sync
+# one every query stops every stream for as long as it takes.
+import os
+import sys
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import tempfile
+
+parser = argparse.ArgumentParser(description="auth db lookups under concurrent streams")
+parser.add_argument("--users", type=int, default=20000, help="users and keys in the db")
+parser.add_argument("--streams", type=int, default=100, help="concurrent streams")
+parser.add_argument("--chunk-ms", type=float, default=20, help="time between a stream's chunks")
+parser.add_argument("--lookups", type=int, default=2000, help="lookups per mode")
+parser.add_argument("--workers", type=int, default=20, help="lookups running at once")
+args = parser.parse_args()
+
+tmp = tempfile.mkdtemp()
+os.environ['AUTH_DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'auth.db')}"
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '0.1', 'dayz'))
+from sqlalchemy import select
+import auth_db
+import credentials
+
+def seed():
+    auth_db.init_db()
+    db = auth_db.SessionLocal()
+    db.add_all([auth_db.User(username=f"user{ix}", email=f"user{ix}@example.com", oauth_provider="github", oauth_id=str(ix)) for ix in range(args.users)])
+    db.add_all([auth_db.ApiKey(key_hash=hashlib.sha256(f"sk-{ix}".encode()).hexdigest(), user_id=ix, upstream_key=f"up-{ix}") for ix in range(args.users)])
+    db.commit()
+    db.close()
+
+def sync_lookup(rng):
+    db = auth_db.SessionLocal()
+    try:
+        oauth_id = str(rng.randrange(args.users * 2))
+        user = db.query(auth_db.User).filter_by(oauth_provider="github", oauth_id=oauth_id).first()
+        if not user:
+            db.add(auth_db.User(username=f"new{oauth_id}-{rng.random()}", oauth_provider="github", oauth_id=f"{oauth_id}-{rng.random()}"))
+            db.commit()
+    finally:
+        db.close()
+    return credentials.get_api_key(f"sk-{rng.randrange(args.users * 2)}", None)
+
+async def async_lookup(rng):
+    async with auth_db.AsyncSessionLocal() as db:
+        oauth_id = str(rng.randrange(args.users * 2))
+        result = await db.execute(select(auth_db.User).filter_by(oauth_provider="github", oauth_id=oauth_id))
+        if not result.scalars().first():
+            db.add(auth_db.User(username=f"new{oauth_id}-{rng.random()}", oauth_provider="github", oauth_id=f"{oauth_id}-{rng.random()}"))
+            await db.commit()
+    return await credentials.aget_api_key(f"sk-{rng.randrange(args.users * 2)}", None)
+
+async def stream(stop, gap_list):
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(args.chunk_ms / 1000)
+        now = time.perf_counter()
+        gap_list.append((now - last) * 1000)
+        last = now
+
+async def run(mode):
+    rng = random.Random(50)
+    credentials.forget_key()
+    stop = asyncio.Event()
+    gap_list = []
+    stream_list = [asyncio.create_task(stream(stop, gap_list)) for _ in range(args.streams)]
+    await asyncio.sleep(0.2)
+
+    remaining = args.lookups
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            if mode == 'sync':
+                sync_lookup(rng)
+                # What an async route calling it does between requests.
+                await asyncio.sleep(0)
+            else:
+                await async_lookup(rng)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.workers)])
+    took = time.perf_counter() - start
+    stop.set()
+    await asyncio.gather(*stream_list)
+
+    gap_list.sort()
+    def pct(p):
+        return gap_list[min(len(gap_list) - 1, int(len(gap_list) * p))]
+    print(f"{mode:6} {args.lookups / took:8.0f} lookups/s   stream gap p50 {pct(0.5):6.1f}ms  p99 {pct(0.99):6.1f}ms  max {gap_list[-1]:6.1f}ms")
+
+async def main():
+    seed()
+    print(f"{args.users} users, {args.streams} streams at {args.chunk_ms:.0f}ms, {args.lookups} lookups {args.workers} at a time")
+    await run('sync')
+    await run('async')
+    await auth_db.async_engine.dispose()
+
+asyncio.run(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# How much content addressing and compression save on what agent tools
+# actually send. The corpus is a pile of sessions that each start from
+# one of a few big system prompts (the tool list from notes.txt and
+# Dayzer's own tool schemas in them, like Roo/Cline do), read files out
+# of a shared repo as tool results and get a fresh reply every turn.
+#
+# Every session goes through history.persist() the way capture does it,
+# once per turn with the whole transcript, under three setups, each in
+# its own process since the thresholds are read at import:
+#
+#   plain      nothing shared, nothing compressed
+#   dedup      bodies >= DAYZER_INTERN characters stored once
+#   dedup+zip  that, plus bodies >= DBCOMPRESS characters compressed
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+dayz = os.path.join(here, '..', '0.1', 'dayz')
+
+parser = argparse.ArgumentParser(description="content addressed storage on a synthetic agent corpus")
+parser.add_argument("--sessions", type=int, default=300, help="conversations")
+parser.add_argument("--turns", type=int, default=12, help="user turns per conversation")
+parser.add_argument("--files", type=int, default=150, help="files in the shared repo")
+parser.add_argument("--mode", help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+SETUP = {
+    'plain': {'DAYZER_INTERN': '0', 'DBCOMPRESS': '0'},
+    'dedup': {'DAYZER_INTERN': '1024', 'DBCOMPRESS': '0'},
+    'dedup+zip': {'DAYZER_INTERN': '1024', 'DBCOMPRESS': '4096'},
+}
+
+def corpus():
+    rng = random.Random(50)
+    with open(os.path.join(here, '..', 'notes.txt')) as f:
+        tool_names = [line.strip().strip('",') for line in f if line.strip().startswith('"')]
+
+    sys.path.insert(0, dayz)
+    from toolcalls import toolList
+
+    words = "the a to of and in is for that with on this it as be by are from at an function return value error file line".split()
+    def prose(count):
+        return ' '.join(rng.choice(words) for _ in range(count))
+
+    prompt_list = []
+    for variant in range(3):
+        tool_text = '\n\n'.join(f"## {name}\nDescription: {prose(40)}\nParameters:\n- path: (required) {prose(12)}" for name in tool_names)
+        prompt_list.append(f"You are agent variant {variant}. {prose(300)}\n\n# Tools\n\n{tool_text}\n\n# Schemas\n{json.dumps(toolList, indent=2)}\n\n# Rules\n{prose(600)}")
+
+    file_list = []
+    for ix in range(args.files):
+        body = '\n'.join(f"def f{ix}_{line}(x):\n    return x + {line}  # {prose(6)}" for line in range(rng.randint(40, 120)))
+        file_list.append((f"src/module{ix}.py", body))
+
+    for session in range(args.sessions):
+        messages = [{'role': 'system', 'content': rng.choice(prompt_list)}]
+        user = f"user{session % 40}"
+        for turn in range(args.turns):
+            messages.append({'role': 'user', 'content': f"<task>{prose(rng.randint(10, 60))}</task>"})
+            yield (user, list(messages))
+            if rng.random() < 0.5:
+                path, body = rng.choice(file_list)
+                messages.append({'role': 'assistant', 'content': f"<read_file><path>{path}</path></read_file>"})
+                messages.append({'role': 'user', 'content': f"[read_file for '{path}'] Result:\n{body}"})
+                yield (user, list(messages))
+            messages.append({'role': 'assistant', 'content': prose(rng.randint(60, 250))})
+            yield (user, list(messages))
+
+def run(mode):
+    tmp = tempfile.mkdtemp()
+    os.environ['DB'] = os.path.join(tmp, 'bench.db')
+    os.environ.update(SETUP[mode])
+    sys.path.insert(0, dayz)
+    import importlib
+    import history
+    objectdb = importlib.import_module('object-db')
+
+    sent = 0
+    requests = 0
+    start = time.time()
+    for user, messages in corpus():
+        sent += sum(len(message['content']) for message in messages)
+        requests += 1
+        with objectdb.transaction():
+            history.persist(messages, {'user': user})
+    took = time.time() - start
+
+    objectdb.run('pragma wal_checkpoint(truncate)')
+    rows, data_bytes = objectdb.run('select count(*), sum(length(data)) from objects').fetchone()
+    logical = objectdb.run("select sum(length(unpack(coalesce(o.data, c.data)))) from objects o left join relationship r on r.src_id = o.id and r.kind = 'content' left join objects c on c.id = r.dest_id where o.chain is not null").fetchone()[0]
+    print(json.dumps({
+        'mode': mode, 'requests': requests, 'sent': sent, 'rows': rows,
+        'logical': logical, 'data': data_bytes, 'file': os.path.getsize(os.environ['DB']), 'took': took
+    }))
+
+def main():
+    if args.mode:
+        return run(args.mode)
+
+    result_list = []
+    for mode in SETUP:
+        out = subprocess.run([sys.executable, __file__, '--mode', mode] + sys.argv[1:], capture_output=True, text=True, check=True)
+        result_list.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    first = result_list[0]
+    print(f"{first['requests']} requests, {first['sent'] / 1e6:.1f}MB sent, {first['logical'] / 1e6:.1f}MB of new messages after prefix diffing")
+    print(f"{'':10} {'rows':>8} {'data MB':>9} {'db MB':>8} {'dedup':>7} {'saved':>7} {'s':>6}")
+    for result in result_list:
+        print(f"{result['mode']:10} {result['rows']:>8} {result['data'] / 1e6:>9.2f} {result['file'] / 1e6:>8.2f} {result['logical'] / result['data']:>6.1f}x {1 - result['file'] / first['file']:>6.0%} {result['took']:>6.1f}")
+
+main()
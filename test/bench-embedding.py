@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Recall@k and queries per second for the local vector index in
+# 0.1/dayz/embedding.py, exact search against the IVF lists.
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '0.1', 'dayz'))
+import embedding
+
+parser = argparse.ArgumentParser(description="embedding recall and throughput")
+parser.add_argument("--docs", type=int, default=100000, help="documents to index")
+parser.add_argument("--queries", type=int, default=500, help="queries to run")
+parser.add_argument("--k", type=int, default=10, help="top k")
+parser.add_argument("--nlist", type=int, default=256, help="IVF lists")
+parser.add_argument("--nprobe", default="4,16,32", help="IVF lists to probe")
+args = parser.parse_args()
+
+random.seed(50)
+vocab = ['w{}'.format(ix) for ix in range(30000)]
+topics = [random.sample(vocab, 40) for ix in range(500)]
+
+def doc(topic):
+  return ' '.join(random.choices(topics[topic], k=30) + random.choices(vocab, k=10))
+
+doc_topic = [random.randrange(len(topics)) for ix in range(args.docs)]
+doc_list = [doc(topic) for topic in doc_topic]
+
+# A query is a handful of words pulled out of one document.
+query_doc = [random.randrange(args.docs) for ix in range(args.queries)]
+query_list = [' '.join(random.sample(doc_list[ix].split(), 8)) for ix in query_doc]
+
+embedder = embedding.HashingEmbedder()
+store = embedding.VectorStore(os.path.join(tempfile.mkdtemp(), 'bench'), embedder.dim)
+
+start = time.time()
+for offset in range(0, args.docs, 10000):
+  store.append(list(range(offset, min(offset + 10000, args.docs))), embedder.embed(doc_list[offset:offset + 10000]))
+print("embedded and stored {} docs in {:.1f}s".format(args.docs, time.time() - start))
+
+queries = embedder.embed(query_list)
+
+def timed(label, batch, nprobe=None):
+  start = time.time()
+  result = []
+  for offset in range(0, len(queries), batch):
+    result += store.search(queries[offset:offset + batch], args.k, nprobe)
+  qps = len(queries) / (time.time() - start)
+  return (result, qps)
+
+exact, qps = timed("exact", 1)
+exact_batched, qps_batched = timed("exact", 64)
+found = np.mean([ix in [hit[0] for hit in hits] for ix, hits in zip(query_doc, exact)])
+print("{:<16} recall@{} of source doc {:.3f}  {:>8.0f} qps  {:>8.0f} qps batched by 64".format("exact", args.k, found, qps, qps_batched))
+
+start = time.time()
+store.train(nlist=args.nlist)
+print("trained {} IVF lists in {:.1f}s".format(args.nlist, time.time() - start))
+
+for nprobe in [int(x) for x in args.nprobe.split(',')]:
+  approx, qps = timed("ivf", 1, nprobe)
+  overlap = np.mean([len(set(h[0] for h in a) & set(h[0] for h in e)) / max(len(e), 1) for a, e in zip(approx, exact)])
+  found = np.mean([ix in [hit[0] for hit in hits] for ix, hits in zip(query_doc, approx)])
+  print("{:<16} recall@{} of source doc {:.3f}  recall@{} vs exact {:.3f}  {:>8.0f} qps".format("ivf nprobe={}".format(nprobe), args.k, found, args.k, overlap, qps))
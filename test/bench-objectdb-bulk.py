@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# Inserting a pile of rows into object-db.py through insert() one at a
+# time versus insert_many().
+import os
+import time
+import argparse
+import tempfile
+import importlib.util
+
+parser = argparse.ArgumentParser(description="object-db bulk vs per-row inserts")
+parser.add_argument("--rows", type=int, default=100000, help="rows to insert")
+args = parser.parse_args()
+
+tmp = tempfile.mkdtemp()
+os.environ['DB'] = os.path.join(tmp, 'bench.db')
+
+spec = importlib.util.spec_from_file_location('objectdb', os.path.join(os.path.dirname(__file__), '..', '0.1', 'dayz', 'object-db.py'))
+objectdb = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(objectdb)
+
+def rows():
+  return [{'data': 'message {} '.format(ix) * 10, 'meta': {'user': 'u{}'.format(ix % 50), 'role': 'user'}} for ix in range(args.rows)]
+
+def edges(id_list):
+  return [{'src_id': id_list[ix - 1], 'dest_id': id_list[ix]} for ix in range(1, len(id_list))]
+
+def timed(label, fn):
+  start = time.time()
+  fn()
+  took = time.time() - start
+  print("{:<28} {:>8.2f}s {:>10.0f} rows/s".format(label, took, args.rows / took))
+  return took
+
+def per_row():
+  id_list = [objectdb.insert('objects', row) for row in rows()]
+  for edge in edges(id_list):
+    objectdb.insert('relationship', edge)
+
+def per_row_txn():
+  with objectdb.transaction():
+    per_row()
+
+def bulk():
+  id_list = objectdb.insert_many('objects', rows())
+  objectdb.insert_many('relationship', edges(id_list))
+
+print("{} objects + {} relationship rows each".format(args.rows, args.rows - 1))
+slow = timed("insert() per row", per_row)
+timed("insert() in transaction()", per_row_txn)
+fast = timed("insert_many()", bulk)
+print("bulk is {:.1f}x the per-row path".format(slow / fast))
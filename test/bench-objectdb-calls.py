@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# Per-call overhead of object-db.py's insert() and findOne(). Writes
+# run inside one transaction() so this is the python side of things
+# and not fsync. Point --module at an older copy of object-db.py
+# (git show <rev>:0.1/dayz/object-db.py > old.py) to compare.
+import os
+import time
+import argparse
+import tempfile
+import importlib.util
+
+parser = argparse.ArgumentParser(description="object-db per-call overhead")
+parser.add_argument("--calls", type=int, default=20000, help="calls per measurement")
+parser.add_argument("--repeat", type=int, default=5, help="measurements to take the best of")
+parser.add_argument("--module", default=os.path.join(os.path.dirname(__file__), '..', '0.1', 'dayz', 'object-db.py'), help="object-db.py to load")
+args = parser.parse_args()
+
+tmp = tempfile.mkdtemp()
+os.environ['DB'] = os.path.join(tmp, 'bench.db')
+
+spec = importlib.util.spec_from_file_location('objectdb', args.module)
+objectdb = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(objectdb)
+
+def timed(label, fn):
+  best = None
+  for attempt in range(args.repeat):
+    start = time.perf_counter()
+    for ix in range(args.calls):
+      fn(ix)
+    took = time.perf_counter() - start
+    best = took if best is None else min(best, took)
+  print("{:<10} {:>8.2f} us/call".format(label, best / args.calls * 1e6))
+
+with objectdb.transaction():
+  timed("insert", lambda ix: objectdb.insert('objects', {'data': 'message {}'.format(ix), 'meta': {'user': 'u{}'.format(ix % 50)}}))
+
+timed("findOne", lambda ix: objectdb.findOne('objects', {'id': ix + 1}))
+timed("get", lambda ix: objectdb.get('objects', ix + 1))
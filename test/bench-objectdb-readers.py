@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Read throughput of object-db.py as the number of reader threads goes
+# up, with the old global lock (DBSERIAL) and with per-thread readers.
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+import importlib.util
+
+parser = argparse.ArgumentParser(description="object-db reader scaling")
+parser.add_argument("--rows", type=int, default=5000, help="rows to seed")
+parser.add_argument("--seconds", type=float, default=2.0, help="time per round")
+parser.add_argument("--threads", default="1,2,4,8", help="thread counts to try")
+args = parser.parse_args()
+
+tmp = tempfile.mkdtemp()
+os.environ['DB'] = os.path.join(tmp, 'bench.db')
+
+spec = importlib.util.spec_from_file_location('objectdb', os.path.join(os.path.dirname(__file__), '..', '0.1', 'dayz', 'object-db.py'))
+objectdb = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(objectdb)
+
+db = objectdb.writer()
+db['c'].executemany('insert into objects(data, meta) values(?, ?)', [
+  ('message {} '.format(ix) * 20, '{{"user": "u{}"}}'.format(ix % 50)) for ix in range(args.rows)
+])
+db['conn'].commit()
+
+def reader(stop, counts, slot):
+  n = 0
+  while not stop.is_set():
+    if n % 2:
+      objectdb.get('objects', random.randint(1, args.rows))
+    else:
+      objectdb.findOne('objects', {'id': random.randint(1, args.rows)})
+    n += 1
+  counts[slot] = n
+
+def measure(thread_count):
+  stop = threading.Event()
+  counts = [0] * thread_count
+  pool = [threading.Thread(target=reader, args=(stop, counts, ix)) for ix in range(thread_count)]
+  for t in pool:
+    t.start()
+  time.sleep(args.seconds)
+  stop.set()
+  for t in pool:
+    t.join()
+  return sum(counts) / args.seconds
+
+print("{:>8} {:>12} {:>12} {:>8}".format("threads", "serial/s", "parallel/s", "ratio"))
+for thread_count in [int(x) for x in args.threads.split(',')]:
+  objectdb._serial = True
+  serial = measure(thread_count)
+  objectdb._serial = False
+  parallel = measure(thread_count)
+  print("{:>8} {:>12.0f} {:>12.0f} {:>8.2f}".format(thread_count, serial, parallel, parallel / serial))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# Latency of object-db.py search() over a synthetic pile of chat
+# messages, with and without a meta filter.
+import os
+import time
+import random
+import argparse
+import tempfile
+import importlib.util
+
+parser = argparse.ArgumentParser(description="object-db full text search latency")
+parser.add_argument("--rows", type=int, default=1000000, help="messages to index")
+parser.add_argument("--queries", type=int, default=200, help="queries to time")
+args = parser.parse_args()
+
+tmp = tempfile.mkdtemp()
+os.environ['DB'] = os.path.join(tmp, 'bench.db')
+
+spec = importlib.util.spec_from_file_location('objectdb', os.path.join(os.path.dirname(__file__), '..', '0.1', 'dayz', 'object-db.py'))
+objectdb = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(objectdb)
+
+random.seed(50)
+# A zipf-ish vocabulary so there are both very common and rare words.
+vocab = ['w{}'.format(ix) for ix in range(20000)]
+cum_weights = []
+for ix in range(len(vocab)):
+  cum_weights.append((cum_weights[-1] if cum_weights else 0) + 1.0 / (ix + 1))
+
+def message():
+  return ' '.join(random.choices(vocab, cum_weights=cum_weights, k=30))
+
+start = time.time()
+for offset in range(0, args.rows, 50000):
+  count = min(50000, args.rows - offset)
+  objectdb.insert_many('objects', [{'data': message(), 'meta': {'user': 'u{}'.format(random.randint(0, 999))}} for ix in range(count)])
+objectdb.fts_optimize()
+print("indexed {} rows in {:.1f}s".format(args.rows, time.time() - start))
+
+def timed(label, filters):
+  took = []
+  for ix in range(args.queries):
+    query = ' '.join(random.choices(vocab[:2000], k=3))
+    start = time.perf_counter()
+    objectdb.search(query, filters() if filters else {}, limit=10)
+    took.append((time.perf_counter() - start) * 1000)
+  took.sort()
+  print("{:<14} p50 {:>7.2f}ms  p99 {:>7.2f}ms".format(label, took[len(took) // 2], took[int(len(took) * 0.99)]))
+
+timed("search", None)
+timed("search+user", lambda: {'meta.user': 'u{}'.format(random.randint(0, 999))})
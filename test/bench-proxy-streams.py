@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Load test for streaming through the proxy. It runs a fake upstream
+# that streams SSE chunks at a fixed pace (app.py talks to
+# localhost:8080 so that's where it listens) and a few of its requests
+# stall for a long time before their first byte. Then it opens more and
+# more concurrent streams through --proxy and reports time to first
+# byte and the worst gap between chunks.
+#
+# If the proxy never blocks its event loop, those numbers stay flat as
+# concurrency goes up and the stalled requests don't show up in anyone
+# else's gaps. Start the proxy first, it listens on 8778, with the
+# key the bench sends (--api-key) on record:
+#
+#   export AUTH_DATABASE_URL=sqlite:////tmp/bench-auth.db
+#   python -c 'import auth_db, credentials; auth_db.init_db(); credentials.create_api_key("sk-bench", 1, upstream_key="sk-bench")'
+#   python app.py
+#
+# --proxy http://localhost:8080/v1 measures the fake upstream
+# directly as a baseline. Every stream asks something different, or
+# the proxy would rightly answer them all off one upstream call (see
+# coalesce.py).
+import time
+import json
+import asyncio
+import argparse
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+parser = argparse.ArgumentParser(description="concurrent streaming load test")
+parser.add_argument("--proxy", default="http://localhost:8778/v1", help="base url to send completions to")
+parser.add_argument("--model", default="openai/bench", help="model to ask for, litellm wants the provider in front")
+parser.add_argument("--api-key", default="sk-bench", help="API_KEY to send, it has to be on record in auth_db")
+parser.add_argument("--port", type=int, default=8080, help="port for the fake upstream")
+parser.add_argument("--chunks", type=int, default=50, help="chunks per stream")
+parser.add_argument("--chunk-ms", type=float, default=20, help="upstream delay between chunks")
+parser.add_argument("--stall-s", type=float, default=5, help="how long the stalled requests wait")
+parser.add_argument("--stalled", type=int, default=2, help="stalled requests in each round")
+parser.add_argument("--concurrency", default="1,10,50,100", help="concurrent streams per round")
+args = parser.parse_args()
+
+
+async def upstream(request):
+    body = await request.json()
+    stall = (body.get('model') or '').endswith('stall')
+
+    async def generate():
+        if stall:
+            await asyncio.sleep(args.stall_s)
+        for ix in range(args.chunks):
+            chunk = {"id": "bench", "object": "chat.completion.chunk", "model": body.get('model'), "choices": [{"index": 0, "delta": {"content": f"tok{ix} "}}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(args.chunk_ms / 1000)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+app = Starlette(routes=[
+    Route("/v1/chat/completions", upstream, methods=["POST"]),
+    Route("/chat/completions", upstream, methods=["POST"]),
+])
+
+
+async def one_stream(client, model, ix):
+    start = time.perf_counter()
+    first = None
+    last = start
+    worst_gap = 0.0
+    body = {"model": model, "stream": True, "messages": [{"role": "user", "content": f"Hello {ix}!"}]}
+    async with client.stream("POST", f"{args.proxy}/chat/completions", json=body, headers={"API_KEY": args.api_key}) as response:
+        if response.status_code != 200:
+            raise SystemExit(f"{args.proxy} answered {response.status_code}: {(await response.aread()).decode(errors='replace')[:500]}")
+        async for chunk in response.aiter_raw():
+            now = time.perf_counter()
+            if first is None:
+                first = now - start
+            else:
+                worst_gap = max(worst_gap, now - last)
+            last = now
+    return (first or 0.0, worst_gap)
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+async def main():
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning"))
+    serve = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        print(f"{'streams':>8} {'ttfb p50':>10} {'ttfb p99':>10} {'gap p50':>10} {'gap p99':>10}   (ms, upstream gap is {args.chunk_ms:g})")
+        for concurrency in [int(x) for x in args.concurrency.split(',')]:
+            stalled = [asyncio.create_task(one_stream(client, args.model + '-stall', ix)) for ix in range(args.stalled)]
+            await asyncio.sleep(0.1)
+            result = await asyncio.gather(*[one_stream(client, args.model, ix) for ix in range(concurrency)])
+            for task in stalled:
+                task.cancel()
+            ttfb = [r[0] for r in result]
+            gap = [r[1] for r in result]
+            print(f"{concurrency:>8} {pct(ttfb, 0.5):>10.1f} {pct(ttfb, 0.99):>10.1f} {pct(gap, 0.5):>10.1f} {pct(gap, 0.99):>10.1f}")
+
+    server.should_exit = True
+    await serve
+
+asyncio.run(main())
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Per-chunk CPU cost of the two ways app.py can stream a completion:
+#
+#   reencode     what litellm does for us: every chunk decoded into a
+#                model object and model_dump_json()'d back out
+#   passthrough  sse.tee(): bytes forwarded as is, with the SSE parser
+#                and the accumulator picking out text and tool calls
+#   relay only   the part of passthrough that happens while the stream
+#                is still going; the json decoding waits for the end
+#   raw          bytes forwarded as is and nothing else, the floor
+#
+# The chunks are what an OpenAI style upstream sends: mostly one token
+# of content each, with a tool call streamed in at the end.
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from typing import Optional
+from pydantic import BaseModel
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '0.1', 'dayz'))
+import sse
+
+parser = argparse.ArgumentParser(description="sse per chunk cpu benchmark")
+parser.add_argument("--chunks", type=int, default=200000, help="chunks per mode")
+parser.add_argument("--stream", type=int, default=500, help="chunks per completion")
+parser.add_argument("--per-read", type=int, default=1, help="sse events per network read")
+args = parser.parse_args()
+
+try:
+    from litellm.types.utils import ModelResponseStream
+    def decode(data):
+        return ModelResponseStream(**json.loads(data))
+    which = 'litellm ModelResponseStream'
+except ImportError:
+    # Close enough to litellm's chunk model for what it costs to build
+    # and dump, if litellm isn't around.
+    class Function(BaseModel):
+        name: Optional[str] = None
+        arguments: Optional[str] = None
+
+    class ToolCall(BaseModel):
+        index: int = 0
+        id: Optional[str] = None
+        type: Optional[str] = None
+        function: Optional[Function] = None
+
+    class Delta(BaseModel):
+        role: Optional[str] = None
+        content: Optional[str] = None
+        tool_calls: Optional[list[ToolCall]] = None
+
+    class Choice(BaseModel):
+        index: int = 0
+        delta: Delta
+        finish_reason: Optional[str] = None
+        logprobs: Optional[dict] = None
+
+    class Chunk(BaseModel):
+        id: str
+        object: str
+        created: int
+        model: str
+        system_fingerprint: Optional[str] = None
+        choices: list[Choice]
+        usage: Optional[dict] = None
+
+    def decode(data):
+        return Chunk(**json.loads(data))
+    which = 'pydantic stand-in'
+
+
+def make_events(count):
+    base = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 1760000000, "model": "bench-model", "system_fingerprint": "fp_bench"}
+    event_list = []
+    for ix in range(count):
+        if ix == 0:
+            delta = {"role": "assistant", "content": ""}
+        elif ix < count - 20:
+            delta = {"content": f" token{ix % 97}"}
+        elif ix == count - 20:
+            delta = {"tool_calls": [{"index": 0, "id": "call_bench", "type": "function", "function": {"name": "get_conversations_from", "arguments": ""}}]}
+        else:
+            delta = {"tool_calls": [{"index": 0, "function": {"arguments": "{\"q\": " if ix == count - 19 else "\"x\""}}]}
+        event_list.append(json.dumps({**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}))
+    return event_list
+
+async def reads(read_list):
+    for read in read_list:
+        yield read
+
+async def reencode(event_list, read_list):
+    out = 0
+    for data in event_list:
+        out += len(f"data:{decode(data).model_dump_json()}\n\n".encode())
+    return out
+
+async def passthrough(event_list, read_list):
+    out = 0
+    # on_done decodes everything so that counts too, not just the relay.
+    async for chunk in sse.tee(reads(read_list), lambda accumulator: accumulator.message()):
+        out += len(chunk)
+    return out
+
+async def relay_only(event_list, read_list):
+    out = 0
+    async for chunk in sse.tee(reads(read_list)):
+        out += len(chunk)
+    return out
+
+async def raw(event_list, read_list):
+    out = 0
+    async for chunk in reads(read_list):
+        out += len(chunk)
+    return out
+
+async def run(mode, stream_list):
+    for event_list, read_list in stream_list:
+        await mode(event_list, read_list)
+
+def main():
+    event_list = make_events(args.stream)
+    wire = [f"data: {data}\n\n".encode() for data in event_list]
+    wire.append(b"data: [DONE]\n\n")
+    read_list = [b''.join(wire[ix:ix + args.per_read]) for ix in range(0, len(wire), args.per_read)]
+    stream_list = [(event_list, read_list)] * max(1, args.chunks // args.stream)
+    chunks = len(stream_list) * args.stream
+
+    print(f"{chunks} chunks in {len(stream_list)} completions, {args.per_read} per read, reencode through {which}")
+    for name, mode in [('reencode', reencode), ('passthrough', passthrough), ('relay only', relay_only), ('raw', raw)]:
+        start = time.process_time()
+        asyncio.run(run(mode, stream_list))
+        took = time.process_time() - start
+        print(f"{name:12} {took * 1e6 / chunks:8.2f} us/chunk")
+
+main()